@@ -0,0 +1,211 @@
+#! /usr/bin/env python3
+"""
+Cold start of tool processes, from exec to exit: the bundled examples and
+synthetic tools of increasing size, with wall time, peak RSS and import time.
+
+    $ python benchmarks/coldstart.py -n 30 --save base.json
+    $ python benchmarks/coldstart.py -n 30 --baseline base.json -t 10
+"""
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from libcli import default, error, run
+
+# Command line of each example, run in a scratch directory
+EXAMPLES = {
+    'hello_world.py': [],
+    'simple_options.py': ['--aflag', '--cvalue', '1', 'x'],
+    'simple_options_hinted.py': ['-a', '-c', '1', 'x'],
+    'simple_arithmetic.py': ['1', '+', '2', 'x', '3'],
+    'gnu_getopt.py': ['-a', '-c', '1', 'x'],
+    'gnu_getopt_long.py': ['--verbose', '-a', 'x'],
+    'crud.py': ['list'],
+    'crud_class.py': ['--filename', 'crud.json', 'list'],
+    'stream_log.py': ['read-log', 'app.log', 'filter', '--level', 'error', \
+        'count'],
+    }
+
+SYNTHETIC = '''\
+@command(level='l:int', name='n:str', verbose='_v')
+def cmd{i}(path, *, level=1, name=None, verbose=None):
+{doc}    return path
+
+'''
+
+DOCSTRING = '''\
+    """Command {i} of a synthetic tool.
+
+    :param path: Path of the input
+    :param level: Level of detail
+    :param name: Name of the output
+    """
+'''
+
+_importtime = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+@error(errno=1)
+class Regression(Exception):
+    pass
+
+
+def synthetic(directory, size, docstrings):
+    """Write a tool with size commands, return its path and command line."""
+    path = os.path.join(directory, 'synthetic_{}{}.py'.format(size, \
+        '_doc' if docstrings else ''))
+    with open(path, 'w') as f:
+        f.write('from libcli import command, run\n\n')
+        for i in range(size):
+            f.write(SYNTHETIC.format(i=i, doc=DOCSTRING.format(i=i) \
+                if docstrings else ''))
+        f.write("if __name__ == '__main__':\n    run()\n")
+    return path, ['cmd{}'.format(size // 2), '-l', '2', '--name', 'out', 'x']
+
+
+def spawn(argv, env, cwd):
+    """Run argv, return wall time in ms, peak RSS in KiB and stderr."""
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(argv, env=env, cwd=cwd, \
+            stdout=subprocess.DEVNULL, stderr=stderr)
+        # Reaped here for its resource usage, instead of by Popen.wait
+        pid, status, rusage = os.wait4(process.pid, 0)
+        wall = (time.perf_counter() - start) * 1000
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stderr.seek(0)
+        output = stderr.read().decode('utf-8', 'replace')
+    if process.returncode:
+        raise RuntimeError('"{}" exited with {}:\n{}'.format(' '.join(argv), \
+            process.returncode, output))
+    # Kilobytes on Linux, bytes on macOS
+    rss = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' \
+        else rusage.ru_maxrss
+    return wall, rss, output
+
+
+def summary(samples):
+    return {
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        'p95': statistics.quantiles(samples, n=20)[18] \
+            if len(samples) > 1 else samples[0],
+        'min': min(samples),
+        }
+
+
+def importtime(argv, env, cwd, n):
+    """Median self and cumulative import time in us of each top level
+    import over n runs with -X importtime.
+    """
+    samples = {}
+    for i in range(n):
+        wall, rss, output = spawn([argv[0], '-X', 'importtime'] + argv[1:], \
+            env, cwd)
+        for line in output.splitlines():
+            match = _importtime.match(line)
+            if match is not None:
+                samples.setdefault(match.group(4), []).append( \
+                    (int(match.group(1)), int(match.group(2)), \
+                        len(match.group(3))))
+    return {k: (statistics.median(x[0] for x in v), \
+        statistics.median(x[1] for x in v), v[0][2]) \
+        for k, v in samples.items()}
+
+
+def measure(name, argv, env, cwd, n, top):
+    spawn(argv, env, cwd) # Warm up the page cache
+    walls, rsss = [], []
+    for i in range(n):
+        wall, rss, output = spawn(argv, env, cwd)
+        walls.append(wall)
+        rsss.append(rss)
+    result = {'wall': summary(walls), 'rss': summary(rsss)}
+    print('{:<28} median {:8.2f} ms  p95 {:8.2f} ms  stdev {:7.2f} ms  '\
+        'rss {:8.0f} KiB'.format(name, result['wall']['median'], \
+        result['wall']['p95'], result['wall']['stdev'], \
+        result['rss']['median']))
+    if top:
+        modules = importtime(argv, env, cwd, n)
+        result['importtime'] = {k: v[1] for k, v in modules.items() if v[2] <= 1}
+        for module, times in sorted(modules.items(), key=lambda x: x[1][0], \
+                reverse=True)[:top]:
+            print('    {:<40} self {:8.0f} us  cumulative {:8.0f} us'.format( \
+                module, times[0], times[1]))
+    return result
+
+
+def compare(results, baseline, threshold):
+    """Raise Regression if a median is threshold percent above baseline."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('wall', 'rss'):
+            old = baseline[name][metric]['median']
+            new = result[metric]['median']
+            change = (new - old) / old * 100 if old else 0.0
+            if change > threshold:
+                regressions.append('{} {} median {:.2f} -> {:.2f} ({:+.1f}%)'.\
+                    format(name, metric, old, new, change))
+    if regressions:
+        raise Regression('Regressions beyond {}%: {}'.format(threshold, \
+            '; '.join(regressions)))
+    print('No regression beyond {}%'.format(threshold))
+
+
+@default(n='n:int', sizes='s:list', docstrings='d:str', top='i:int', \
+    save='o:str', baseline='b:str', threshold='t:float', examples='e:str')
+def main(*argv, n=20, sizes=['10', '100', '1000', '5000'], docstrings='both', \
+        top=0, save=None, baseline=None, threshold=10.0, examples='yes'):
+    """Spawn each tool n times, report wall time and peak RSS.
+
+    :param n: Number of measured runs per tool, after a warm up run
+    :param sizes: Numbers of commands of the synthetic tools
+    :param docstrings: Synthetic commands with docstrings, "yes", "no" or "both"
+    :param top: Report the slowest imports of n more runs with -X importtime
+    :param save: Write the results as JSON
+    :param baseline: Compare medians with results saved before
+    :param threshold: Percentage above the baseline failing the comparison
+    :param examples: Include the bundled examples, "yes" or "no"
+    """
+    if docstrings not in ('yes', 'no', 'both'):
+        raise ValueError('docstrings should be "yes", "no" or "both"')
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, 'app.log'), 'w') as f:
+            for i in range(1000):
+                f.write('{} line {}\n'.format(('INFO', 'ERROR')[i % 7 == 0], i))
+        targets = []
+        if examples == 'yes':
+            for script, command in EXAMPLES.items():
+                targets.append((script[:-3], [sys.executable, os.path.join( \
+                    ROOT, 'examples', script)] + command))
+        for size in sizes:
+            for doc in ((True, False) if docstrings == 'both' \
+                    else (docstrings == 'yes',)):
+                path, command = synthetic(tmpdir, int(size), doc)
+                targets.append(('synthetic-{}{}'.format(size, \
+                    '-doc' if doc else ''), [sys.executable, path] + command))
+        for name, argv in targets:
+            results[name] = measure(name, argv, env, tmpdir, n, top)
+    if save is not None:
+        with open(save, 'w') as f:
+            json.dump({'python': sys.version, 'results': results}, f, indent=1)
+    if baseline is not None:
+        with open(baseline) as f:
+            compare(results, json.load(f)['results'], threshold)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,80 @@
+#! /usr/bin/env python3
+"""
+Latency of a command run by a cold interpreter versus through a server.
+
+    $ python benchmarks/forkserver.py -n 50
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from libcli import default, run
+import libcli.client
+
+
+def measure(func, n):
+    samples = []
+    for i in range(n):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(name, samples):
+    print('{:<28} median {:8.2f} ms   mean {:8.2f} ms   min {:8.2f} ms'.format( \
+        name, statistics.median(samples), statistics.mean(samples), \
+        min(samples)))
+
+
+def wait_socket(path, process, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if process.poll() is not None or time.monotonic() > deadline:
+            raise RuntimeError('Server failed to start')
+        time.sleep(0.01)
+
+
+@default(n='n:int', script='s:str')
+def main(*argv, n=20, script=os.path.join(ROOT, 'examples', 'crud_class.py')):
+    """Compare cold start with prefork and fork server modes.
+
+    :param n: Number of runs per mode
+    :param script: Tool to run, with a "list" command
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            open(os.devnull, 'wb') as devnull:
+        storage = os.path.join(tmpdir, 'crud.json')
+        command = ['--filename', storage, 'list']
+        report('cold start', measure(lambda: subprocess.run( \
+            [sys.executable, script] + command, env=env, stdout=devnull, \
+            stderr=devnull, check=True), n))
+        for mode in ('prefork', 'fork'):
+            path = os.path.join(tmpdir, mode + '.sock')
+            server = subprocess.Popen([sys.executable, script, \
+                '--libcli-serve', path, '--libcli-serve-mode', mode, \
+                '--libcli-jobs', '2'], env=env, cwd=tmpdir)
+            try:
+                wait_socket(path, server)
+                stdio = (0, devnull.fileno(), devnull.fileno())
+                report('{} server, in process'.format(mode), measure( \
+                    lambda: libcli.client.call(path, ['crud'] + command, \
+                        stdio=stdio), n))
+                report('{} server, python client'.format(mode), measure( \
+                    lambda: subprocess.run([sys.executable, '-m', \
+                        'libcli.client', path, 'crud'] + command, env=env, \
+                        stdout=devnull, stderr=devnull, check=True), n))
+            finally:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,43 @@
+#! /usr/bin/env python3
+"""
+Streaming chained commands, runs in constant memory over large logs.
+
+    $ ./stream_log.py read-log app.log filter --level error count
+    $ ./stream_log.py read-log app.log filter --level warning head -n 5 print
+"""
+from libcli import command, run
+import libcli.opttools
+
+#libcli.opttools.DEBUG = True
+
+@command(_name='read-log', filename='_:str')
+def read_log(filename):
+    with open(filename, 'r') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+@command(level='l:str')
+def filter(lines, *, level='error'):
+    level = level.upper()
+    for line in lines:
+        if level in line:
+            yield line
+
+@command(n='n:int')
+def head(lines, *, n=10):
+    # Stop reading early, read-log would be finalized and close its file
+    for i, line in zip(range(n), lines):
+        yield line
+
+@command(_name='print')
+def print_(lines):
+    for line in lines:
+        print(line)
+        yield line
+
+@command
+def count(lines):
+    print(sum(1 for _ in lines))
+
+if __name__ == '__main__':
+    run()
@@ -1,8 +1,20 @@
 __version__ = "0.3.3"
+
 from .opttools import OptionHandler
 
 default_handler = OptionHandler()
 command = default_handler.command
 default = default_handler.default
 error = default_handler.error
+encoder = default_handler.encoder
 run = default_handler.run
+
+
+def fast_help(argv=None):
+    """Exit after printing the cached help if argv, sys.argv by default,
+    asks for it. Called by a tool before importing its commands.
+    """
+    import sys
+    from .usage import print_cached
+    if print_cached(sys.argv if argv is None else argv):
+        sys.exit(0)
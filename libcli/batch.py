@@ -0,0 +1,261 @@
+import collections
+import concurrent.futures
+import io
+import itertools
+import logging
+import multiprocessing
+import os
+import shlex
+import sys
+import threading
+
+_logger = logging.getLogger(__name__)
+
+# State of a process pool worker, inherited through fork
+_worker = None
+
+# Operands per chunk of a lazy iterator mapped by map_chunks
+LAZY_CHUNKSIZE = 1024
+
+
+class ThreadStream():
+    """Proxy of a text stream, writes from a thread go to the buffer
+    assigned to that thread if any, otherwise to the wrapped stream.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._local, 'target', self._stream), name)
+
+    def redirect(self, target):
+        if target is None:
+            del self._local.target
+        else:
+            self._local.target = target
+
+
+class LineRecords(logging.Filter):
+    """Filter of a logger holding back the records logged from a thread
+    running a line, to be handled in input order with its output.
+    """
+    def __init__(self):
+        super().__init__()
+        self._local = threading.local()
+
+    def capture(self, records):
+        """Append records of this thread to the list records, stop if None."""
+        self._local.records = records
+
+    def filter(self, record):
+        records = getattr(self._local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+def _portable(record):
+    """Record with its message and traceback formatted, to be pickled."""
+    record.msg = record.getMessage()
+    record.args = None
+    if record.exc_info:
+        record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+    return record
+
+
+def _capture(handler, argv, lineno, last, logger, debug, settings, scan, \
+        stdout, stderr, records):
+    out, err, logged = io.StringIO(), io.StringIO(), []
+    stdout.redirect(out)
+    stderr.redirect(err)
+    records.capture(logged)
+    try:
+        errno = handler._invoke(argv, last, logger=logger, debug=debug, \
+            lineno=lineno, settings=settings, scan=scan)
+    finally:
+        stdout.redirect(None)
+        stderr.redirect(None)
+        records.capture(None)
+    return errno, out.getvalue(), err.getvalue(), logged
+
+
+def _init_process(handler, last, logger, debug, settings, scan):
+    global _worker
+    records = LineRecords()
+    logger.addFilter(records)
+    _worker = (handler, last, logger, debug, settings, scan, records)
+
+
+def _run_process(argv, lineno):
+    handler, last, logger, debug, settings, scan, records = _worker
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+    logged = []
+    records.capture(logged)
+    try:
+        errno = handler._invoke(argv, last, logger=logger, debug=debug, \
+            lineno=lineno, settings=settings, scan=scan)
+        return errno, sys.stdout.getvalue(), sys.stderr.getvalue(), \
+            [_portable(x) for x in logged]
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        records.capture(None)
+
+
+def _done(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+def run_parallel(handler, stream, *, workers=None, pool='thread', \
+        max_inflight=None, stop_on_error=False, prog=None, logger=None, \
+        debug=False, settings=None, last=None):
+    """Dispatch each shell-quoted line of stream on a pool of workers, each
+    one chaining last, inherited by the processes of a process pool.
+
+    Output of each line, and the records it logged to logger, are collected
+    and written in input order, at most max_inflight lines are submitted
+    but not yet written.
+    Return the list of exit codes, one per dispatched line.
+    """
+    if logger is None:
+        logger = _logger
+    if prog is None:
+        prog = sys.argv[0] if sys.argv else ''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_inflight is None:
+        max_inflight = workers * 2
+    if workers < 1 or max_inflight < 1:
+        raise ValueError('workers and max_inflight should be positive')
+    # Build every spec once, before workers are started
+    handler.build_opts()
+    # Directory listings shared by the lines, per process for a process pool
+    from .pathset import ScanCache
+    scan = ScanCache()
+
+    stdout, stderr = sys.stdout, sys.stderr
+    records = LineRecords()
+    if pool == 'thread':
+        sys.stdout, sys.stderr = ThreadStream(stdout), ThreadStream(stderr)
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+        submit = lambda argv, lineno: executor.submit(_capture, handler, \
+            argv, lineno, last, logger, debug, settings, scan, sys.stdout, \
+            sys.stderr, records)
+    elif pool == 'process':
+        executor = concurrent.futures.ProcessPoolExecutor(workers, \
+            mp_context=multiprocessing.get_context('fork'), \
+            initializer=_init_process, initargs=(handler, last, logger, \
+                debug, settings, scan))
+        submit = lambda argv, lineno: executor.submit(_run_process, argv, lineno)
+    else:
+        raise ValueError('Unknown pool "{}"'.format(pool))
+
+    errnos = []
+    pending = collections.deque()
+    def emit():
+        errno, out, err, logged = pending.popleft().result()
+        stdout.write(out)
+        stderr.write(err)
+        for i in logged:
+            logger.handle(i)
+        errnos.append(errno)
+        return errno and stop_on_error
+    logger.addFilter(records)
+    try:
+        for lineno, line in enumerate(stream, 1):
+            try:
+                argv = shlex.split(line, comments=True)
+            except ValueError as ex:
+                logged = []
+                records.capture(logged)
+                try:
+                    logger.error('line {}: {}'.format(lineno, ex))
+                finally:
+                    records.capture(None)
+                pending.append(_done((127, '', '', logged)))
+            else:
+                if not argv:
+                    continue
+                pending.append(submit([prog] + argv, lineno))
+            if len(pending) >= max_inflight and emit():
+                break
+        else:
+            while pending and not emit():
+                pass
+    finally:
+        for i in pending:
+            i.cancel()
+        executor.shutdown()
+        logger.removeFilter(records)
+        sys.stdout, sys.stderr = stdout, stderr
+    stdout.flush()
+    return errnos
+
+
+def _init_map(func, prefix, kwargs):
+    global _worker
+    _worker = (func, prefix, kwargs)
+
+
+def _run_map(chunk):
+    func, prefix, kwargs = _worker
+    return func(*prefix, *chunk, **kwargs)
+
+
+def map_chunks(func, prefix, operands, kwargs, *, pool='thread', workers=None, \
+        chunksize=None):
+    """Call func(*prefix, *chunk, **kwargs) for each chunk of operands on a
+    pool of workers.
+
+    func should return an iterable of results for the operands of its chunk,
+    or None. Results are concatenated in operand order, None if every chunk
+    returned None.
+    operands could be a lazy iterator, chunks are then read as workers
+    become available, of chunksize operands or LAZY_CHUNKSIZE by default.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if isinstance(operands, (list, tuple)):
+        if not operands:
+            return func(*prefix, **kwargs)
+        if chunksize is None:
+            chunksize = max(1, -(-len(operands) // (workers * 4)))
+        chunks = iter([operands[i:i+chunksize] \
+            for i in range(0, len(operands), chunksize)])
+    else:
+        if chunksize is None:
+            chunksize = LAZY_CHUNKSIZE
+        operands = iter(operands)
+        chunks = iter(lambda: list(itertools.islice(operands, chunksize)), [])
+    first = next(chunks, None)
+    if first is None:
+        return func(*prefix, **kwargs)
+    if pool == 'thread':
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+        submit = lambda x: executor.submit(lambda: func(*prefix, *x, **kwargs))
+    elif pool == 'process':
+        # Fork the pool with func, prefix and kwargs, only chunks are pickled
+        executor = concurrent.futures.ProcessPoolExecutor(workers, \
+            mp_context=multiprocessing.get_context('fork'), \
+            initializer=_init_map, initargs=(func, prefix, kwargs))
+        submit = lambda x: executor.submit(_run_map, x)
+    else:
+        raise ValueError('Unknown pool "{}"'.format(pool))
+    results = []
+    with executor:
+        # Bounded number of chunks in flight, in order
+        pending = collections.deque([submit(first)])
+        for chunk in chunks:
+            if len(pending) >= workers * 2:
+                results.append(pending.popleft().result())
+            pending.append(submit(chunk))
+        while pending:
+            results.append(pending.popleft().result())
+    if all(x is None for x in results):
+        return None
+    return [y for x in results if x is not None for y in x]
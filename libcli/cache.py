@@ -0,0 +1,362 @@
+"""Memoise results of pure commands, in memory or on disk.
+
+    from libcli.cache import LRU, DiskCache
+
+    @command(_cache=LRU(maxsize=64, ttl=300))
+    def report(last, *, month=None):
+        ...
+
+    @command(_cache=DiskCache('.cache'), _inputs=['src'], _outputs=['dst'])
+    def compress(src, dst, *, level=3):
+        ...
+"""
+import collections
+import hashlib
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+CacheInfo = collections.namedtuple('CacheInfo', \
+    'hits misses maxsize currsize bytes')
+
+
+def estimate_size(obj, seen=None):
+    """Estimated memory size of obj and the objects it contains."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, (str, bytes, bytearray, int, float)):
+        return size
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += estimate_size(k, seen) + estimate_size(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        for i in obj:
+            size += estimate_size(i, seen)
+    elif hasattr(obj, '__dict__'):
+        size += estimate_size(vars(obj), seen)
+    return size
+
+
+def freeze(value):
+    """Hashable equivalent of a converted argument value."""
+    if isinstance(value, list):
+        return ('list', tuple(freeze(x) for x in value))
+    elif isinstance(value, dict):
+        return ('dict', tuple(sorted((k, freeze(v)) for k, v in value.items())))
+    return value
+
+
+class LRU():
+    """Least recently used cache of command results.
+
+    Entries are evicted beyond maxsize entries or maxbytes estimated bytes,
+    and expire ttl seconds after they are stored.
+    The chained object is part of the key by identity, and is kept alive
+    by the entry so that its identity is not reused.
+    Exceptions are never cached.
+    """
+    def __init__(self, maxsize=128, *, ttl=None, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = estimate_size if sizeof is None else sizeof
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        # key -> (value, expires, size, last)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, args, kwargs, chained=False):
+        if chained:
+            return (id(args[0]), tuple(freeze(x) for x in args[1:]), \
+                tuple(sorted((k, freeze(v)) for k, v in kwargs.items())))
+        return (None, tuple(freeze(x) for x in args), \
+            tuple(sorted((k, freeze(v)) for k, v in kwargs.items())))
+
+    def get(self, key):
+        """Return whether key is cached and its value."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None \
+                and entry[1] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, value, last=None):
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires, size, last)
+            self.bytes += size
+            while self._entries and (self.maxsize is not None and \
+                    len(self._entries) > self.maxsize or \
+                    self.maxbytes is not None and self.bytes > self.maxbytes):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry[2]
+
+    def invoke(self, func, args, kwargs, chained=False, command=None):
+        """Return the cached result of func(*args, **kwargs), call it on a miss.
+        args[0] is the chained object if chained.
+        """
+        try:
+            key = self.key(args, kwargs, chained)
+            hash(key)
+        except TypeError: # Unhashable argument
+            return func(*args, **kwargs)
+        hit, value = self.get(key)
+        if hit:
+            return value
+        value = func(*args, **kwargs)
+        self.put(key, value, args[0] if chained else None)
+        return value
+
+    def invalidate(self, *args, **kwargs):
+        """Drop the entry of the call with args and kwargs,
+        args[0] is the chained object if any.
+        """
+        keys = [self.key(args, kwargs)]
+        if args:
+            keys.append(self.key(args, kwargs, True))
+        with self._lock:
+            for key in keys:
+                try:
+                    if key in self._entries:
+                        self._remove(key)
+                except TypeError: # Unhashable argument, never cached
+                    pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, \
+                len(self._entries), self.bytes)
+
+
+def bind(command, args, kwargs):
+    """Map argument names of command to their values."""
+    fas = command.argspec
+    bound = dict(zip(fas.args, args))
+    if fas.varargs is not None:
+        bound[fas.varargs] = list(args[len(fas.args):])
+    bound.update(kwargs)
+    return bound
+
+
+def paths(bound, names):
+    ret = []
+    for i in names:
+        value = bound.get(i)
+        if isinstance(value, (list, tuple)):
+            ret.extend(value)
+        elif value is not None:
+            ret.append(value)
+    return [os.fspath(x) for x in ret]
+
+
+def fingerprint(path, content=True):
+    """Fingerprint of a file, its digest or its size and modification time.
+    None if it does not exist."""
+    try:
+        if not content:
+            st = os.stat(path)
+            return 'stat:{}:{}'.format(st.st_size, st.st_mtime_ns)
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return 'sha256:' + digest.hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def copy_atomic(src, dst):
+    """Copy src to dst through a temporary file renamed in place."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)), \
+        prefix='.' + os.path.basename(dst) + '.')
+    try:
+        with open(fd, 'wb') as f, open(src, 'rb') as fsrc:
+            shutil.copyfileobj(fsrc, f)
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class DiskCache():
+    """Cache of command results in a directory, which several processes
+    could share.
+
+    An entry is addressed by the digest of the command, its converted
+    arguments, the chained object pickled if any, and the fingerprints of
+    its input files, declared by _inputs of the command. Files declared by
+    _outputs are stored along the pickled result. On a hit the command is
+    skipped, outputs changed or missing since are restored.
+
+    Fingerprints are digests of contents, or size and modification time
+    with content=False. Entries are written to a temporary directory
+    renamed in place. Least recently used entries are evicted beyond
+    maxbytes, under a lock on the directory.
+    """
+    def __init__(self, path, *, maxbytes=None, content=True):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.content = content
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, command, args, kwargs, chained):
+        bound = bind(command, args, kwargs)
+        if chained:
+            # Under a fixed name, the chained object fills the first argument
+            # or the first of *args. Unpicklable ones are not cached.
+            fas = command.argspec
+            if fas.args:
+                del bound[fas.args[0]]
+            else:
+                bound[fas.varargs] = bound[fas.varargs][1:]
+            bound['<last>'] = hashlib.sha256(pickle.dumps(args[0])).hexdigest()
+        inputs = paths(bound, command.inputs)
+        material = repr((command.name, command._func.__module__, \
+            command._func.__qualname__, sorted(bound.items()), \
+            [(x, fingerprint(x, self.content)) for x in inputs]))
+        return hashlib.sha256(material.encode('utf-8')).hexdigest(), \
+            paths(bound, command.outputs)
+
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def invoke(self, func, args, kwargs, chained=False, command=None):
+        try:
+            key, outputs = self.key(command, args, kwargs, chained)
+        except (TypeError, AttributeError, pickle.PicklingError):
+            return func(*args, **kwargs)
+        hit, value = self.load(key, outputs)
+        if hit:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = func(*args, **kwargs)
+        self.store(key, value, outputs)
+        return value
+
+    def load(self, key, outputs):
+        entry = self.entry(key)
+        try:
+            with open(os.path.join(entry, 'result.pickle'), 'rb') as f:
+                value, recorded = pickle.load(f)
+            if recorded != outputs:
+                return False, None
+            for i, path in enumerate(outputs):
+                stored = os.path.join(entry, 'output{}'.format(i))
+                if fingerprint(path, True) != fingerprint(stored, True):
+                    copy_atomic(stored, path)
+            os.utime(entry)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # Missing, evicted meanwhile or partially restored
+            return False, None
+        return True, value
+
+    def store(self, key, value, outputs):
+        try:
+            data = pickle.dumps((value, outputs))
+        except (TypeError, AttributeError, pickle.PicklingError):
+            return
+        entry = self.entry(key)
+        try:
+            # Created on the first store, not when the command is declared
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmp = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix='.tmp-')
+        except OSError:
+            return
+        try:
+            for i, path in enumerate(outputs):
+                shutil.copyfile(path, os.path.join(tmp, 'output{}'.format(i)))
+            with open(os.path.join(tmp, 'result.pickle'), 'wb') as f:
+                f.write(data)
+            try:
+                os.rename(tmp, entry)
+            except OSError: # Stored by another process meanwhile
+                pass
+        except OSError:
+            pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        if self.maxbytes is not None:
+            self.evict()
+
+    def entries(self):
+        """List of (atime, bytes, path) of the entries."""
+        ret = []
+        try:
+            roots = list(os.scandir(self.path))
+        except FileNotFoundError: # Nothing stored yet
+            return ret
+        for i in roots:
+            if not i.is_dir() or i.name.startswith('.'):
+                continue
+            for entry in os.scandir(i.path):
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    size = sum(x.stat().st_size for x in os.scandir(entry.path))
+                    ret.append((entry.stat().st_mtime, size, entry.path))
+                except OSError: # Evicted meanwhile
+                    pass
+        return ret
+
+    def evict(self):
+        import fcntl
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self.entries())
+            total = sum(x[1] for x in entries)
+            for mtime, size, path in entries:
+                if total <= self.maxbytes:
+                    break
+                self.remove(path)
+                total -= size
+
+    def remove(self, path):
+        # Rename first so that readers never see a partial entry
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.del-')
+        try:
+            os.rename(path, os.path.join(tmp, 'entry'))
+        except OSError:
+            pass
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    def clear(self):
+        for i in self.entries():
+            self.remove(i[2])
+
+    def info(self):
+        entries = self.entries()
+        return CacheInfo(self.hits, self.misses, None, len(entries), \
+            sum(x[1] for x in entries))
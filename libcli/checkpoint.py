@@ -0,0 +1,88 @@
+"""Checkpoint the cursor of a chain and the chained object, to resume it."""
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+from .opttools import OptionError
+
+_logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+class Checkpoint():
+    """Persist the index of the next command and the chained object to path
+    after every "every" completed commands of the chain argv.
+
+    The chain should be resumed with the same argv, which is checked by
+    digest. The file is removed once the chain completes. Failures to write
+    it are logged, the chain goes on.
+    """
+    def __init__(self, path, argv, *, every=1, logger=None):
+        self.path = path
+        self.every = every
+        self.logger = _logger if logger is None else logger
+        self.digest = hashlib.sha256('\0'.join(argv).encode('utf-8', \
+            'surrogateescape')).hexdigest()
+        self.count = 0
+        self.warned = False
+
+    def save(self, index, last):
+        self.count += 1
+        if self.count % self.every:
+            return
+        try:
+            data = pickle.dumps({'version': VERSION, 'argv': self.digest, \
+                'index': index, 'last': last}, pickle.HIGHEST_PROTOCOL)
+        except (TypeError, AttributeError, pickle.PicklingError) as ex:
+            # Stream stages and other unpicklable objects are skipped
+            if not self.warned:
+                self.logger.warning('Checkpoint skipped: {}'.format(ex))
+                self.warned = True
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname( \
+                os.path.abspath(self.path)), prefix='.checkpoint-')
+        except OSError as ex:
+            self.logger.error('Failed to write checkpoint: {}'.format(ex))
+            return
+        try:
+            with open(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException as ex:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            if not isinstance(ex, OSError):
+                raise
+            self.logger.error('Failed to write checkpoint: {}'.format(ex))
+
+    def load(self):
+        """Return the index of the next command and the chained object,
+        None if no checkpoint was saved.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError) as ex:
+            raise OptionError('Failed to read checkpoint: "{}"'.format(ex))
+        if not isinstance(state, dict) or state.get('version') != VERSION:
+            raise OptionError('Unsupported checkpoint "{}"'.format(self.path))
+        if state['argv'] != self.digest:
+            raise OptionError('Checkpoint "{}" was saved for another command '\
+                'line'.format(self.path))
+        return state['index'], state['last']
+
+    def done(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
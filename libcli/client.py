@@ -0,0 +1,41 @@
+"""Thin client of libcli.server, without importing the served application.
+
+    $ python -m libcli.client /run/tool.sock tool cmd --option value
+"""
+import os
+import socket
+import sys
+
+from .server import PROTOCOL_VERSION, EXIT_PROTOCOL, send_message, \
+    recv_message
+
+
+def call(path, argv, *, env=None, cwd=None, stdio=(0, 1, 2), timeout=None):
+    """Run argv on the server listening on path, return the exit code."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        send_message(sock, {
+            'version': PROTOCOL_VERSION,
+            'argv': list(argv),
+            'env': dict(os.environ if env is None else env),
+            'cwd': os.getcwd() if cwd is None else cwd,
+            }, fds=stdio)
+        response, fds = recv_message(sock)
+    if 'error' in response:
+        print('{}: {}'.format(path, response['error']), file=sys.stderr)
+    return response.get('status', EXIT_PROTOCOL)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    if len(argv) < 3:
+        print('usage: {} SOCKET PROG [ARG]...'.format(argv[0]), file=sys.stderr)
+        return 2
+    sys.stdout.flush()
+    return call(argv[1], argv[2:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
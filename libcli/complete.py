@@ -0,0 +1,224 @@
+"""Complete command lines in bash and zsh from a static index, without
+starting Python.
+
+    $ eval "$(./tool.py --libcli-completion bash)"
+
+The index lists commands and their options, tab separated, one per line:
+
+    c   NAME
+    o   COMMAND OPTION HAS_ARG KIND
+
+COMMAND is empty for the default command and "@" for --libcli-* options.
+HAS_ARG is 0, 1 or 2 for no, a required or an optional value. KIND is how
+a value is completed, "files", "words:WORD..." from an enumerable type,
+"dynamic" from a completer called through a server, or "-".
+"""
+import os
+import re
+import sys
+
+INDEX_VERSION = 1
+SHELLS = ('bash', 'zsh')
+
+# Values of --libcli-* options
+GLOBAL_KINDS = {
+    'batch': 'files',
+    'pool': 'words:thread process',
+    'serve': 'files',
+    'serve-mode': 'words:prefork fork',
+    'history': 'files',
+    'checkpoint': 'files',
+    'output': 'words:ndjson json msgpack',
+    'profile': 'files',
+    'profile-pstats': 'files',
+    'metrics': 'files',
+    'metrics-socket': 'files',
+    'memprofile': 'files',
+    'completion': 'words:' + ' '.join(SHELLS),
+    'completion-socket': 'files',
+    }
+
+FILE_TYPES = {'path', 'file', 'mmap', 'glob'}
+
+# Find the command and the option before the last word, print "words" and
+# the candidates, "files", "dynamic" with the command and the option, or
+# "none". Arguments are the index and the words after the program name.
+AWK = r'''
+function value(key, cur,    k, v, m, i, p) {
+    k = kind[key]
+    if (k == "files") {
+        print "files"
+    } else if (k == "dynamic") {
+        split(key, p, SUBSEP)
+        print "dynamic"; print p[1]; print p[2]
+    } else if (k ~ /^words:/) {
+        print "words"
+        m = split(substr(k, 7), v, " ")
+        for (i = 1; i <= m; i++)
+            if (index(v[i], cur) == 1) print v[i]
+    } else {
+        print "none"
+    }
+}
+function options(c, cur,    o, m, i) {
+    m = split(olist[c], o, "\t")
+    for (i = 2; i <= m; i++)
+        if (index(o[i], cur) == 1) print o[i]
+}
+BEGIN {
+    FS = "\t"
+    n = ARGC - 2
+    for (i = 2; i < ARGC; i++) {
+        w[i - 1] = ARGV[i]
+        delete ARGV[i]
+    }
+    ARGC = 2
+}
+$1 == "c" { cmds[$2] = 1; clist[++nc] = $2; next }
+$1 == "o" { arg[$2, $3] = $4; kind[$2, $3] = $5; olist[$2] = olist[$2] "\t" $3 }
+END {
+    cmd = ""; expect = ""; start = 1
+    for (i = 1; i < n; i++) {
+        x = w[i]
+        if (expect != "") { expect = ""; continue }
+        if (start && x ~ /^--libcli-/) {
+            name = x; sub(/=.*/, "", name)
+            if (x !~ /=/ && arg["@", name] == 1) expect = "@" SUBSEP name
+            continue
+        }
+        start = 0
+        if (x in cmds) {
+            cmd = x
+        } else if (x ~ /^--./) {
+            name = x; sub(/=.*/, "", name)
+            if (x !~ /=/ && arg[cmd, name] == 1) expect = cmd SUBSEP name
+        } else if (x ~ /^-./) {
+            for (j = 2; j <= length(x); j++) {
+                name = "-" substr(x, j, 1)
+                if (arg[cmd, name] == 1 && j == length(x)) expect = cmd SUBSEP name
+                if (arg[cmd, name] == 1 || arg[cmd, name] == 2) break
+            }
+        }
+    }
+    cur = n ? w[n] : ""
+    if (expect != "") { value(expect, cur); exit }
+    print "words"
+    if (cur ~ /^-/) {
+        if (start) options("@", cur)
+        options(cmd, cur)
+    } else {
+        for (i = 1; i <= nc; i++)
+            if (index(clist[i], cur) == 1) print clist[i]
+    }
+}
+'''
+
+BASH = r'''# bash completion for {prog}, generated by libcli
+_libcli_awk_{id}='{awk}'
+_libcli_{id}() {{
+    local index={index} socket={socket} f
+    local line=${{COMP_LINE:0:COMP_POINT}} cur
+    local -a words out
+    [[ -r $index ]] || return 1
+    while IFS= read -r f; do
+        if [[ $f -nt $index ]]; then
+            {python} {script} --libcli-completion bash >/dev/null 2>&1
+            break
+        fi
+    done 2>/dev/null < {sources}
+    read -ra words <<< "$line"
+    [[ $line == *[[:space:]] || ${{#words[@]}} -eq 0 ]] && words+=("")
+    cur=${{words[${{#words[@]}}-1]}}
+    mapfile -t out < <(awk "$_libcli_awk_{id}" "$index" "${{words[@]:1}}")
+    case ${{out[0]}} in
+    words) COMPREPLY=("${{out[@]:1}}") ;;
+    files) mapfile -t COMPREPLY < <(compgen -f -- "$cur") ;;
+    dynamic)
+        [[ -S $socket ]] && mapfile -t COMPREPLY < <(PYTHONPATH={path} \
+            {python} -m libcli.client "$socket" {prog} --libcli-complete \
+            "${{out[1]}}" "${{out[2]}}" "$cur")
+        ;;
+    esac
+    return 0
+}}
+complete -o default -F _libcli_{id} {prog}
+'''
+
+ZSH = r'''#compdef {prog}
+# zsh completion for {prog}, generated by libcli
+_libcli_awk_{id}='{awk}'
+_libcli_{id}() {{
+    local index={index} socket={socket} f
+    local -a out
+    [[ -r $index ]] || return 1
+    while IFS= read -r f; do
+        if [[ $f -nt $index ]]; then
+            {python} {script} --libcli-completion zsh >/dev/null 2>&1
+            break
+        fi
+    done 2>/dev/null < {sources}
+    out=("${{(@f)$(awk "$_libcli_awk_{id}" "$index" "${{(@)words[2,CURRENT]}}")}}")
+    case $out[1] in
+    words) (( $#out > 1 )) && compadd -- "${{(@)out[2,-1]}}" ;;
+    files) _files ;;
+    dynamic)
+        [[ -S $socket ]] && compadd -- "${{(@f)$(PYTHONPATH={path} \
+            {python} -m libcli.client "$socket" {prog} --libcli-complete \
+            "$out[2]" "$out[3]" "$words[CURRENT]")}}"
+        ;;
+    esac
+}}
+compdef _libcli_{id} {prog}
+'''
+
+
+def quote(value):
+    """Single quoted shell word."""
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def kind(option):
+    if option['complete']:
+        return 'dynamic'
+    elif FILE_TYPES.intersection(option['type']):
+        return 'files'
+    elif option['type'] == ['bool']:
+        return 'words:true false'
+    return '-'
+
+
+def index_lines(spec):
+    from .opttools import GLOBAL_OPTIONS
+    yield 'libcli-index\t{}'.format(INDEX_VERSION)
+    for name in spec['commands']:
+        if name:
+            yield 'c\t{}'.format(name)
+    for name in sorted(GLOBAL_OPTIONS):
+        yield 'o\t@\t--libcli-{}\t{}\t{}'.format(name, \
+            int(GLOBAL_OPTIONS[name]), GLOBAL_KINDS.get(name, '-'))
+    for name, command in spec['commands'].items():
+        for option in command['options'].values():
+            for alias, has_arg in option['alias'].items():
+                if has_arg is not None:
+                    yield 'o\t{}\t{}\t{}\t{}'.format(name, alias, has_arg, \
+                        kind(option))
+
+
+def write_index(spec, path):
+    from .spec import write_atomic
+    write_atomic(path, ''.join(x + '\n' for x in index_lines(spec)))
+
+
+def script(shell, prog, directory, socket=None):
+    """Completion script of shell for the tool run as prog, reading the
+    index in directory, with dynamic values from the server on socket.
+    """
+    template = {'bash': BASH, 'zsh': ZSH}[shell]
+    name = os.path.basename(prog)
+    return template.format(prog=quote(name), id=re.sub(r'\W', '_', name), \
+        awk=AWK, index=quote(os.path.join(directory, 'complete.idx')), \
+        sources=quote(os.path.join(directory, 'sources.txt')), \
+        script=quote(os.path.abspath(prog)), \
+        socket=quote('' if socket is None else os.path.abspath(socket)), \
+        python=quote(sys.executable), path=quote(os.path.dirname( \
+            os.path.dirname(os.path.abspath(__file__)))))
@@ -0,0 +1,107 @@
+"""Option defaults from environment variables and configuration files."""
+import os
+import threading
+
+from .opttools import OptionError
+
+# path -> (mtime_ns, size, sections), parsed files kept for the process
+_cache = {}
+_lock = threading.Lock()
+
+
+def _parse(path):
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, 'rb') as f:
+        data = f.read()
+    if ext == '.json':
+        import json
+        return json.loads(data.decode('utf-8'))
+    elif ext == '.toml':
+        try:
+            import tomllib
+        except ImportError: # Python < 3.11
+            import tomli as tomllib
+        return tomllib.loads(data.decode('utf-8'))
+    import configparser
+    parser = configparser.ConfigParser(interpolation=None)
+    try:
+        parser.read_string(data.decode('utf-8'), path)
+    except configparser.Error as ex:
+        raise ValueError(ex)
+    sections = dict(parser.defaults())
+    for i in parser.sections():
+        sections[i] = dict(parser.items(i))
+    return sections
+
+
+def load(path):
+    """Parsed configuration file, cached by path and modification time.
+
+    A mapping of command names to mappings of option names to values,
+    values of other names apply to every command. INI files are read by
+    configparser, with DEFAULT applying to every command, .json and .toml
+    files by json and tomllib. A missing file is empty.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    except OSError as ex:
+        raise OptionError('Failed to read config: "{}"'.format(ex))
+    key = os.path.abspath(path)
+    with _lock:
+        cached = _cache.get(key)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    try:
+        sections = _parse(path)
+    except ImportError as ex:
+        raise OptionError('Failed to read config "{}": {}'.format(path, ex))
+    except (OSError, ValueError) as ex:
+        # configparser, json and tomllib errors are ValueError
+        raise OptionError('Failed to read config "{}": {}'.format(path, ex))
+    if not isinstance(sections, dict):
+        raise OptionError('Config "{}" should be a mapping'.format(path))
+    with _lock:
+        _cache[key] = (st.st_mtime_ns, st.st_size, sections)
+    return sections
+
+
+def format_config(value):
+    """Command line form of a value from a configuration file."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, (list, tuple)):
+        return ','.join(format_config(x) for x in value)
+    elif isinstance(value, dict):
+        return ','.join('{}={}'.format(k, format_config(v)) \
+            for k, v in value.items())
+    return str(value)
+
+
+class Defaults():
+    """Values of options missing from argv, from the environment variables
+    PREFIX + COMMAND + "_" + NAME or PREFIX + NAME, then from the section of
+    the command or the top level of the configuration file.
+    """
+    def __init__(self, env_prefix=None, config=None):
+        self.env_prefix = env_prefix
+        self.config = None if config is None else os.path.expanduser(config)
+
+    def lookup(self, command, name):
+        """Value of option name of command as a string, None if not set."""
+        if self.env_prefix is not None:
+            for i in (command + '_' + name, name):
+                value = os.environ.get((self.env_prefix + i).upper().\
+                    replace('-', '_'))
+                if value is not None:
+                    return value
+        if self.config is not None:
+            sections = load(self.config)
+            section = sections.get(command)
+            if isinstance(section, dict) and name in section:
+                return format_config(section[name])
+            value = sections.get(name)
+            if value is not None and not isinstance(value, dict):
+                return format_config(value)
+        return None
@@ -79,7 +79,7 @@ PERMUTE = opt_ordering.PERMUTE
 RETURN_IN_ORDER = opt_ordering.RETURN_IN_ORDER
 
 class GetoptIter():
-    def __init__(self, argv, optstring, longopts, longind, long_only):
+    def __init__(self, argv, optstring, longopts, longind, long_only, optind=1):
         self.argv = argv
         self.optstring = optstring
         self.longopts = longopts
@@ -87,11 +87,16 @@ class GetoptIter():
         self.long_only = long_only
         self.opterr = 1
         self.optopt = '?'
-        self.optind = 1
+        # Scanning may start in the middle of a shared argv,
+        # argv[optind-1] plays the role of the program name.
+        self.progname = argv[optind-1]
+        self.optind = optind
         self.optarg = None
-        self.first_nonopt = 1
-        self.last_nonopt = 1
+        self.first_nonopt = optind
+        self.last_nonopt = optind
         self.nextchar = None
+        # Whether "--" ended the options
+        self.dashdash = False
         if 'POSIXLY_CORRECT' in os.environ:
             self.posixly_correct = os.environ['POSIXLY_CORRECT']
         else:
@@ -129,6 +134,7 @@ class GetoptIter():
 
             if self.optind != len(self.argv) and self.argv[self.optind] == '--':
                 self.optind += 1
+                self.dashdash = True
 
                 if self.first_nonopt != self.last_nonopt \
                     and self.last_nonopt != self.optind:
@@ -185,7 +191,7 @@ class GetoptIter():
             if ambig and not exact:
                 if self.opterr:
                     logger.error(_("{}: option {} is ambiguous").\
-                        format(self.argv[0], self.argv[self.optind]))
+                        format(self.progname, self.argv[self.optind]))
                 self.nextchar = None
                 self.optind += 1
                 return '?'
@@ -199,9 +205,9 @@ class GetoptIter():
                     else:
                         if self.opterr:
                             if len(self.argv[self.optind-1]) > 1 and self.argv[self.optind-1][1] == '-':
-                                logger.error(_("{}: option `--{}' doesn't allow and argument").format(self.argv[0], pfound.name))
+                                logger.error(_("{}: option `--{}' doesn't allow and argument").format(self.progname, pfound.name))
                             else:
-                                logger.error(_("{}: option `{}{}' doesn't allow and argument").format(self.argv[0], self.argv[self.optind-1][0], pfound.name))
+                                logger.error(_("{}: option `{}{}' doesn't allow and argument").format(self.progname, self.argv[self.optind-1][0], pfound.name))
                         self.nextchar = None
                         return '?'
                 elif pfound.has_arg == required_argument:
@@ -210,7 +216,7 @@ class GetoptIter():
                         self.optind += 1
                     else:
                         if self.opterr:
-                            logger.error(_("{}: option `{}' requires an argument").format(self.argv[0], self.argv[self.optind-1]))
+                            logger.error(_("{}: option `{}' requires an argument").format(self.progname, self.argv[self.optind-1]))
                         self.nextchar = None
                         return ':' if len(self.optstring) > 0 and self.optstring[0] == ':' else '?'
                 self.nextchar = None
@@ -231,10 +237,10 @@ class GetoptIter():
                         and len(self.argv[self.optind]) > 1 \
                             and self.argv[self.optind][1] == '-':
                         logger.error(_("{}: unrecognized option `--{}'").\
-                            format(self.argv[0], self.nextchar))
+                            format(self.progname, self.nextchar))
                     elif len(self.argv) > self.optind:
                         logger.error(_("{}: unrecognized option `{}{}'").\
-                            format(self.argv[0], self.argv[self.optind][0], \
+                            format(self.progname, self.argv[self.optind][0], \
                                 self.nextchar))
                 self.nextchar = None
                 self.optind += 1
@@ -250,9 +256,9 @@ class GetoptIter():
         if temp is None or c == ':':
             if self.opterr:
                 if self.posixly_correct is not None:
-                    logger.error(_("{}: illegal option -- {}").format(self.argv[0], c))
+                    logger.error(_("{}: illegal option -- {}").format(self.progname, c))
                 else:
-                    logger.error(_("{}: invalid option -- {}").format(self.argv[0], c))
+                    logger.error(_("{}: invalid option -- {}").format(self.progname, c))
             self.optopt = c
             return '?'
         if len(temp) > 1 and temp[1] == ':':
@@ -272,7 +278,7 @@ class GetoptIter():
                 elif self.optind == len(self.argv):
                     if self.opterr:
                         logger.error(_("{}: option requires an argument -- {}")\
-                            .format(self.argv[0], c))
+                            .format(self.progname, c))
                     self.optopt = c
                     if self.optstring[0] == ':':
                         c = ':'
@@ -307,14 +313,14 @@ class GetoptIter():
         self.last_nonopt = self.optind
 
 
-def iter_getopt(argv, shortopts):
+def iter_getopt(argv, shortopts, *, optind=1):
     return GetoptIter(argv, optstring=shortopts, longopts=None, \
-        longind=None, long_only=None)
+        longind=None, long_only=None, optind=optind)
 
-def iter_getopt_long(argv, shortopts, longopts):
+def iter_getopt_long(argv, shortopts, longopts, *, optind=1):
     return GetoptIter(argv, optstring=shortopts, longopts=longopts, \
-        longind=None, long_only=None)
+        longind=None, long_only=None, optind=optind)
 
-def iter_getopt_long_only(argv, shortopts, longopts):
+def iter_getopt_long_only(argv, shortopts, longopts, *, optind=1):
     return GetoptIter(argv, optstring=shortopts, longopts=longopts, \
-        longind=None, long_only=True)
+        longind=None, long_only=True, optind=optind)
@@ -0,0 +1,331 @@
+"""Count commands, errors and phase latencies, export them in the Prometheus
+text format.
+
+    metrics = Metrics(handler)
+    handler.tracers.append(metrics)
+    ...
+    metrics.snapshot().latency['report', 'call'].quantile(0.99)
+"""
+import bisect
+import collections
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import weakref
+
+_logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets in seconds, beyond them is +Inf
+BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, \
+    .25, .5, 1, 2.5, 5, 10)
+
+Snapshot = collections.namedtuple('Snapshot', 'calls errors latency caches')
+
+
+class Histogram(collections.namedtuple('Histogram', 'buckets counts sum')):
+    """Latencies counted per bucket, counts has a last bucket for +Inf,
+    sum is in seconds.
+    """
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """Upper bound of the bucket of quantile q, inf for the last one."""
+        rank = q * self.count
+        total = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            if total >= rank and total:
+                return bound
+        return None
+
+
+class _Shard():
+    """Metrics of one thread, written by that thread only."""
+    def __init__(self, thread=None):
+        self.calls = {}
+        self.errors = {}
+        # (command, phase) -> [count of each bucket..., +Inf, sum in ns]
+        self.latency = {}
+        # (command, start) of the open spans
+        self.stack = []
+        self.thread = None if thread is None else weakref.ref(thread)
+
+    def dead(self):
+        thread = self.thread()
+        return thread is None or not thread.is_alive()
+
+    def fold(self, shard):
+        """Add the counts of shard, of a thread which no longer writes."""
+        for key, n in shard.calls.items():
+            self.calls[key] = self.calls.get(key, 0) + n
+        for key, n in shard.errors.items():
+            self.errors[key] = self.errors.get(key, 0) + n
+        for key, counts in shard.latency.items():
+            if key in self.latency:
+                counts = [x + y for x, y in zip(self.latency[key], counts)]
+            self.latency[key] = list(counts)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').\
+        replace('\n', '\\n')
+
+
+class Metrics():
+    """Tracer counting calls and errors of each command, with a histogram
+    of the latency of each command, phase "total", and of its phases.
+
+    Each thread records to its own shard without locking, shards are merged
+    by snapshot. Errors are counted by the exit code mapped by the error
+    handlers of handler. With path set, the Prometheus text format is
+    written to path on close, and when a top level command completes
+    interval seconds after the last write. A forked process starts from
+    empty metrics written to path suffixed by its pid.
+    """
+    interval = 10.0
+    poll_interval = 0.2
+
+    def __init__(self, handler=None, *, path=None, buckets=BUCKETS):
+        self.handler = handler
+        self.path = path
+        self.buckets = tuple(buckets)
+        self._bounds = [round(x * 1e9) for x in self.buckets]
+        self._lock = threading.Lock()
+        self.sock = None
+        self.sockpath = None
+        self._owner = os.getpid()
+        self._reset()
+        _instances.add(self)
+
+    def _reset(self):
+        self._local = threading.local()
+        self._shards = []
+        # Counts of the threads which ended
+        self._retired = _Shard()
+        self.last_write = time.monotonic()
+
+    def _retire(self):
+        """Fold the shards of the threads which ended, called with the lock
+        held, so that pools creating threads do not grow the shards.
+        """
+        live = []
+        for shard in self._shards:
+            if shard.dead():
+                self._retired.fold(shard)
+            else:
+                live.append(shard)
+        self._shards = live
+
+    def _forked(self):
+        self._lock = threading.Lock()
+        self._reset()
+        if self.sock is not None:
+            # The serving thread is not inherited
+            self.sock.close()
+            self.sock = None
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._retire()
+                self._shards.append(shard)
+            return shard
+
+    def enter(self, name, cat):
+        stack = self._shard().stack
+        if cat == 'command':
+            stack.append((name, time.perf_counter_ns()))
+        else:
+            stack.append((stack[-1][0] if stack else '', \
+                time.perf_counter_ns()))
+
+    def exit(self, name, cat, exc=None):
+        end = time.perf_counter_ns()
+        shard = self._shard()
+        if not shard.stack: # Added within the span
+            return
+        command, start = shard.stack.pop()
+        key = (command, 'total' if cat == 'command' else name)
+        counts = shard.latency.get(key)
+        if counts is None:
+            counts = shard.latency[key] = [0] * (len(self._bounds) + 2)
+        counts[bisect.bisect_left(self._bounds, end - start)] += 1
+        counts[-1] += end - start
+        if cat != 'command':
+            return
+        shard.calls[command] = shard.calls.get(command, 0) + 1
+        if exc is not None:
+            key = (command, 127 if self.handler is None \
+                else self.handler._errno(exc))
+            shard.errors[key] = shard.errors.get(key, 0) + 1
+        if not shard.stack and self.path is not None \
+                and time.monotonic() - self.last_write >= self.interval:
+            self.last_write = time.monotonic()
+            try:
+                self.write()
+            except OSError as ex:
+                _logger.error('Failed to write metrics: {}'.format(ex))
+
+    def commands(self):
+        if self.handler is None:
+            return []
+        commands = list(self.handler._command.values())
+        if self.handler._default is not None:
+            commands.insert(0, self.handler._default)
+        return commands
+
+    def snapshot(self):
+        """Merge the shards.
+
+        Return calls by command, errors by (command, exit code), a Histogram
+        by (command, phase), and the CacheInfo of the results and MemoInfo
+        of the parse results by (command, "result" or "parse").
+        """
+        calls = collections.Counter()
+        errors = collections.Counter()
+        latency = {}
+        with self._lock:
+            self._retire()
+            shards = [self._retired] + self._shards
+        for shard in shards:
+            calls.update(dict(shard.calls))
+            errors.update(dict(shard.errors))
+            for key, counts in dict(shard.latency).items():
+                counts = list(counts)
+                if key in latency:
+                    counts = [x + y for x, y in zip(latency[key], counts)]
+                latency[key] = counts
+        caches = {}
+        for i in self.commands():
+            if i.cache is not None:
+                caches[i.name, 'result'] = i.cache.info()
+            if i._memo is not None:
+                caches[i.name, 'parse'] = i.memo_info()
+        return Snapshot(dict(calls), dict(errors), \
+            {k: Histogram(self.buckets, v[:-1], v[-1] / 1e9) \
+                for k, v in latency.items()}, caches)
+
+    def format(self):
+        """Return the snapshot in the Prometheus text format."""
+        snapshot = self.snapshot()
+        pid = os.getpid()
+        extra = '' if pid == self._owner else ',pid="{}"'.format(pid)
+        lines = []
+        def metric(name, kind, doc, samples):
+            lines.append('# HELP {} {}'.format(name, doc))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{{{}{}}} {}'.format(name, suffix, ','.join( \
+                    '{}="{}"'.format(k, _label(v)) for k, v in labels), \
+                    extra, value))
+        metric('libcli_command_calls_total', 'counter', 'Commands called.', \
+            [('', [('command', k)], v) for k, v in sorted(snapshot.calls.\
+                items())])
+        metric('libcli_command_errors_total', 'counter', 'Commands failed, '\
+            'by exit code.', [('', [('command', k[0]), ('errno', k[1])], v) \
+            for k, v in sorted(snapshot.errors.items())])
+        samples = []
+        for key, hist in sorted(snapshot.latency.items()):
+            labels = [('command', key[0]), ('phase', key[1])]
+            total = 0
+            for bound, n in zip(hist.buckets + ('+Inf',), hist.counts):
+                total += n
+                samples.append(('_bucket', labels + [('le', bound)], total))
+            samples.append(('_sum', labels, repr(hist.sum)))
+            samples.append(('_count', labels, total))
+        metric('libcli_phase_seconds', 'histogram', 'Latency of commands, '\
+            'phase "total", and of their phases.', samples)
+        for name, field, kind, doc in ( \
+                ('libcli_cache_hits_total', 'hits', 'counter', 'Cache hits.'), \
+                ('libcli_cache_misses_total', 'misses', 'counter', \
+                    'Cache misses.'), \
+                ('libcli_cache_entries', 'currsize', 'gauge', \
+                    'Cached entries.')):
+            metric(name, kind, doc, [('', [('command', k[0]), \
+                ('cache', k[1])], getattr(v, field)) \
+                for k, v in sorted(snapshot.caches.items())])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path=None):
+        """Write the Prometheus text format to path, or self.path suffixed by
+        the pid in a forked process, replacing it atomically.
+        """
+        if path is None:
+            path = self.path
+            if os.getpid() != self._owner:
+                path = '{}.{}'.format(path, os.getpid())
+        data = self.format().encode('utf-8')
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath( \
+            path)), prefix='.metrics-')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def serve(self, path):
+        """Answer each connection on the Unix domain socket path with the
+        Prometheus text format, from a daemon thread, until close.
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(path)
+            sock.listen(16)
+        except BaseException:
+            sock.close()
+            raise
+        sock.settimeout(self.poll_interval)
+        self.sock, self.sockpath = sock, path
+        self._thread = threading.Thread(target=self._serve, args=(sock,), \
+            name='libcli-metrics', daemon=True)
+        self._thread.start()
+
+    def _serve(self, sock):
+        while self.sock is sock:
+            try:
+                conn, addr = sock.accept()
+            except socket.timeout:
+                continue
+            except OSError: # Closed
+                return
+            with conn:
+                try:
+                    conn.settimeout(self.poll_interval * 25)
+                    conn.sendall(self.format().encode('utf-8'))
+                except OSError as ex:
+                    _logger.error('Failed to send metrics: {}'.format(ex))
+
+    def close(self):
+        """Stop serving, write the metrics if path is set."""
+        if self.sock is not None:
+            sock, self.sock = self.sock, None
+            self._thread.join()
+            sock.close()
+            try:
+                os.unlink(self.sockpath)
+            except FileNotFoundError:
+                pass
+        if self.path is not None:
+            self.write()
+
+
+# Forked processes, process pools and server workers, count their own
+_instances = weakref.WeakSet()
+
+def _after_fork():
+    for i in list(_instances):
+        i._forked()
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -3,13 +3,19 @@ import os
 import functools
 import re
 import collections
+import collections.abc
 import logging
 import inspect
+import shlex
+import threading
+import time
 
 from . import getopt
 
 DEBUG = False
 _logger = logging.getLogger(__name__)
+# Start of the profiled startup phase
+_loaded_ns = time.perf_counter_ns()
 
 class OptionError(Exception):
     pass
@@ -19,11 +25,280 @@ class StructureError(Exception):
     pass
 
 
+# Options consumed by OptionHandler.run itself, as "--libcli-NAME[=VALUE]"
+# right after the program name. True if the option requires a value.
+GLOBAL_OPTIONS = {
+    'batch': True,
+    'stop-on-error': False,
+    'jobs': True,
+    'pool': True,
+    'max-inflight': True,
+    'chunksize': True,
+    'serve': True,
+    'idle-timeout': True,
+    'serve-mode': True,
+    'interactive': False,
+    'history': True,
+    'checkpoint': True,
+    'checkpoint-every': True,
+    'resume': False,
+    'output': True,
+    'profile': True,
+    'profile-pstats': True,
+    'metrics': True,
+    'metrics-socket': True,
+    'memprofile': True,
+    'completion': True,
+    'completion-socket': True,
+    'complete': False,
+    }
+
+def parse_global(argv):
+    settings = {}
+    i = 1
+    while i < len(argv) and argv[i].startswith('--libcli-'):
+        name, sep, value = argv[i][len('--libcli-'):].partition('=')
+        if name not in GLOBAL_OPTIONS:
+            raise OptionError('Invalid option: "{}"'.format(argv[i]))
+        elif GLOBAL_OPTIONS[name] and not sep:
+            if i + 1 >= len(argv):
+                raise OptionError('Option "--libcli-{}" requires a value'.\
+                    format(name))
+            i += 1
+            value = argv[i]
+        elif not GLOBAL_OPTIONS[name] and sep:
+            raise OptionError('Option "--libcli-{}" does not take a value'.\
+                format(name))
+        settings[name] = value
+        i += 1
+    if i == 1:
+        return settings, argv
+    return settings, argv[:1] + argv[i:]
+
+# Delimiters of a branch in a chain, "cmd { branch0 } { branch1 } ..."
+BRANCH_OPEN = '{'
+BRANCH_CLOSE = '}'
+
+def split_branches(argv, index):
+    """Split the consecutive branches starting at argv[index].
+
+    Return the list of branches, each as an argv with the opening
+    delimiter in place of the program name, and the index after them.
+    """
+    branches = []
+    while index < len(argv) and argv[index] == BRANCH_OPEN:
+        depth = 0
+        for i in range(index, len(argv)):
+            if argv[i] == BRANCH_OPEN:
+                depth += 1
+            elif argv[i] == BRANCH_CLOSE:
+                depth -= 1
+                if depth == 0:
+                    break
+        else:
+            raise OptionError('Branch "{}" is not closed with "{}"'.format( \
+                BRANCH_OPEN, BRANCH_CLOSE))
+        branches.append(argv[index:i])
+        index = i + 1
+    return branches, index
+
+def branch_inputs(last, n):
+    """The chained object of each of n branches. An iterator, such as a
+    stream stage, is read once into a list, and each branch iterates over
+    its own copy of it.
+    """
+    if isinstance(last, collections.abc.Iterator):
+        items = list(last)
+        return [iter(items) for i in range(n)]
+    return [last] * n
+
+# Classes of the token following a parsed command, see CommandHandler.memo_get
+def token_class(argv, index):
+    if index >= len(argv):
+        return 'end'
+    elif argv[index] in (BRANCH_OPEN, BRANCH_CLOSE):
+        return 'brace'
+    elif argv[index].startswith('-') and argv[index] != '-':
+        return 'option'
+    return 'operand'
+
+MemoInfo = collections.namedtuple('MemoInfo', 'hits misses maxsize currsize')
+
+# Option types whose value does not depend on the argument alone, parse
+# results of commands using them are never memoised
+IMPURE_TYPES = {'path', 'file', 'mmap', 'glob'}
+
+def carries(value, resource):
+    """Whether value, passed to the next command, refers to resource."""
+    if value is resource:
+        return True
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return any(x is resource for x in value)
+    elif isinstance(value, dict):
+        return any(x is resource for x in value.values())
+    return any(x is resource for x in getattr(value, '__dict__', {}).values())
+
+def is_mmap(resource):
+    mmap = sys.modules.get('mmap')
+    return mmap is not None and isinstance(resource, mmap.mmap)
+
+def run_coroutine(coro):
+    # asyncio is imported on demand, it doubles the startup time
+    import asyncio
+    return asyncio.run(coro)
+
+def setting_int(settings, name, default=None):
+    if name not in settings:
+        return default
+    try:
+        value = int(settings[name])
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise OptionError('Option "--libcli-{}" should be a positive "int" but '\
+            'got invalid value "{}"'.format(name, settings[name]))
+    return value
+
+
+def read_operands(source, sep='\n'):
+    """Lazily read operands separated by sep from source, which is "stdin"
+    or a file descriptor. Empty operands are skipped.
+    """
+    if source == 'stdin':
+        read = sys.stdin.buffer.read1
+    else:
+        read = functools.partial(os.read, source)
+    sep = sep.encode()
+    pending = b''
+    while True:
+        chunk = read(1 << 16)
+        if not chunk:
+            break
+        *operands, pending = (pending + chunk).split(sep)
+        for i in operands:
+            if i:
+                yield os.fsdecode(i)
+    if pending:
+        yield os.fsdecode(pending)
+
+
+class SourceRef():
+    """Location of a definition, "file:line" as a string.
+
+    The line is resolved when formatted, frame.f_lineno scans the line table
+    of the whole code, which for a module defining many commands makes
+    registering them quadratic.
+    """
+    def __init__(self, frame):
+        self.filename = frame.f_code.co_filename
+        self.code = frame.f_code
+        self.lasti = frame.f_lasti
+
+    def __str__(self):
+        if hasattr(self.code, 'co_lines'):
+            lineno = next((x[2] for x in self.code.co_lines() \
+                if x[0] <= self.lasti < x[1]), None)
+        else: # Python 3.9
+            import dis
+            lineno = None
+            for offset, line in dis.findlinestarts(self.code):
+                if offset > self.lasti:
+                    break
+                lineno = line
+        return '{}:{}'.format(os.path.relpath(self.filename), lineno)
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+
+class Context():
+    """State of a single invocation, shared by the chained commands."""
+    def __init__(self, settings=None, scan=None, tracers=()):
+        self.settings = {} if settings is None else settings
+        self.streams = []
+        # Observers of spans, see trace
+        self.tracers = tracers
+        # Directory listings for glob values, shared by a batch if given
+        self.scan = scan
+        # See libcli.checkpoint, set for the top level chain only
+        self.checkpoint = None
+        # Files and maps opened for option values carried along the chain
+        self.resources = []
+
+    def close(self):
+        # Finalize stream stages from the last one, so that a stage stops
+        # before the stage it is reading from.
+        while self.streams:
+            stream = self.streams.pop()
+            if hasattr(stream, 'close'):
+                stream.close()
+        while self.resources:
+            try:
+                self.resources.pop().close()
+            except BufferError: # A map still exported, closed when collected
+                pass
+
+    def trace(self, name, cat, func, *args, **kwargs):
+        """Call func within a span name of category cat, notifying each of
+        tracers with enter(name, cat) and exit(name, cat, exc).
+        """
+        for i in self.tracers:
+            i.enter(name, cat)
+        try:
+            ret = func(*args, **kwargs)
+        except BaseException as ex:
+            for i in reversed(self.tracers):
+                i.exit(name, cat, ex)
+            raise
+        for i in reversed(self.tracers):
+            i.exit(name, cat, None)
+        return ret
+
+    def scan_cache(self):
+        if self.scan is None:
+            from .pathset import ScanCache
+            self.scan = ScanCache()
+        return self.scan
+
+
 class CommandHandler():
-    def __init__(self, func, *, _=None, _name=None, _ref=None, **kwargs):
+    def __init__(self, func, *, _=None, _name=None, _ref=None, _map=None, \
+            _stream=None, _memo=None, _cache=None, _invalidates=(), _inputs=(), _outputs=(), \
+            _operands=None, _operands_sep='\n', _defaults=None, _complete=None, \
+            **kwargs):
+        if _map not in (None, 'thread', 'process'):
+            raise StructureError('Command "{}" map should be "thread" or '\
+                '"process"'.format(func.__name__ if _name is None else _name))
         self._func = func
         self._ref = _ref
         self._ = _
+        self._map = _map
+        if _operands is not None and _operands != 'stdin' and \
+                not isinstance(_operands, int):
+            raise StructureError('Command "{}" operands should be "stdin" or '\
+                'a file descriptor'.format(func.__name__ if _name is None \
+                    else _name))
+        # Values of options missing from argv, see libcli.config.Defaults
+        self.defaults = _defaults
+        # Source of operands read lazily instead of argv, see read_operands
+        self.operands = _operands
+        self.operands_sep = _operands_sep
+        if _stream is None:
+            _stream = inspect.isgeneratorfunction(func)
+        self.stream = _stream
+        # Caches of results, see libcli.cache
+        self.cache = _cache
+        self.invalidates = tuple(_invalidates)
+        # Names of arguments which are paths of files read or written
+        self.inputs = tuple(_inputs)
+        self.outputs = tuple(_outputs)
+        # Option name -> func(prefix) returning values, see libcli.complete
+        self.completers = dict(_complete or {})
+        # Bounded LRU of parse results, keyed by the consumed tokens
+        self._memo = None
+        self._memo_maxsize = _memo
+        self.memo_hits = 0
+        self.memo_misses = 0
         self.name = func.__name__ if _name is None else _name
         self.hint = kwargs
         self.opts = None
@@ -31,54 +306,278 @@ class CommandHandler():
         if DEBUG:
             self.build_opts()
 
-    def __call__(self, argv, *, last=None):
+    def __call__(self, argv, *, last=None, ctx=None):
+        ret, end = self.call_at(argv, 0, last=last, ctx=ctx)
+        return ret, argv[end:]
+
+    def call_at(self, argv, index, *, last=None, ctx=None):
+        """Parse argv from argv[index], which is the command name,
+        call the function, return its result and the index of the next
+        unconsumed argument. argv is shared along the chain and not copied.
+        """
+        if ctx is not None and ctx.tracers:
+            return ctx.trace(self.name, 'command', self._call_at, argv, index, \
+                last, ctx)
+        return self._call_at(argv, index, last, ctx)
+
+    def _call_at(self, argv, index, last, ctx):
+        if self.opts is None and ctx is not None and ctx.tracers:
+            ctx.trace('build_opts', 'phase', self.build_opts)
         self.build_opts()
-        kwargs = {}
-        gi = getopt.iter_getopt_long(argv, self.shortopts, self.longopts)
-        for i in gi:
-            if i in self.opts:
-                kwargs[i] = self.format_value(i, gi.optarg)
-            elif i in self.alias:
-                i = self.alias[i]
-                kwargs[i] = self.format_value(i, gi.optarg)
+        chained = last is not None
+        parsed = None
+        resources = []
+        if self._memo is not None:
+            parsed = self.memo_get(argv, index, chained)
+        if parsed is None:
+            try:
+                parsed = self.parse_at(argv, index, chained, resources, ctx)
+            except BaseException:
+                self.release(None, resources, None)
+                raise
+            if self._memo is not None:
+                self.memo_put(argv, index, chained, parsed)
+        kwargs, args, end = parsed
+        if self.defaults is not None:
+            kwargs = self.apply_defaults(kwargs, resources, ctx)
+        self.check_required(kwargs)
+        if chained:
+            args = [last] + args
+        if self.operands is not None:
+            args.append(read_operands(self.operands, self.operands_sep))
+        if self.lazy_varargs and self._map is None:
+            # *args is a tuple, it takes the paths of every pattern in order
+            from .pathset import PathSet
+            n = len(self.argspec.args)
+            args = args[:n] + [y for x in args[n:] for y in \
+                (x if isinstance(x, PathSet) else (x,))]
+        reqnarg = len(args)
+
+        if self._map is not None and self.operands is not None:
+            func = lambda *args, **kwargs: \
+                self.map(args[:chained], args[chained], kwargs, ctx)
+        elif self._map is not None and self.lazy_varargs:
+            # Operands expanded lazily, chunks are read as they are mapped
+            import itertools
+            func = lambda *args, **kwargs: self.map(args[:chained], \
+                itertools.chain.from_iterable(args[chained:]), kwargs, ctx)
+        elif self._map is not None:
+            func = lambda *args, **kwargs: \
+                self.map(args[:chained], args[chained:], kwargs, ctx)
+        else:
+            func = self._func
+        try:
+            if self.cache is not None and ctx is not None and ctx.tracers:
+                ret = ctx.trace('call', 'phase', self.cache.invoke, func, \
+                    args[:reqnarg], kwargs, chained, command=self)
+            elif self.cache is not None:
+                ret = self.cache.invoke(func, args[:reqnarg], kwargs, chained, \
+                    command=self)
+            elif ctx is not None and ctx.tracers:
+                ret = ctx.trace('call', 'phase', func, *args[:reqnarg], **kwargs)
             else:
-                raise OptionError('Invalid option: "{}" with value: "{}"'.\
-                    format(gi.optopt, gi.optarg))
-        args = gi.argv[gi.optind:]
+                ret = func(*args[:reqnarg], **kwargs)
+        except BaseException:
+            self.release(None, resources, None)
+            raise
+        if resources:
+            self.release(ret, resources, ctx)
+        for i in self.invalidates:
+            i.clear()
+        if self.stream and ctx is not None and ret is not None:
+            ctx.streams.append(ret)
+        return ret, end
 
-        fas = inspect.getfullargspec(self._func)
+    def check_required(self, kwargs):
+        fas = self.argspec
         for i in fas.kwonlyargs:
             if i not in kwargs and (fas.kwonlydefaults is None \
                 or fas.kwonlydefaults is not None and i not in fas.kwonlydefaults):
                 raise OptionError('Option "{}" should be provide with "{}"'.\
                     format(i, " or ".join(self.opts[i]['alias'])))
 
-        if self._func.__class__ is type: # Constructor
-            if fas.args and fas.args[0] == 'self':
-                del fas.args[0]
+    def apply_defaults(self, kwargs, resources, ctx):
+        """Options missing from kwargs resolved by self.defaults, converted
+        the same way as values from argv. Only keyword-only arguments.
+        """
+        ret = None
+        for i in self.argspec.kwonlyargs:
+            if i in kwargs or i not in self.opts:
+                continue
+            value = self.defaults.lookup(self.name, i)
+            if value is None:
+                continue
+            if ret is None:
+                ret = dict(kwargs)
+            if set(self.opts[i].get('type', ())) <= {'flag', 'none'}:
+                if value.lower() not in ('0', 'n', 'no', 'f', 'false', 'nil', \
+                        'nul', 'null', 'none', '-', ''):
+                    ret[i] = ''
+            else:
+                ret[i] = self.format_value(i, value, resources, ctx)
+        return kwargs if ret is None else ret
+
+    def release(self, ret, resources, ctx):
+        """Close resources opened for option values, unless ret refers to
+        them, then they are closed with ctx at the end of the chain.
+        """
+        # A stream stage or a coroutine uses them once the command returned
+        defer = ctx is not None and ret is not None and (self.stream or \
+            inspect.isawaitable(ret))
+        for i in resources:
+            # A map may be exported to ret through a memoryview or a slice of
+            # one, which carries does not see
+            if defer or ctx is not None and (carries(ret, i) or \
+                    ret is not None and is_mmap(i)):
+                ctx.resources.append(i)
+                continue
+            try:
+                i.close()
+            except BufferError: # Still exported, closed when collected
+                if ctx is not None:
+                    ctx.resources.append(i)
+
+    def parse_at(self, argv, index, chained, resources=None, ctx=None):
+        """Parse argv from argv[index], return the converted keyword arguments,
+        the converted positional arguments following the chained one if
+        chained, and the index of the next unconsumed argument.
+        """
+        if ctx is not None and ctx.tracers:
+            raw, args, end = ctx.trace('parse', 'phase', self.scan_at, argv, \
+                index, chained)
+            return ctx.trace('convert', 'phase', self.convert, raw, args, \
+                chained, resources, ctx) + (end,)
+        raw, args, end = self.scan_at(argv, index, chained)
+        return self.convert(raw, args, chained, resources, ctx) + (end,)
+
+    def scan_at(self, argv, index, chained):
+        """Return the option values as in argv, the positional arguments
+        following the chained one, and the index of the next unconsumed
+        argument.
+        """
+        raw = {}
+        gi = getopt.iter_getopt_long(argv, self.shortopts, self.longopts, \
+            optind=index+1)
+        for i in gi:
+            if i in self.opts:
+                raw[i] = gi.optarg
+            elif i in self.alias:
+                raw[self.alias[i]] = gi.optarg
+            else:
+                raise OptionError('Invalid option: "{}" with value: "{}"'.\
+                    format(gi.optopt, gi.optarg))
+        optind = gi.optind
 
-        if last is not None:
-            args.insert(0, last)
+        fas = self.argspec
+        if self.operands is not None:
+            # The positional argument after the chained one is read lazily
+            return raw, [], optind
 
-        reqnarg = (0 if fas.args is None else len(fas.args)) \
-            - (0 if fas.defaults is None else len(fas.defaults))
+        # Positional arguments are last if chained, followed by argv[optind:]
+        # up to the opening of a branch, unless after "--". A closing one
+        # here closes no branch, split_branches took them out.
+        stop = len(argv) if fas.varargs is not None \
+            else min(len(argv), optind + len(fas.args))
+        for i in range(optind, stop):
+            if argv[i] == BRANCH_OPEN and not gi.dashdash:
+                break
+        else:
+            i = len(argv)
+        nargs = i - optind + chained
+        reqnarg = len(fas.args) - (0 if fas.defaults is None else len(fas.defaults))
         for i in range(reqnarg):
-            if fas.args[i] in kwargs:
+            if fas.args[i] in raw:
                 reqnarg -= 1
-        if reqnarg > len(args):
+        if reqnarg > nargs:
             raise OptionError('Not enough positional argument')
         elif fas.varargs is not None:
-            reqnarg = len(args)
+            reqnarg = nargs
         else:
-            reqnarg = sum([x not in kwargs for x in fas.args])
-        for i in range(last is not None, reqnarg): # Skip first if chained
+            reqnarg = min(nargs, sum([x not in raw for x in fas.args]))
+        end = optind + max(0, reqnarg - chained)
+        return raw, argv[optind:end], end
+
+    def convert(self, raw, args, chained, resources=None, ctx=None):
+        """Return the converted keyword and positional arguments."""
+        fas = self.argspec
+        kwargs = {}
+        for i in raw:
+            kwargs[i] = self.format_value(i, raw[i], resources, ctx)
+        for i in range(chained, chained + len(args)): # Skip first if chained
             #if i < len(fas.args) and fas.args[i] in kwargs: # Should not happen
                 #raise OptionError('Option "{}" got both keyword and '\
                     #'positional value'.format(fas.args[i]))
-            if i < len(args) and i < len(fas.args) and  fas.args[i] in self.opts:
-                args[i] = self.format_value(fas.args[i], args[i])
+            if i < len(fas.args) and fas.args[i] in self.opts:
+                args[i-chained] = self.format_value(fas.args[i], \
+                    args[i-chained], resources, ctx)
+            elif i >= len(fas.args) and fas.varargs in self.opts:
+                args[i-chained] = self.format_value(fas.varargs, \
+                    args[i-chained], resources, ctx)
+        return kwargs, args
 
-        return self._func(*args[:reqnarg], **kwargs), args[reqnarg:]
+    def memo_get(self, argv, index, chained):
+        with self._memo_lock:
+            lengths = list(self._memo_lengths)
+        for n in lengths:
+            if index + 1 + n > len(argv):
+                continue
+            key = (chained, tuple(argv[index+1:index+1+n]))
+            with self._memo_lock:
+                entry = self._memo.get(key)
+                if entry is not None:
+                    self._memo.move_to_end(key)
+            if entry is None:
+                continue
+            kwargs, args, truncated, tail = entry
+            # The same tokens parse the same way, unless what follows them
+            # would have been consumed as well
+            now = token_class(argv, index + 1 + n)
+            if truncated and now != tail or not args and now == 'option':
+                continue
+            with self._memo_lock:
+                self.memo_hits += 1
+            return {k: v.copy() if isinstance(v, list) else v \
+                for k, v in kwargs.items()}, \
+                [x.copy() if isinstance(x, list) else x for x in args], \
+                index + 1 + n
+        with self._memo_lock:
+            self.memo_misses += 1
+        return None
+
+    def memo_put(self, argv, index, chained, parsed):
+        kwargs, args, end = parsed
+        key = argv[index+1:end]
+        if '--' in key:
+            return
+        fas = self.argspec
+        truncated = fas.varargs is not None or len(args) < \
+            sum([x not in kwargs for x in fas.args]) - chained
+        entry = ({k: v.copy() if isinstance(v, list) else v \
+            for k, v in kwargs.items()}, \
+            [x.copy() if isinstance(x, list) else x for x in args], \
+            truncated, token_class(argv, end))
+        key = (chained, tuple(key))
+        with self._memo_lock:
+            if key not in self._memo:
+                self._memo_lengths[len(key[1])] += 1
+            self._memo[key] = entry
+            while len(self._memo) > self._memo_maxsize:
+                key, entry = self._memo.popitem(last=False)
+                self._memo_lengths[len(key[1])] -= 1
+                if not self._memo_lengths[len(key[1])]:
+                    del self._memo_lengths[len(key[1])]
+
+    def memo_info(self):
+        """Statistics of memoised parse results, like functools.lru_cache."""
+        return MemoInfo(self.memo_hits, self.memo_misses, \
+            self._memo_maxsize, 0 if self._memo is None else len(self._memo))
+
+    def map(self, prefix, operands, kwargs, ctx=None):
+        from . import batch
+        settings = {} if ctx is None else ctx.settings
+        return batch.map_chunks(self._func, prefix, operands, kwargs, \
+            pool=self._map, workers=setting_int(settings, 'jobs'), \
+            chunksize=setting_int(settings, 'chunksize'))
 
     def build_opts(self):
         if self.opts is not None:
@@ -99,6 +598,30 @@ class CommandHandler():
                 'and variable arguments at the same time. This may result in '\
                 'ambiguous options. Try varargs and keyword-only arguments instead.'.\
                     format(self._func.__name__))
+        # Positional arguments as seen by the caller
+        if self._func.__class__ is type and fas.args and fas.args[0] == 'self':
+            self.argspec = fas._replace(args=fas.args[1:]) # Constructor
+        else:
+            self.argspec = fas
+        if self.cache is not None and (self.stream or \
+                inspect.iscoroutinefunction(self._func)):
+            raise StructureError('Command "{}" returns a stream or a coroutine, '\
+                'which could not be cached'.format(self.name))
+        for i in self.inputs + self.outputs + tuple(self.completers):
+            if i not in fas.args and i != fas.varargs and i not in fas.kwonlyargs:
+                raise StructureError('Command "{}" has no argument "{}"'.\
+                    format(self.name, i))
+        if self.operands is not None:
+            if self._map is None and (fas.varargs is not None or \
+                    len(self.argspec.args) < 1):
+                raise StructureError('Function "{}" should take a positional '\
+                    'argument for its operands'.format(self._func.__name__))
+            if self.cache is not None:
+                raise StructureError('Command "{}" reads operands lazily, '\
+                    'which could not be cached'.format(self.name))
+        if self._map is not None and fas.varargs is None:
+            raise StructureError('Function "{}" should take variable arguments '\
+                'to be mapped'.format(self._func.__name__))
         self.longopts = []
         self.shortopts = '' if self._ is None else self._
         # positional args
@@ -111,6 +634,21 @@ class CommandHandler():
         for i in fas.kwonlyargs:
             if not i.startswith('_'):
                 self.longopts.extend(self.parse_opt(i))
+        # variable args, typed only
+        if fas.varargs is not None and fas.varargs in self.hint:
+            if self.parse_opt(fas.varargs):
+                raise StructureError('Variable arguments "{}" could not be an '\
+                    'option'.format(fas.varargs))
+        # Mapped operands expanded to several paths each
+        self.lazy_varargs = fas.varargs in self.opts and \
+            'glob' in self.opts[fas.varargs].get('type', ())
+
+        # Memoise only if argv is parsed in order and every type is pure
+        if self._memo_maxsize and self.shortopts.startswith('+') and \
+            not any(set(x.get('type', ())) & IMPURE_TYPES for x in self.opts.values()):
+            self._memo = collections.OrderedDict()
+            self._memo_lengths = collections.Counter()
+            self._memo_lock = threading.Lock()
 
         if DEBUG:
             print('  short option string: "{}"'.format(self.shortopts), file=sys.stderr)
@@ -281,7 +819,11 @@ class CommandHandler():
         # Option.val should be int or char, but with python, str is also usable.
         return [getopt.Option(name, req, None, name)]
 
-    def format_value(self, name, value):
+    def format_value(self, name, value, resources=None, ctx=None):
+        """Convert value of option name to the first of its types accepting it.
+        Files and maps opened are appended to resources, to be closed by the
+        caller. Globs share the directory listings of ctx.
+        """
         #if 'type' not in self.opts[name]: # Should not happen
             #return value
         if value is None and 'default' in self.opts[name]:
@@ -323,6 +865,29 @@ class CommandHandler():
                         kv = i.split('=', 1)
                         ret.append(tuple(kv) if len(kv) == 2 else (kv[0], None))
                     return ret
+                elif i == 'path':
+                    if not os.path.exists(value):
+                        continue
+                    return value
+                elif i == 'file':
+                    if value == '-':
+                        return sys.stdin.buffer
+                    ret = open(value, 'rb')
+                    if resources is not None:
+                        resources.append(ret)
+                    return ret
+                elif i == 'mmap':
+                    import mmap
+                    with open(value, 'rb') as f:
+                        if os.fstat(f.fileno()).st_size == 0:
+                            return b'' # An empty file could not be mapped
+                        ret = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    if resources is not None:
+                        resources.append(ret)
+                    return ret
+                elif i == 'glob':
+                    from .pathset import PathSet
+                    return PathSet(value, None if ctx is None else ctx.scan_cache())
                 elif i == 'flag':
                     if value is None:
                         return ''
@@ -338,17 +903,27 @@ class CommandHandler():
                     if DEBUG:
                         break
                     continue
-            except (TypeError, ValueError, AttributeError):
+            except (TypeError, ValueError, AttributeError, OSError):
                 pass
         raise OptionError('Option "{}" should be "{}" but got invalid value "{}"'.\
             format(name, '" or "'.join(self.opts[name]['type']), value))
 
 
 class OptionHandler():
-    def __init__(self):
+    def __init__(self, *, env_prefix=None, config=None):
         self._command = collections.OrderedDict()
         self._default = None
         self._error = collections.OrderedDict()
+        # Observers of the spans of commands and phases, see Context.trace
+        self.tracers = []
+        # Serialization of final values for --libcli-output, see libcli.output
+        self._encoder = collections.OrderedDict()
+        # Options missing from argv resolved from environment and config
+        if env_prefix is None and config is None:
+            self._defaults = None
+        else:
+            from .config import Defaults
+            self._defaults = Defaults(env_prefix, config)
 
     def command(self, func=None, _='+', **kwargs):
         cur = inspect.currentframe()
@@ -368,16 +943,15 @@ class OptionHandler():
                 # Python stack frame support not available
                 ref = None
             else:
-                caller = inspect.getouterframes(cur, 2)[1]
-                filename = os.path.relpath(caller.filename)
-                ref = '{}:{}'.format(filename, caller.lineno)
+                ref = SourceRef(cur.f_back)
             kwargs['_'] = _
             if DEBUG:
                 if ref:
                     print('\nCommand "{}" at [{}]:'.format(name, ref), file=sys.stderr)
                 else:
                     print('\nCommand "{}":'.format(name), file=sys.stderr)
-            self._command[name] = CommandHandler(func, **kwargs, _ref=ref)
+            self._command[name] = CommandHandler(func, **kwargs, _ref=ref, \
+                _defaults=self._defaults)
         return func
 
     def default(self, func=None, _='+', **kwargs):
@@ -391,16 +965,15 @@ class OptionHandler():
                 # Python stack frame support not available
                 ref = None
             else:
-                caller = inspect.getouterframes(cur, 2)[1]
-                filename = os.path.relpath(caller.filename)
-                ref = '{}:{}'.format(filename, caller.lineno)
+                ref = SourceRef(cur.f_back)
             kwargs['_'] = _
             if DEBUG:
                 if ref:
                     print('\nDefault command at [{}]:'.format(ref), file=sys.stderr)
                 else:
                     print('\nDefault command:', file=sys.stderr)
-            self._default = CommandHandler(func, **kwargs, _ref=ref)
+            self._default = CommandHandler(func, **kwargs, _ref=ref, \
+                _defaults=self._defaults)
         else:
             if self._default._ref:
                 raise StructureError('Default already defined at [{}]'.format( \
@@ -420,30 +993,429 @@ class OptionHandler():
             self._error[ext] = kwargs
         return ext
 
+    def encoder(self, cls, func=None):
+        """Register func converting instances of cls to serializable values
+        for --libcli-output.
+        """
+        if func is None:
+            return functools.partial(self.encoder, cls)
+        elif not callable(func):
+            raise StructureError('Encoder "{}" not callable'.format(repr(func)))
+        self._encoder[cls] = func
+        return func
+
+    def build_opts(self):
+        if callable(self._default):
+            self._default.build_opts()
+        for i in self._command.values():
+            i.build_opts()
+
     def run(self, argv=None, *, last=None, logger=None, debug=False):
         if argv is None:
             argv = sys.argv
         if logger is None:
             logger = _logger
+        tracers = []
         try:
-            if callable(self._default):
-                last, argv = self._default(argv, last=last)
+            settings, argv = parse_global(argv)
+            if 'completion' in settings:
+                self._completion(settings, argv)
+                return
+            if 'complete' in settings:
+                self._complete(argv[1:])
+                return
+            if self._help(argv, logger):
+                return
+            tracers = self._start_tracers(settings)
+            if 'serve' in settings:
+                self._serve(settings, argv, logger=logger)
+                return
+            if 'interactive' in settings:
+                sys.exit(self.interact(argv, last=last, logger=logger, \
+                    debug=debug, history=settings.get('history'), \
+                    settings=settings))
+            if 'batch' in settings:
+                errnos = self._run_batch_file(settings, argv, last=last, \
+                    logger=logger, debug=debug)
+                sys.exit(next((x for x in errnos if x), 0))
+            self._dispatch(argv, last, self._context(settings, argv, logger))
+        except tuple(self._error) as exc:
+            logger.error(repr(exc))
+            sys.exit(self._errno(exc))
+        except () if debug else OptionError as ex:
+            logger.error(ex)
+            sys.exit(127)
+        finally:
+            self._stop_tracers(tracers, logger)
+
+    def _context(self, settings, argv, logger):
+        """Context of a single run of argv with the global settings."""
+        if 'output' in settings:
+            from . import output
+            output.check(settings['output'])
+        ctx = Context(settings, tracers=self.tracers)
+        if 'checkpoint' in settings:
+            from . import checkpoint
+            ctx.checkpoint = checkpoint.Checkpoint(settings['checkpoint'], \
+                argv, every=setting_int(settings, 'checkpoint-every', 1), \
+                logger=logger)
+        elif 'resume' in settings:
+            raise OptionError('Option "--libcli-resume" requires '\
+                '"--libcli-checkpoint"')
+        return ctx
+
+    def _completion(self, settings, argv):
+        """Refresh the spec cache, print the completion script of the shell
+        reading the index from it.
+        """
+        from . import complete, spec
+        if settings['completion'] not in complete.SHELLS:
+            raise OptionError('Option "--libcli-completion" should be "{}" '\
+                'but got invalid value "{}"'.format('" or "'.join( \
+                    complete.SHELLS), settings['completion']))
+        cache = spec.for_prog(argv[0])
+        try:
+            cache.refresh(self, force=True)
+        except OSError as ex:
+            raise OptionError('Failed to write spec cache: {}'.format(ex))
+        print(complete.script(settings['completion'], argv[0], cache.path, \
+            settings.get('completion-socket')), end='')
+
+    def _complete(self, args):
+        """Print the values of option args[1] of command args[0], the default
+        if empty, starting with args[2], from the completer of the option.
+        """
+        if len(args) != 3:
+            raise OptionError('Option "--libcli-complete" requires a command, '\
+                'an option and a prefix')
+        command = self._command.get(args[0]) if args[0] else self._default
+        if command is None:
+            return
+        command.build_opts()
+        for name, info in command.opts.items():
+            if args[1] in info.get('alias', ()) and name in command.completers:
+                for i in command.completers[name](args[2]):
+                    if i.startswith(args[2]):
+                        print(i)
+                return
+
+    def _help(self, argv, logger):
+        """Print the help asked by argv, "PROG --help" or "PROG CMD --help",
+        from the spec cache, created or refreshed. Return whether it was.
+        """
+        if len(argv) not in (2, 3) or argv[-1] != '--help':
+            return False
+        from . import spec, usage
+        key = usage.help_key(argv)
+        if key is None or (key and key not in self._command):
+            return False
+        cache = spec.for_prog(argv[0])
+        try:
+            cache.refresh(self)
+            texts = cache.load_help()
+        except OSError as ex:
+            logger.debug('Failed to write spec cache: {}'.format(ex))
+            texts = None
+        if texts is None:
+            texts = usage.render(spec.describe(self), cache.prog)
+        if key not in texts: # Defined by the command
+            return False
+        print(texts[key], end='')
+        return True
+
+    def _start_tracers(self, settings):
+        """Append the tracers enabled by settings to self.tracers."""
+        tracers = []
+        if 'profile' in settings:
+            from . import profile
+            tracers.append(profile.Profiler(settings['profile'], \
+                pstats=settings.get('profile-pstats'), start_ns=_loaded_ns))
+        elif 'profile-pstats' in settings:
+            raise OptionError('Option "--libcli-profile-pstats" requires '\
+                '"--libcli-profile"')
+        if 'metrics' in settings or 'metrics-socket' in settings:
+            if 'serve' in settings and 'metrics-socket' in settings:
+                raise OptionError('Option "--libcli-metrics-socket" is not '\
+                    'supported in server mode, use "--libcli-metrics"')
+            if settings.get('serve-mode') == 'fork':
+                raise OptionError('Option "--libcli-metrics" requires '\
+                    '"--libcli-serve-mode=prefork"')
+            from . import metrics
+            tracer = metrics.Metrics(self, path=settings.get('metrics'))
+            if 'metrics-socket' in settings:
+                try:
+                    tracer.serve(settings['metrics-socket'])
+                except OSError as ex:
+                    raise OptionError('Failed to serve metrics: {}'.format(ex))
+            tracers.append(tracer)
+        if 'memprofile' in settings:
+            from . import profile
+            tracers.append(profile.MemoryProfiler(settings['memprofile']))
+        self.tracers.extend(tracers)
+        return tracers
+
+    def _stop_tracers(self, tracers, logger):
+        for i in tracers:
+            self.tracers.remove(i)
+            try:
+                i.close()
+            except OSError as ex:
+                logger.error('Failed to write report: {}'.format(ex))
+
+    def run_batch(self, stream, *, last=None, logger=None, debug=False, \
+            stop_on_error=False, prog=None, workers=None, pool='thread', \
+            max_inflight=None, settings=None):
+        """Dispatch each shell-quoted line of stream as a separate invocation.
+
+        Return the list of exit codes, one per dispatched line, 0 on success.
+        Empty lines and comments are skipped.
+        If workers is set, lines are dispatched on a pool of workers,
+        see libcli.batch.run_parallel.
+        """
+        if logger is None:
+            logger = _logger
+        if workers is not None:
+            from . import batch
+            return batch.run_parallel(self, stream, workers=workers, \
+                pool=pool, max_inflight=max_inflight, \
+                stop_on_error=stop_on_error, prog=prog, logger=logger, \
+                debug=debug, settings=settings, last=last)
+        if prog is None:
+            prog = sys.argv[0] if sys.argv else ''
+        # Directory listings are shared by the lines of a batch
+        from .pathset import ScanCache
+        scan = ScanCache()
+        errnos = []
+        for lineno, line in enumerate(stream, 1):
+            try:
+                argv = shlex.split(line, comments=True)
+            except ValueError as ex:
+                logger.error('line {}: {}'.format(lineno, ex))
+                errnos.append(127)
             else:
-                argv = argv[1:]
-            while argv:
-                if argv[0] in self._command:
-                    last, argv = self._command[argv[0]](argv, last=last)
-                else:
-                    raise OptionError('Unknow command "{}"'.format(argv[0]))
+                if not argv:
+                    continue
+                errnos.append(self._invoke([prog] + argv, last, \
+                    logger=logger, debug=debug, lineno=lineno, \
+                    settings=settings, scan=scan))
+            if stop_on_error and errnos[-1]:
+                break
+        return errnos
+
+    def interact(self, argv=None, *, last=None, stream=None, prompt=None, \
+            history=None, logger=None, debug=False, settings=None):
+        """Run argv, then read command lines from stream or the terminal,
+        dispatch them against the chained object until end of file.
+        See libcli.shell.Shell. Return the exit code of the last line.
+        """
+        from . import shell
+        if argv is None:
+            argv = sys.argv
+        return shell.Shell(self, prompt=prompt, history=history, \
+            logger=_logger if logger is None else logger, debug=debug).run( \
+                argv, last=last, stream=stream, settings=settings)
+
+    def serve(self, path, *, mode='prefork', workers=None, idle_timeout=None, \
+            logger=None):
+        """Serve on a Unix domain socket, with a pool of workers if mode is
+        "prefork", or a child forked for each request if mode is "fork".
+        See libcli.server.
+        """
+        from . import server
+        server.serve(self, path, mode=mode, workers=workers, \
+            idle_timeout=idle_timeout, logger=logger)
+
+    def _serve(self, settings, argv, **kwargs):
+        if argv[1:]:
+            raise OptionError('Server mode takes no command line, got "{}"'.\
+                format(' '.join(argv[1:])))
+        if 'idle-timeout' in settings:
+            try:
+                kwargs['idle_timeout'] = float(settings['idle-timeout'])
+            except ValueError:
+                raise OptionError('Option "--libcli-idle-timeout" should be '\
+                    '"float" but got invalid value "{}"'.format( \
+                        settings['idle-timeout']))
+        kwargs['mode'] = settings.get('serve-mode', 'prefork')
+        if kwargs['mode'] not in ('prefork', 'fork'):
+            raise OptionError('Option "--libcli-serve-mode" should be "prefork" '\
+                'or "fork" but got invalid value "{}"'.format(kwargs['mode']))
+        self.serve(settings['serve'], workers=setting_int(settings, 'jobs'), \
+            **kwargs)
+
+    def _run_batch_file(self, settings, argv, **kwargs):
+        if argv[1:]:
+            raise OptionError('Batch mode takes no command line, got "{}"'.\
+                format(' '.join(argv[1:])))
+        if 'jobs' in settings:
+            kwargs['workers'] = setting_int(settings, 'jobs')
+            kwargs['max_inflight'] = setting_int(settings, 'max-inflight')
+            kwargs['pool'] = settings.get('pool', 'thread')
+            if kwargs['pool'] not in ('thread', 'process'):
+                raise OptionError('Option "--libcli-pool" should be "thread" '\
+                    'or "process" but got invalid value "{}"'.\
+                        format(kwargs['pool']))
+        kwargs['settings'] = settings
+        if settings['batch'] == '-':
+            return self.run_batch(sys.stdin, prog=argv[0], \
+                stop_on_error='stop-on-error' in settings, **kwargs)
+        try:
+            with open(settings['batch'], 'r') as stream:
+                return self.run_batch(stream, prog=argv[0], \
+                    stop_on_error='stop-on-error' in settings, **kwargs)
+        except OSError as ex:
+            raise OptionError('Failed to read batch file: "{}"'.format(ex))
+
+    def _invoke(self, argv, last, *, logger, debug, lineno=None, settings=None, \
+            scan=None, ctx=None):
+        prefix = '' if lineno is None else 'line {}: '.format(lineno)
+        if ctx is None:
+            ctx = Context(settings, scan, self.tracers)
+        try:
+            self._dispatch(argv, last, ctx)
+        except tuple(self._error) as exc:
+            logger.error(prefix + repr(exc))
+            return self._errno(exc)
+        except () if debug else OptionError as ex:
+            logger.error(prefix + str(ex))
+            return 127
+        return 0
+
+    def _dispatch(self, argv, last, ctx=None):
+        if ctx is None:
+            ctx = Context(tracers=self.tracers)
+        # A single copy, commands move a cursor over it
+        argv = list(argv)
+        checkpoint = ctx.checkpoint
+        state = None
+        try:
+            if checkpoint is not None and 'resume' in ctx.settings:
+                # From the beginning if none was saved
+                state = checkpoint.load()
+            if state is not None:
+                i, last = state
+            elif callable(self._default):
+                last, i = self._default.call_at(argv, 0, last=last, ctx=ctx)
+                if inspect.iscoroutine(last):
+                    last = run_coroutine(last)
+                if checkpoint is not None:
+                    checkpoint.save(i, last)
+            else:
+                i = 1
+            last = self._chain(argv, i, last, ctx, checkpoint)
+            if checkpoint is not None:
+                checkpoint.done()
+            self._output(last, ctx)
+            return last
+        finally:
+            ctx.close()
+
+    def _output(self, last, ctx):
+        if 'output' in ctx.settings:
+            from . import output
+            output.write(last, ctx.settings['output'], encoders=self._encoder)
+        elif ctx.streams and last is ctx.streams[-1]:
+            # Nothing reads from the last stream stage, drain it
+            collections.deque(last, maxlen=0)
+
+    def _chain(self, argv, i, last, ctx, checkpoint=None):
+        while i < len(argv):
+            if argv[i] == BRANCH_OPEN:
+                branches, i = split_branches(argv, i)
+                last = self._fan_out(branches, last, ctx)
+            elif argv[i] in self._command:
+                last, i = self._command[argv[i]].call_at(argv, i, \
+                    last=last, ctx=ctx)
+                if inspect.iscoroutine(last):
+                    last = run_coroutine(last)
+            else:
+                raise OptionError('Unknow command "{}"'.format(argv[i]))
+            if checkpoint is not None:
+                checkpoint.save(i, last)
+        return last
+
+    def _fan_out(self, branches, last, ctx):
+        workers = setting_int(ctx.settings, 'jobs', len(branches))
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(self._chain, x, 1, y, ctx) \
+                for x, y in zip(branches, branch_inputs(last, len(branches)))]
+        # Raise the error of the first failed branch
+        return [x.result() for x in futures]
+
+    async def run_async(self, argv=None, *, last=None, logger=None, debug=False):
+        if argv is None:
+            argv = sys.argv
+        if logger is None:
+            logger = _logger
+        try:
+            await self._dispatch_async(argv, last)
         except tuple(self._error) as exc:
-            errno = 127
-            for i in self._error:
-                if isinstance(exc, i):
-                    if 'errno' in self._error[i]:
-                        errno = self._error[i]['errno']
-                    break
             logger.error(repr(exc))
-            sys.exit(errno)
+            sys.exit(self._errno(exc))
         except () if debug else OptionError as ex:
             logger.error(ex)
             sys.exit(127)
+
+    async def run_many_async(self, argvs, *, logger=None, debug=False):
+        """Run independent invocations concurrently on the running event
+        loop, return their exit codes in order instead of exiting.
+        """
+        if logger is None:
+            logger = _logger
+        async def _run(argv):
+            try:
+                await self._dispatch_async(argv, None)
+            except tuple(self._error) as exc:
+                logger.error(repr(exc))
+                return self._errno(exc)
+            except () if debug else OptionError as ex:
+                logger.error(ex)
+                return 127
+            return 0
+        import asyncio
+        return await asyncio.gather(*[_run(x) for x in argvs])
+
+    async def _dispatch_async(self, argv, last, ctx=None):
+        if ctx is None:
+            ctx = Context(tracers=self.tracers)
+        argv = list(argv)
+        try:
+            if callable(self._default):
+                last, i = self._default.call_at(argv, 0, last=last, ctx=ctx)
+                if inspect.isawaitable(last):
+                    last = await last
+            else:
+                i = 1
+            last = await self._chain_async(argv, i, last, ctx)
+            self._output(last, ctx)
+            return last
+        finally:
+            ctx.close()
+
+    async def _chain_async(self, argv, i, last, ctx):
+        while i < len(argv):
+            if argv[i] == BRANCH_OPEN:
+                branches, i = split_branches(argv, i)
+                import asyncio
+                results = await asyncio.gather(*[self._chain_async( \
+                    x, 1, y, ctx) for x, y in zip(branches, branch_inputs( \
+                        last, len(branches)))], return_exceptions=True)
+                for j in results:
+                    if isinstance(j, BaseException):
+                        raise j
+                last = results
+            elif argv[i] in self._command:
+                last, i = self._command[argv[i]].call_at(argv, i, \
+                    last=last, ctx=ctx)
+                if inspect.isawaitable(last):
+                    last = await last
+            else:
+                raise OptionError('Unknow command "{}"'.format(argv[i]))
+        return last
+
+    def _errno(self, exc):
+        for i in self._error:
+            if isinstance(exc, i):
+                return self._error[i].get('errno', 127)
+        return 127
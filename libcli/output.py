@@ -0,0 +1,129 @@
+"""Write the final value of a chain as JSON Lines, JSON or MessagePack.
+
+Iterators are written item by item as they are produced, through a buffer
+flushed every BUFFER_SIZE characters or bytes.
+msgpack is an optional dependency, required by the msgpack format only.
+"""
+import json
+import sys
+
+from .opttools import OptionError
+
+FORMATS = ('ndjson', 'json', 'msgpack')
+BUFFER_SIZE = 1 << 16
+
+
+class _Buffer():
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.stream.write(self.chunks[0][:0].join(self.chunks))
+            self.chunks = []
+            self.size = 0
+        self.stream.flush()
+
+
+def is_sequence(value):
+    """Whether value is written as a sequence of items."""
+    return not isinstance(value, (str, bytes, bytearray, dict)) and \
+        hasattr(value, '__iter__')
+
+
+def make_default(encoders):
+    """Fallback of the serializers for values of other types, converted by
+    the first encoder registered for a base class of the value.
+    """
+    def default(value):
+        for i in encoders:
+            if isinstance(value, i):
+                return encoders[i](value)
+        if isinstance(value, (set, frozenset)):
+            return list(value)
+        raise TypeError('Object of type "{}" is not serializable'.format( \
+            type(value).__name__))
+    return default
+
+
+def encoding(encode):
+    """Wrap encode to raise OptionError if an item could not be encoded.
+    Errors raised while producing the items are left as they are.
+    """
+    def wrapper(value):
+        try:
+            return encode(value)
+        except (TypeError, ValueError, OverflowError) as ex:
+            raise OptionError('Failed to write output: {}'.format(ex))
+    return wrapper
+
+
+def check(fmt):
+    if fmt not in FORMATS:
+        raise OptionError('Option "--libcli-output" should be "{}" but got '\
+            'invalid value "{}"'.format('" or "'.join(FORMATS), fmt))
+
+
+def write(value, fmt, *, encoders=None, stream=None):
+    """Write value to stream, sys.stdout by default, in format fmt.
+
+    With ndjson, each item of a sequence is a line, other values a single
+    line. With json, a sequence is written as an array. With msgpack,
+    each item of a sequence is a packed object. None writes nothing.
+    """
+    check(fmt)
+    if value is None:
+        return
+    if stream is None:
+        stream = sys.stdout
+    default = make_default({} if encoders is None else encoders)
+    if fmt == 'msgpack':
+        _write_msgpack(value, default, stream)
+    else:
+        _write_json(value, fmt, default, stream)
+
+
+def _write_json(value, fmt, default, stream):
+    encode = encoding(json.JSONEncoder(default=default, \
+        ensure_ascii=False).encode)
+    buf = _Buffer(stream)
+    if not is_sequence(value):
+        buf.write(encode(value))
+        buf.write('\n')
+    elif fmt == 'ndjson':
+        for i in value:
+            buf.write(encode(i))
+            buf.write('\n')
+    else:
+        buf.write('[')
+        sep = '\n'
+        for i in value:
+            buf.write(sep)
+            buf.write(encode(i))
+            sep = ',\n'
+        buf.write('\n]\n')
+    buf.flush()
+
+
+def _write_msgpack(value, default, stream):
+    try:
+        import msgpack
+    except ImportError:
+        raise OptionError('Output format "msgpack" requires package "msgpack"')
+    pack = encoding(msgpack.Packer(default=default).pack)
+    buf = _Buffer(getattr(stream, 'buffer', stream))
+    stream.flush()
+    if not is_sequence(value):
+        buf.write(pack(value))
+    else:
+        for i in value:
+            buf.write(pack(i))
+    buf.flush()
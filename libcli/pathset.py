@@ -0,0 +1,104 @@
+"""Expand glob patterns lazily, with directory listings cached and shared."""
+import fnmatch
+import os
+import re
+import threading
+
+_magic = re.compile(r'[*?[]')
+
+
+class ScanCache():
+    """Listings of directories by os.scandir, shared by the patterns expanded
+    with it. Not refreshed, the cache should live for one invocation or batch.
+    """
+    def __init__(self):
+        self._listings = {}
+        self._lock = threading.Lock()
+        self.scans = 0
+
+    def list(self, path):
+        """Sorted list of (name, is_dir, is_symlink) in directory path,
+        empty if it could not be read."""
+        listing = self._listings.get(path)
+        if listing is not None:
+            return listing
+        listing = []
+        try:
+            with os.scandir(path or os.curdir) as it:
+                for i in it:
+                    try:
+                        listing.append((i.name, i.is_dir(), i.is_symlink()))
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        listing.sort()
+        with self._lock:
+            self.scans += 1
+            return self._listings.setdefault(path, listing)
+
+
+def expand(pattern, cache=None):
+    """Generate paths matching pattern, in which "**" matches any number of
+    directories. Hidden names are matched only by a part starting with ".".
+    Symbolic links to directories are not followed by "**".
+    """
+    if cache is None:
+        cache = ScanCache()
+    drive, rest = os.path.splitdrive(pattern)
+    if rest.startswith(os.sep):
+        root = drive + os.sep
+    else:
+        root = drive
+    parts = [x for x in rest.split(os.sep) if x]
+    if not _magic.search(rest):
+        if os.path.lexists(pattern):
+            yield pattern
+        return
+    yield from _walk(root, parts, cache)
+
+
+def _walk(base, parts, cache):
+    part, rest = parts[0], parts[1:]
+    if part == '**':
+        if rest:
+            yield from _walk(base, rest, cache)
+        for name, is_dir, is_symlink in cache.list(base):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(base, name)
+            if not rest: # Everything below base
+                yield path
+            if is_dir and not is_symlink:
+                yield from _walk(path, parts, cache)
+    elif not _magic.search(part):
+        path = os.path.join(base, part)
+        if not rest:
+            if os.path.lexists(path):
+                yield path
+        else:
+            yield from _walk(path, rest, cache)
+    else:
+        hidden = part.startswith('.')
+        for name, is_dir, is_symlink in cache.list(base):
+            if name.startswith('.') and not hidden:
+                continue
+            if not fnmatch.fnmatchcase(name, part):
+                continue
+            if not rest:
+                yield os.path.join(base, name)
+            elif is_dir:
+                yield from _walk(os.path.join(base, name), rest, cache)
+
+
+class PathSet():
+    """Lazy iterable of the paths matching a glob pattern."""
+    def __init__(self, pattern, cache=None):
+        self.pattern = pattern
+        self.cache = ScanCache() if cache is None else cache
+
+    def __iter__(self):
+        return expand(self.pattern, self.cache)
+
+    def __repr__(self):
+        return 'PathSet({!r})'.format(self.pattern)
@@ -0,0 +1,209 @@
+"""Time the phases of each command, write a Chrome trace viewable in Perfetto,
+or measure their memory allocations with tracemalloc.
+
+    handler.tracers.append(Profiler('trace.json'))
+    ...
+    profiler.close()
+"""
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # Not on Unix
+    resource = None
+
+REPORT_VERSION = 1
+
+
+class Profiler():
+    """Tracer recording spans as Chrome trace events with perf_counter_ns.
+
+    Command spans contain the phases build_opts, parse, the getopt loop and
+    positional arguments, convert, the conversion of option values, and call,
+    the command body. A startup span covers the time from libcli import to
+    the creation of the profiler, which includes importing and registering
+    the commands.
+    With pstats set, command bodies are profiled by cProfile, statistics are
+    dumped to that file on close.
+    """
+    def __init__(self, path, *, pstats=None, start_ns=None):
+        self.path = path
+        self.pid = os.getpid()
+        self.events = []
+        now = time.perf_counter_ns()
+        if start_ns is not None:
+            self.events.append({'name': 'startup', 'cat': 'phase', 'ph': 'X', \
+                'ts': start_ns / 1000, 'dur': (now - start_ns) / 1000, \
+                'pid': self.pid, 'tid': threading.get_ident()})
+        self.pstats = pstats
+        self.profile = None
+        if pstats is not None:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.depth = 0
+            self.lock = threading.Lock()
+
+    def enter(self, name, cat):
+        self.events.append({'name': name, 'cat': cat, 'ph': 'B', \
+            'ts': time.perf_counter_ns() / 1000, 'pid': self.pid, \
+            'tid': threading.get_ident()})
+        if self.profile is not None and name == 'call':
+            with self.lock:
+                # Only one profiler could be active, shared by threads
+                if not self.depth:
+                    self.profile.enable()
+                self.depth += 1
+
+    def exit(self, name, cat, exc=None):
+        ts = time.perf_counter_ns() / 1000
+        if self.profile is not None and name == 'call':
+            with self.lock:
+                self.depth -= 1
+                if not self.depth:
+                    self.profile.disable()
+        event = {'name': name, 'cat': cat, 'ph': 'E', 'ts': ts, \
+            'pid': self.pid, 'tid': threading.get_ident()}
+        if exc is not None:
+            event['args'] = {'error': repr(exc)}
+        self.events.append(event)
+
+    def close(self):
+        """Write the trace, and the statistics if any."""
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        if self.profile is not None:
+            self.profile.dump_stats(self.pstats)
+
+
+def _maxrss():
+    """Peak resident set size of this process in bytes, None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class MemoryProfiler():
+    """Tracer measuring memory allocated by commands and their phases with
+    tracemalloc, tracing from its creation to close.
+
+    For each command name, net is the memory retained after the command,
+    and peak the highest memory above the start of the command, summed and
+    maximal over calls, the same for each phase. Snapshots taken around each
+    command give the top allocation sites of the retained memory, with frames
+    frames of traceback. maxrss is the peak resident set size after the
+    command. Allocations are process wide, concurrent commands of threads
+    are attributed to each other.
+    """
+    def __init__(self, path, *, top=10, frames=1):
+        self.path = path
+        self.top = top
+        self.commands = {}
+        self.order = []
+        # Highest traced memory, the peak of tracemalloc is reset by spans
+        self.peak = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start(frames)
+        self.filters = [tracemalloc.Filter(False, tracemalloc.__file__), \
+            tracemalloc.Filter(False, __file__)]
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def enter(self, name, cat):
+        stack = self._stack()
+        snapshot = None
+        if cat == 'command':
+            snapshot = tracemalloc.take_snapshot().filter_traces(self.filters)
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1][2] = max(stack[-1][2], peak)
+        tracemalloc.reset_peak()
+        # [name, start, highest peak, snapshot]
+        stack.append([name, current, current, snapshot])
+
+    def exit(self, name, cat, exc=None):
+        current, peak = tracemalloc.get_traced_memory()
+        stack = self._stack()
+        if not stack: # Added within the span
+            return
+        name, start, highest, snapshot = stack.pop()
+        highest = max(highest, peak)
+        self.peak = max(self.peak, highest)
+        if stack:
+            stack[-1][2] = max(stack[-1][2], highest)
+        net, peak = current - start, highest - start
+        if cat == 'command':
+            top = tracemalloc.take_snapshot().filter_traces(self.filters).\
+                compare_to(snapshot, 'traceback')[:self.top]
+            self.record(name, net, peak, top, _maxrss())
+        else:
+            with self._lock:
+                command = self.entry(stack[-1][0] if stack else '')
+                phase = command['phases'].setdefault(name, {'calls': 0, \
+                    'net': 0, 'peak': 0})
+                phase['calls'] += 1
+                phase['net'] += net
+                phase['peak'] = max(phase['peak'], peak)
+        tracemalloc.reset_peak()
+
+    def entry(self, name):
+        if name not in self.commands:
+            self.commands[name] = {'calls': 0, 'net': 0, 'peak': 0, \
+                'maxrss': None, 'phases': {}, 'sites': {}}
+            self.order.append(name)
+        return self.commands[name]
+
+    def record(self, name, net, peak, top, maxrss):
+        with self._lock:
+            command = self.entry(name)
+            command['calls'] += 1
+            command['net'] += net
+            command['peak'] = max(command['peak'], peak)
+            command['maxrss'] = maxrss
+            for i in top:
+                if i.size_diff <= 0:
+                    continue
+                site = '\n'.join('{}:{}'.format(x.filename, x.lineno) \
+                    for x in i.traceback)
+                size, count = command['sites'].get(site, (0, 0))
+                command['sites'][site] = (size + i.size_diff, \
+                    count + i.count_diff)
+
+    def report(self):
+        """Return the report, commands in order of first call."""
+        commands = []
+        with self._lock:
+            for name in self.order:
+                command = dict(self.commands[name])
+                sites = sorted(command.pop('sites').items(), \
+                    key=lambda x: x[1][0], reverse=True)[:self.top]
+                command['top'] = [{'site': k, 'size': v[0], 'count': v[1]} \
+                    for k, v in sites]
+                command['phases'] = {k: dict(v) for k, v in \
+                    command['phases'].items()}
+                commands.append(dict({'name': name}, **command))
+        return {'version': REPORT_VERSION, 'pid': os.getpid(), \
+            'peak': self.peak, 'maxrss': _maxrss(), 'commands': commands}
+
+    def close(self):
+        """Stop tracing if started by the profiler, write the report."""
+        report = self.report()
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+        with open(self.path, 'w') as f:
+            json.dump(report, f, indent=1)
@@ -0,0 +1,390 @@
+"""Serve an OptionHandler over a Unix domain socket.
+
+A request carries argv, environment and working directory of the client,
+with its stdin, stdout and stderr passed as file descriptors.
+The response carries the exit code.
+
+Server handles requests with a pool of forked workers,
+ForkServer forks a fresh child for each request.
+"""
+import io
+import json
+import logging
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+
+_logger = logging.getLogger(__name__)
+
+PROTOCOL_VERSION = 1
+# Exit code of a request the server could not understand
+EXIT_PROTOCOL = 126
+# Global options applying to a single request, the others set up the server
+# or the whole process
+REQUEST_OPTIONS = {'output', 'jobs', 'chunksize', 'checkpoint', \
+    'checkpoint-every', 'resume'}
+
+_header = struct.Struct('!I')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def send_message(sock, message, fds=()):
+    data = json.dumps(message).encode('utf-8')
+    data = _header.pack(len(data)) + data
+    if fds:
+        sent = socket.send_fds(sock, [data], list(fds))
+        data = data[sent:]
+    if data:
+        sock.sendall(data)
+
+
+def recv_message(sock, maxfds=0):
+    data, fds = b'', []
+    while len(data) < _header.size:
+        if maxfds and not fds:
+            chunk, fds, flags, addr = socket.recv_fds(sock, 65536, maxfds)
+        else:
+            chunk = sock.recv(65536)
+        if not chunk:
+            raise ProtocolError('Connection closed')
+        data += chunk
+    size, = _header.unpack_from(data)
+    data = data[_header.size:]
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ProtocolError('Connection closed')
+        data += chunk
+    try:
+        return json.loads(data.decode('utf-8')), fds
+    except ValueError as ex:
+        raise ProtocolError('Malformed message: {}'.format(ex))
+
+
+class _Stdio():
+    """Redirect stdio of this process to fds, restore on exit."""
+    def __init__(self, fds):
+        self.fds = fds
+
+    def __enter__(self):
+        for i in (sys.stdout, sys.stderr):
+            i.flush()
+        self.saved = [os.dup(i) for i in range(3)]
+        self.streams = sys.stdin, sys.stdout, sys.stderr
+        for i, fd in enumerate(self.fds):
+            os.dup2(fd, i)
+        sys.stdin = io.TextIOWrapper(open(0, 'rb', closefd=False))
+        sys.stdout = io.TextIOWrapper(open(1, 'wb', closefd=False), \
+            line_buffering=True)
+        sys.stderr = io.TextIOWrapper(open(2, 'wb', closefd=False), \
+            line_buffering=True)
+
+    def __exit__(self, *exc):
+        for i in (sys.stdout, sys.stderr):
+            try:
+                i.flush()
+            except OSError:
+                pass
+        sys.stdin, sys.stdout, sys.stderr = self.streams
+        for i, fd in enumerate(self.saved):
+            os.dup2(fd, i)
+            os.close(fd)
+
+
+class Server():
+    """Load an OptionHandler once, serve requests on a Unix domain socket
+    with a pool of forked worker processes.
+
+    Each worker handles one request at a time, so that it could switch to
+    the working directory, environment and stdio of the client.
+    With idle_timeout set, the server exits after that many seconds
+    without requests.
+    """
+    poll_interval = 0.2
+
+    def __init__(self, handler, path, *, workers=None, idle_timeout=None, \
+            logger=None):
+        self.handler = handler
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.idle_timeout = idle_timeout
+        self.logger = _logger if logger is None else logger
+        self.sock = None
+
+    def bind(self):
+        # Build every spec once, workers inherit them
+        self.handler.build_opts()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(max(16, self.workers * 4))
+        # Activity shared by workers, for idle shutdown
+        self.last_active = multiprocessing.Value('d', time.monotonic())
+        self.busy = multiprocessing.Value('i', 0)
+
+    def serve_forever(self):
+        if self.sock is None:
+            self.bind()
+        children = {}
+        stopping = []
+        def stop(signum, frame):
+            stopping.append(signum)
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+        handler = signal.signal(signal.SIGTERM, stop)
+        try:
+            for i in range(self.workers):
+                pid = self.spawn()
+                children[pid] = i
+            while children:
+                pid, status = os.wait()
+                children.pop(pid, None)
+                if os.waitstatus_to_exitcode(status) != 0 and not stopping:
+                    self.logger.error('Worker {} died with status {}'.format( \
+                        pid, os.waitstatus_to_exitcode(status)))
+                    children[self.spawn()] = None
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+            self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            return pid
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.work()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def idle(self):
+        if self.idle_timeout is None or self.busy.value:
+            return False
+        return time.monotonic() - self.last_active.value > self.idle_timeout
+
+    def work(self):
+        self.sock.settimeout(self.poll_interval)
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.timeout:
+                if self.idle():
+                    return
+                continue
+            with self.busy.get_lock():
+                self.busy.value += 1
+            try:
+                with conn:
+                    conn.settimeout(None)
+                    self.handle(conn)
+            except (OSError, ProtocolError) as ex:
+                self.logger.error('Request failed: {}'.format(ex))
+            finally:
+                with self.busy.get_lock():
+                    self.busy.value -= 1
+                    self.last_active.value = time.monotonic()
+
+    def handle(self, conn):
+        request, fds = recv_message(conn, maxfds=3)
+        try:
+            if self.check(conn, request, fds):
+                status = self.execute(request, fds)
+                send_message(conn, {'version': PROTOCOL_VERSION, \
+                    'status': status})
+        finally:
+            for i in fds:
+                os.close(i)
+
+    def check(self, conn, request, fds):
+        """Reply with an error and return False if request is not valid."""
+        if request.get('version') != PROTOCOL_VERSION:
+            error = 'Unsupported protocol version "{}"'.format( \
+                request.get('version'))
+        elif len(fds) != 3:
+            error = 'Request should pass stdin, stdout and stderr'
+        elif not isinstance(request.get('argv'), list) or not request['argv']:
+            error = 'Request should pass argv'
+        else:
+            return True
+        send_message(conn, {'version': PROTOCOL_VERSION, \
+            'status': EXIT_PROTOCOL, 'error': error})
+        return False
+
+    def execute(self, request, fds):
+        cwd = os.getcwd()
+        environ = dict(os.environ)
+        try:
+            with _Stdio(fds):
+                try:
+                    os.chdir(request.get('cwd', cwd))
+                    os.environ.clear()
+                    os.environ.update(request.get('env', environ))
+                    from .opttools import OptionError, parse_global
+                    try:
+                        settings, argv = parse_global(request['argv'])
+                        if 'complete' in settings:
+                            # Dynamic values for shell completion
+                            self.handler._complete(argv[1:])
+                            return 0
+                        unsupported = sorted(set(settings) - REQUEST_OPTIONS)
+                        if unsupported:
+                            raise OptionError('Option "--libcli-{}" is not '\
+                                'supported by a server request'.format( \
+                                unsupported[0]))
+                        ctx = self.handler._context(settings, argv, \
+                            self.logger)
+                    except OptionError as ex:
+                        self.logger.error(ex)
+                        return 127
+                    return self.handler._invoke(argv, None, \
+                        logger=self.logger, debug=False, ctx=ctx)
+                except SystemExit as ex:
+                    if ex.code is None or isinstance(ex.code, int):
+                        return ex.code or 0
+                    print(ex.code, file=sys.stderr)
+                    return 1
+                except Exception:
+                    traceback.print_exc()
+                    return 1
+        finally:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+
+
+class ForkServer(Server):
+    """Load an OptionHandler once, fork a child for each request.
+
+    The child runs in a fresh copy-on-write copy of the loaded server,
+    global state changed or memory leaked by a command ends with it.
+    workers limits the number of running children, further requests wait.
+    """
+    def serve_forever(self):
+        if self.sock is None:
+            self.bind()
+        self.sock.setblocking(False)
+        # Wake up the selector when a child exits
+        wakeup_r, wakeup_w = socket.socketpair()
+        wakeup_r.setblocking(False)
+        wakeup_w.setblocking(False)
+        sigchld = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        wakeup = signal.set_wakeup_fd(wakeup_w.fileno())
+        selector = selectors.DefaultSelector()
+        selector.register(wakeup_r, selectors.EVENT_READ)
+        children = {}
+        last_active = time.monotonic()
+        try:
+            while True:
+                accepting = len(children) < self.workers
+                if accepting:
+                    selector.register(self.sock, selectors.EVENT_READ)
+                timeout = None
+                if self.idle_timeout is not None and not children:
+                    timeout = max(0, last_active + self.idle_timeout \
+                        - time.monotonic())
+                events = selector.select(timeout)
+                if accepting:
+                    selector.unregister(self.sock)
+                if not events and not children and timeout is not None:
+                    return
+                for key, mask in events:
+                    if key.fileobj is wakeup_r:
+                        while True:
+                            try:
+                                if not wakeup_r.recv(4096):
+                                    break
+                            except BlockingIOError:
+                                break
+                    else:
+                        self.accept(children)
+                while children:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                    if pid == 0:
+                        break
+                    self.reply(children.pop(pid), status)
+                    last_active = time.monotonic()
+        finally:
+            signal.set_wakeup_fd(wakeup)
+            signal.signal(signal.SIGCHLD, sigchld)
+            selector.close()
+            wakeup_r.close()
+            wakeup_w.close()
+            for pid, conn in children.items():
+                os.kill(pid, signal.SIGTERM)
+                self.reply(conn, os.waitpid(pid, 0)[1])
+            self.close()
+
+    def accept(self, children):
+        try:
+            conn, addr = self.sock.accept()
+        except BlockingIOError:
+            return
+        fds = []
+        try:
+            conn.setblocking(True)
+            conn.settimeout(self.poll_interval * 25)
+            request, fds = recv_message(conn, maxfds=3)
+            if not self.check(conn, request, fds):
+                conn.close()
+                return
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    signal.set_wakeup_fd(-1)
+                    self.sock.close()
+                    conn.close()
+                    status = self.execute(request, fds)
+                finally:
+                    os._exit(status)
+            children[pid] = conn
+        except (OSError, ProtocolError) as ex:
+            self.logger.error('Request failed: {}'.format(ex))
+            conn.close()
+        finally:
+            for i in fds:
+                os.close(i)
+
+    def reply(self, conn, status):
+        status = os.waitstatus_to_exitcode(status)
+        if status < 0: # Killed by a signal
+            status = 128 - status
+        try:
+            send_message(conn, {'version': PROTOCOL_VERSION, 'status': status})
+        except OSError as ex:
+            self.logger.error('Reply failed: {}'.format(ex))
+        finally:
+            conn.close()
+
+
+def serve(handler, path, *, mode='prefork', **kwargs):
+    if mode == 'prefork':
+        Server(handler, path, **kwargs).serve_forever()
+    elif mode == 'fork':
+        ForkServer(handler, path, **kwargs).serve_forever()
+    else:
+        raise ValueError('Unknown server mode "{}"'.format(mode))
@@ -0,0 +1,163 @@
+"""Interactive shell keeping the handler and the chained object resident."""
+import inspect
+import logging
+import os
+import shlex
+import sys
+
+from .opttools import Context, OptionError, carries, run_coroutine
+
+_logger = logging.getLogger(__name__)
+
+
+class Shell():
+    """Read command lines, dispatch each one as the continuation of the chain.
+
+    The object chained by a line is passed to the commands of the next line,
+    a line resulting in None keeps the previous object.
+    """
+    def __init__(self, handler, *, prompt=None, history=None, logger=None, \
+            debug=False):
+        self.handler = handler
+        self.prompt = prompt
+        self.history = history
+        self.logger = _logger if logger is None else logger
+        self.debug = debug
+        # Files and maps referred to by the object kept across lines
+        self.kept = []
+
+    def candidates(self, line, text):
+        """Completions of the word text at the end of line."""
+        words = shlex.split(line[:len(line)-len(text)], posix=True) \
+            if line[:len(line)-len(text)].strip() else []
+        # Options of the last command on the line
+        command = None
+        for i in words:
+            if i in self.handler._command:
+                command = self.handler._command[i]
+        if text.startswith('-'):
+            if command is None:
+                command = self.handler._default
+            if command is None:
+                return []
+            command.build_opts()
+            return sorted(y for x in command.opts.values() \
+                for y in x['alias'] if y.startswith(text))
+        return sorted(x for x in self.handler._command if x.startswith(text))
+
+    def complete(self, text, state):
+        import readline
+        try:
+            matches = self.candidates(readline.get_line_buffer()[ \
+                :readline.get_endidx()], text)
+        except ValueError: # Unbalanced quotes
+            return None
+        return matches[state] + ' ' if state < len(matches) else None
+
+    def lines(self, stream):
+        if stream is not None:
+            yield from stream
+            return
+        if not sys.stdin.isatty():
+            yield from sys.stdin
+            return
+        try:
+            import readline
+        except ImportError:
+            readline = None
+        if readline is not None:
+            readline.set_completer(self.complete)
+            readline.set_completer_delims(' \t\n')
+            readline.parse_and_bind('tab: complete')
+            if self.history is not None:
+                try:
+                    readline.read_history_file(self.history)
+                except OSError:
+                    pass
+        try:
+            while True:
+                try:
+                    yield input(self.prompt)
+                except EOFError:
+                    print(file=sys.stderr)
+                    return
+                except KeyboardInterrupt:
+                    print(file=sys.stderr)
+        finally:
+            if readline is not None and self.history is not None:
+                readline.write_history_file(self.history)
+
+    def dispatch(self, func, *args):
+        """Return the result of func and 0, or None and the exit code."""
+        handler = self.handler
+        try:
+            return func(*args), 0
+        except tuple(handler._error) as exc:
+            self.logger.error(repr(exc))
+            return None, handler._errno(exc)
+        except () if self.debug else OptionError as ex:
+            self.logger.error(ex)
+            return None, 127
+
+    def run(self, argv, *, last=None, stream=None, settings=None):
+        """Run argv as the first line, then each line read from stream,
+        or from stdin if stream is None. Return the last exit code.
+        """
+        argv = list(argv)
+        prog = argv[0] if argv else ''
+        if self.prompt is None:
+            self.prompt = '{}> '.format(os.path.basename(prog))
+        handler = self.handler
+        def first(ctx):
+            if callable(handler._default):
+                ret, i = handler._default.call_at(argv, 0, last=last, ctx=ctx)
+                if inspect.iscoroutine(ret):
+                    ret = run_coroutine(ret)
+            else:
+                ret, i = last, 1
+            return handler._chain(argv, i, ret, ctx)
+        try:
+            last, errno = self.dispatch(self.line, first, settings)
+            if errno:
+                return errno
+            for line in self.lines(stream):
+                try:
+                    words = shlex.split(line, comments=True)
+                except ValueError as ex:
+                    self.logger.error(ex)
+                    errno = 127
+                    continue
+                if not words:
+                    continue
+                ret, errno = self.dispatch(self.line, lambda ctx: \
+                    handler._chain([prog] + words, 1, last, ctx), settings)
+                if ret is not None:
+                    last = ret
+            return errno
+        finally:
+            while self.kept:
+                self.kept.pop().close()
+
+    def line(self, func, settings):
+        """Run func(ctx) with a context of its own, closed after the output
+        of the line, except for the files and maps the result refers to,
+        kept while it is the chained object. Return the result, None if it
+        is the last stream stage, drained.
+        """
+        ctx = Context(settings, tracers=self.handler.tracers)
+        try:
+            ret = func(ctx)
+            drained = bool(ctx.streams) and ret is ctx.streams[-1]
+            self.handler._output(ret, ctx)
+            if drained or ret is None:
+                return None
+            kept = [x for x in self.kept + ctx.resources if carries(ret, x)]
+            for i in self.kept:
+                if not any(x is i for x in kept):
+                    i.close()
+            ctx.resources = [x for x in ctx.resources \
+                if not any(x is y for y in kept)]
+            self.kept = kept
+            return ret
+        finally:
+            ctx.close()
@@ -0,0 +1,192 @@
+"""Cache the built specs of the commands of a handler on disk, with the files
+rendered from them, refreshed when a source file of the commands changes.
+
+The cache of a tool is a directory, by default under $XDG_CACHE_HOME/libcli,
+created by --libcli-completion or --help, which refresh it when stale, as
+does the completion script when a source file is newer than the index.
+sources.json lists the source files with their modification time and size,
+so that freshness is checked without importing them; sources.txt lists
+their paths for the shell.
+"""
+import os
+import sys
+import zlib
+
+VERSION = 2
+
+
+def cache_dir(prog):
+    """Default cache directory of the tool run as prog."""
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.abspath(prog)
+    # Computed by every run, crc32 avoids importing hashlib
+    return os.path.join(base, 'libcli', '{}-{:08x}'.format(os.path.basename( \
+        path), zlib.crc32(path.encode('utf-8', 'surrogateescape'))))
+
+
+def for_prog(prog):
+    """SpecCache of the tool run as prog in its default directory."""
+    return SpecCache(cache_dir(prog), os.path.basename(prog))
+
+
+def commands(handler):
+    """Pairs of the name and the CommandHandler, "" for the default."""
+    ret = []
+    if handler._default is not None:
+        ret.append(('', handler._default))
+    ret.extend(handler._command.items())
+    return ret
+
+
+def has_arg(command, alias):
+    """0, 1 or 2 if alias of an option of command takes no, a required or
+    an optional value.
+    """
+    from . import getopt
+    if alias.startswith('--'):
+        for i in command.longopts:
+            if i.name == alias[2:]:
+                return i.has_arg.value
+        return None
+    i = command.shortopts.find(alias[1])
+    if i < 0 or alias[1] in '+-:':
+        return None
+    if command.shortopts.startswith('::', i + 1):
+        return getopt.optional_argument.value
+    elif command.shortopts.startswith(':', i + 1):
+        return getopt.required_argument.value
+    return getopt.no_argument.value
+
+
+def describe(handler):
+    """Build every spec, return them as a JSON serializable dict."""
+    import inspect
+    specs = {}
+    for name, command in commands(handler):
+        command.build_opts()
+        options = {}
+        for opt, info in command.opts.items():
+            aliases = info.get('alias', [])
+            if not aliases: # Typed positional arguments only
+                continue
+            options[opt] = {
+                'alias': {x: has_arg(command, x) for x in aliases},
+                'type': list(info.get('type', [])),
+                'help': info.get('help'),
+                'default': info.get('default'),
+                'complete': opt in command.completers,
+                }
+        fas = command.argspec
+        args = [x for x in fas.args if x != 'self']
+        specs[name] = {
+            'name': command.name,
+            'doc': inspect.getdoc(command._func),
+            'args': args,
+            'required': args[:len(args) - len(fas.defaults or ())],
+            'varargs': fas.varargs,
+            'options': options,
+            }
+    return {'version': VERSION, 'commands': specs}
+
+
+def sources(handler):
+    """Source files of the commands of handler and of the main script."""
+    import inspect
+    paths = set()
+    main = getattr(sys.modules.get('__main__'), '__file__', None)
+    if main is not None:
+        paths.add(os.path.abspath(main))
+    for name, command in commands(handler):
+        try:
+            paths.add(os.path.abspath(inspect.getfile(command._func)))
+        except TypeError: # Built-in or callable object
+            pass
+    return sorted(x for x in paths if os.path.isfile(x))
+
+
+def fingerprint(paths):
+    ret = []
+    for i in paths:
+        try:
+            st = os.stat(i)
+        except OSError:
+            return None
+        ret.append([i, st.st_mtime_ns, st.st_size])
+    return ret
+
+
+def write_atomic(path, data):
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with open(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class SpecCache():
+    """Directory of spec.json, the built specs, with the completion index
+    and the help of prog rendered from them, and sources.json written last.
+    """
+    def __init__(self, path, prog=None):
+        self.path = path
+        self.prog = os.path.basename(sys.argv[0]) if prog is None else prog
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def fresh(self):
+        """Whether the recorded source files are unchanged, without
+        importing them.
+        """
+        import json
+        from . import __version__
+        try:
+            with open(os.path.join(self.path, 'sources.json')) as f:
+                recorded = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return isinstance(recorded, dict) and \
+            recorded.get('version') == VERSION and \
+            recorded.get('libcli') == __version__ and \
+            recorded.get('files') is not None and \
+            fingerprint(x[0] for x in recorded['files']) == recorded['files']
+
+    def load(self, name='spec.json'):
+        """Return the cached specs, or the file name, None if missing."""
+        import json
+        try:
+            with open(os.path.join(self.path, name), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load_help(self):
+        """Return the help texts by command name, "" for the handler."""
+        return self.load('help.json')
+
+    def refresh(self, handler, force=False):
+        """Rebuild the specs and the files rendered from them if stale,
+        return whether they were rebuilt.
+        """
+        if not force and self.fresh():
+            return False
+        import json
+        from . import __version__, complete, usage
+        paths = sources(handler)
+        files = fingerprint(paths)
+        spec = describe(handler)
+        os.makedirs(self.path, exist_ok=True)
+        write_atomic(os.path.join(self.path, 'spec.json'), json.dumps(spec))
+        complete.write_index(spec, os.path.join(self.path, 'complete.idx'))
+        write_atomic(os.path.join(self.path, 'help.json'), json.dumps( \
+            usage.render(spec, self.prog)))
+        write_atomic(os.path.join(self.path, 'sources.txt'), \
+            ''.join(x + '\n' for x in paths))
+        write_atomic(os.path.join(self.path, 'sources.json'), json.dumps({ \
+            'version': VERSION, 'libcli': __version__, 'files': files}))
+        return True
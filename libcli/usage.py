@@ -0,0 +1,176 @@
+"""Usage and help of a handler and its commands, rendered from the specs of
+libcli.spec and stored in its cache, so that
+
+    $ ./tool.py --help
+    $ ./tool.py cmd --help
+
+are answered by libcli.fast_help, called before the modules of the commands
+are imported, if the cache is fresh.
+"""
+import os
+import sys
+
+# Column of the help of arguments, options and commands
+COLUMN = 24
+
+
+def description(doc):
+    """Docstring without the :param, :type and :return fields."""
+    if not doc:
+        return ''
+    lines = []
+    for line in doc.splitlines():
+        if line.startswith(':'):
+            break
+        lines.append(line)
+    return '\n'.join(lines).strip()
+
+
+def summary(doc):
+    """First line of a docstring."""
+    text = description(doc)
+    return text.splitlines()[0] if text else ''
+
+
+def metavar(name):
+    return name.upper()
+
+
+def row(head, text):
+    if not text:
+        return '  ' + head
+    elif len(head) + 4 > COLUMN:
+        return '  {}\n{}{}'.format(head, ' ' * COLUMN, text)
+    return '  {:<{}}{}'.format(head, COLUMN - 2, text)
+
+
+def option_head(name, option):
+    heads = []
+    for alias, has_arg in option['alias'].items():
+        if has_arg is None:
+            continue
+        sep = '=' if alias.startswith('--') else ' '
+        if has_arg == 1:
+            heads.append('{}{}{}'.format(alias, sep, metavar(name)))
+        elif has_arg == 2:
+            heads.append('{}[{}{}]'.format(alias, sep.strip(), metavar(name)))
+        else:
+            heads.append(alias)
+    return ', '.join(heads)
+
+
+def option_text(option):
+    text = option['help'] or ''
+    if option['default'] is not None:
+        text = '{}{}(default: {})'.format(text, ' ' if text else '', \
+            option['default'])
+    return text
+
+
+def has_help(command):
+    """Whether command defines --help itself."""
+    return any('--help' in x['alias'] for x in command['options'].values())
+
+
+def synopsis(command):
+    words = []
+    options = command['options']
+    if any(x not in command['args'] and x != command['varargs'] \
+            for x in options):
+        words.append('[OPTION]...')
+    for name in command['args']:
+        if name in command['required']:
+            words.append(metavar(name))
+        else:
+            words.append('[{}]'.format(metavar(name)))
+    if command['varargs'] is not None:
+        words.append('[{}]...'.format(metavar(command['varargs'])))
+    return ' '.join(words)
+
+
+def body(command):
+    """Description, arguments and options of command."""
+    parts = []
+    text = description(command['doc'])
+    if text:
+        parts.append(text)
+    positional = command['args'] + ([command['varargs']] \
+        if command['varargs'] is not None else [])
+    rows = [row(metavar(x), command['options'][x]['help'] \
+        if x in command['options'] else None) for x in positional]
+    if rows:
+        parts.append('arguments:\n' + '\n'.join(rows))
+    rows = [row(option_head(k, v), option_text(v)) \
+        for k, v in command['options'].items() if k not in positional]
+    if rows:
+        parts.append('options:\n' + '\n'.join(rows))
+    return parts
+
+
+def command_help(prog, name, command):
+    parts = ['usage: {} {} {}'.format(prog, name, synopsis(command)).rstrip()]
+    return '\n\n'.join(parts + body(command)) + '\n'
+
+
+def handler_help(prog, spec):
+    commands = {k: v for k, v in spec['commands'].items() if k}
+    default = spec['commands'].get('')
+    usages = []
+    if default is not None:
+        usages.append('{} {}'.format(prog, synopsis(default)).rstrip())
+    if commands:
+        usages.append('{} COMMAND [ARG]... [COMMAND [ARG]...]...'.format(prog))
+    parts = ['usage: ' + '\n       '.join(usages or [prog])]
+    if default is not None:
+        parts.extend(body(default))
+    if commands:
+        parts.append('commands:\n' + '\n'.join(row(k, summary(v['doc'])) \
+            for k, v in commands.items()))
+        parts.append('Run "{} COMMAND --help" for the help of COMMAND.'.\
+            format(prog))
+    return '\n\n'.join(parts) + '\n'
+
+
+def render(spec, prog):
+    """Help of the handler, key "", and of each command, by name, except
+    the ones defining --help.
+    """
+    texts = {}
+    default = spec['commands'].get('')
+    if default is None or not has_help(default):
+        texts[''] = handler_help(prog, spec)
+    for name, command in spec['commands'].items():
+        if name and not has_help(command):
+            texts[name] = command_help(prog, name, command)
+    return texts
+
+
+def help_key(argv):
+    """Key of the help asked by argv, "" or a command name, None if not."""
+    if len(argv) == 2 and argv[1] == '--help':
+        return ''
+    elif len(argv) == 3 and argv[2] == '--help' and \
+            not argv[1].startswith('-'):
+        return argv[1]
+    return None
+
+
+def print_cached(argv):
+    """Print the cached help asked by argv of the script run as __main__,
+    return whether it was.
+    """
+    key = help_key(argv)
+    main = getattr(sys.modules.get('__main__'), '__file__', None)
+    if key is None or main is None or os.environ.get('LIBCLI_NO_FAST_HELP') \
+            or os.path.abspath(main) != os.path.abspath(argv[0]):
+        return False
+    from . import spec
+    cache = spec.for_prog(argv[0])
+    if not cache.exists() or not cache.fresh():
+        return False
+    texts = cache.load_help()
+    if not isinstance(texts, dict) or not isinstance(texts.get(key), str):
+        return False
+    sys.stdout.write(texts[key])
+    sys.stdout.flush()
+    return True
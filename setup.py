@@ -18,6 +18,11 @@ setup(
     author_email='stephen.jin.yee@gmail.com',
 
     packages=['libcli'],
+    # socket.send_fds and tracemalloc.reset_peak
+    python_requires='>=3.9',
+    extras_require={
+        'msgpack': ['msgpack'],
+        },
     test_suite = 'tests',
 
     classifiers=[
@@ -0,0 +1,187 @@
+import io
+import logging
+import os
+import sys
+import threading
+import time
+import unittest
+import unittest.mock
+import libcli.opttools as opttools
+import libcli.batch as batch
+
+class TestException32(Exception):
+    pass
+
+
+class TestParallelBatch(unittest.TestCase):
+    def setUp(self):
+        self.opthdr = opttools.OptionHandler()
+        self.opthdr.error(TestException32, errno=32)
+        @self.opthdr.command(n='_n:int')
+        def echo(*args, n=0):
+            time.sleep(0.001 * n)
+            print(' '.join(args), end='')
+            print(os.getpid(), file=sys.stderr)
+            if 'fail' in args:
+                raise TestException32
+        self.lines = ['echo -n{} {}\n'.format((7 * i) % 5, i) for i in range(20)]
+
+    def run_parallel(self, lines, **kwargs):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with unittest.mock.patch('sys.stdout', new=stdout), \
+                unittest.mock.patch('sys.stderr', new=stderr):
+            errnos = self.opthdr.run_batch(lines, **kwargs)
+        return errnos, stdout.getvalue(), stderr.getvalue()
+
+    def test_parallel_thread_ordered(self):
+        errnos, out, err = self.run_parallel(self.lines, workers=4, \
+            max_inflight=3)
+        self.assertEqual(errnos, [0] * 20)
+        self.assertEqual(out, ''.join(str(i) for i in range(20)))
+        self.assertEqual(err, '{}\n'.format(os.getpid()) * 20)
+
+    def test_parallel_process_ordered(self):
+        errnos, out, err = self.run_parallel(self.lines, workers=2, \
+            pool='process')
+        self.assertEqual(errnos, [0] * 20)
+        self.assertEqual(out, ''.join(str(i) for i in range(20)))
+        self.assertNotIn(str(os.getpid()), err.split())
+
+    def test_parallel_errno(self):
+        with self.assertLogs('libcli.opttools', 'ERROR'):
+            errnos, out, err = self.run_parallel(['echo a\n', 'echo fail\n', \
+                'unknown\n', 'echo "b\n', 'echo c\n'], workers=2)
+        self.assertEqual(errnos, [0, 32, 127, 127, 0])
+        self.assertEqual(out, 'afailc')
+
+    def test_parallel_logged_ordered(self):
+        logger = logging.getLogger('test.batch')
+        self.addCleanup(setattr, logger, 'propagate', logger.propagate)
+        logger.propagate = False
+        lines = ['echo -n{} fail {}\n'.format(5 - i, i) for i in range(6)] + \
+            ['echo "x\n']
+        for pool in ('thread', 'process'):
+            stderr = io.StringIO()
+            handler = logging.StreamHandler(stderr)
+            handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+            logger.addHandler(handler)
+            try:
+                with unittest.mock.patch('sys.stdout', new=io.StringIO()), \
+                        unittest.mock.patch('sys.stderr', new=stderr):
+                    errnos = self.opthdr.run_batch(lines, workers=4, \
+                        pool=pool, logger=logger)
+            finally:
+                logger.removeHandler(handler)
+            self.assertEqual(errnos, [32] * 6 + [127])
+            err = stderr.getvalue().splitlines()
+            self.assertEqual(err[1::2][:6], ['ERROR line {}: '\
+                'TestException32()'.format(x) for x in range(1, 7)])
+            self.assertTrue(all(x.isdigit() for x in err[:12:2]))
+            self.assertEqual(err[12], 'ERROR line 7: No closing quotation')
+            self.assertEqual(logger.filters, [])
+
+    def test_parallel_last(self):
+        @self.opthdr.command
+        def prefix(last, word):
+            print('{}{}'.format(last, word), end='')
+        lines = ['prefix {}\n'.format(i) for i in range(10)]
+        for pool in ('thread', 'process'):
+            errnos, out, err = self.run_parallel(lines, workers=3, pool=pool, \
+                last='>')
+            self.assertEqual(errnos, [0] * 10)
+            self.assertEqual(out, ''.join('>{}'.format(i) for i in range(10)))
+
+    def test_parallel_stop_on_error(self):
+        with self.assertLogs('libcli.opttools', 'ERROR'):
+            errnos, out, err = self.run_parallel(['echo a\n', 'echo fail\n'] + \
+                self.lines, workers=2, max_inflight=2, stop_on_error=True)
+        self.assertEqual(errnos, [0, 32])
+        self.assertEqual(out, 'afail')
+
+    def test_parallel_invalid_pool(self):
+        with self.assertRaises(ValueError):
+            self.run_parallel(self.lines, workers=2, pool='fiber')
+
+    def test_thread_stream(self):
+        target = io.StringIO()
+        stream = batch.ThreadStream(io.StringIO())
+        stream.redirect(target)
+        thread = threading.Thread(target=lambda: stream.write('other'))
+        thread.start()
+        thread.join()
+        stream.write('mine')
+        stream.redirect(None)
+        self.assertEqual(target.getvalue(), 'mine')
+        self.assertEqual(stream.getvalue(), 'other')
+
+    def test_run_jobs(self):
+        with unittest.mock.patch('sys.stdin', new=io.StringIO(''.join(self.lines))):
+            errnos, out, err = self.run_parallel(self.lines, workers=3)
+            with self.assertRaises(SystemExit) as cm:
+                with unittest.mock.patch('sys.stdout', new=io.StringIO()) as stdout:
+                    self.opthdr.run(['test', '--libcli-batch=-', \
+                        '--libcli-jobs', '3', '--libcli-pool=thread'])
+        self.assertEqual(cm.exception.code, 0)
+        self.assertEqual(stdout.getvalue(), out)
+
+    def test_run_jobs_invalid(self):
+        with self.assertLogs('libcli.opttools', 'ERROR'):
+            with self.assertRaises(SystemExit) as cm:
+                self.opthdr.run(['test', '--libcli-batch=-', '--libcli-jobs=0'])
+        self.assertEqual(cm.exception.code, 127)
+
+
+class TestMapCommand(unittest.TestCase):
+    def setUp(self):
+        self.opthdr = opttools.OptionHandler()
+        self.calls = []
+        @self.opthdr.command(_map='thread', level='l:int')
+        def process(*files, level=3):
+            self.calls.append(files)
+            return ['{}:{}'.format(x, level) for x in files]
+
+    def test_map_thread(self):
+        self.opthdr.run(['test', '--libcli-chunksize=2', 'process', '-l5', \
+            'a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(self.calls, [('a', 'b'), ('c', 'd'), ('e',)])
+        self.opthdr.run(['test', '--libcli-jobs=3', 'process', \
+            'a', 'b', 'c', 'd', 'e', 'f', 'g'])
+        self.assertEqual(len(self.calls), 3 + 7)
+
+    def test_map_chained(self):
+        @self.opthdr.default
+        class Prefix():
+            def __str__(self):
+                return 'p'
+        @self.opthdr.command(_map='thread', _name='join')
+        def join(self, *files):
+            return [str(self) + x for x in files]
+        self.opthdr.run(['test', '--libcli-chunksize=1', 'join', 'x', 'y'])
+        self.assertEqual(self.calls, [])
+        result, argv = self.opthdr._command['join'](['join', 'a', 'b', 'c'], \
+            last=Prefix())
+        self.assertEqual(result, ['pa', 'pb', 'pc'])
+
+    def test_map_process(self):
+        from libcli.batch import map_chunks
+        result = map_chunks(lambda *x: [(y, os.getpid()) for y in x], (), \
+            list('abcdef'), {}, pool='process', workers=2, chunksize=2)
+        self.assertEqual([x[0] for x in result], list('abcdef'))
+        self.assertNotIn(os.getpid(), [x[1] for x in result])
+
+    def test_map_result(self):
+        from libcli.batch import map_chunks
+        self.assertIsNone(map_chunks(lambda *x: None, (), [1, 2, 3], {}))
+        self.assertEqual(map_chunks(lambda *x: len(x), (), [], {}), 0)
+
+    def test_map_invalid(self):
+        with self.assertRaises(opttools.StructureError):
+            self.opthdr.command(_map='fiber')(lambda *x: x)
+        with self.assertRaises(opttools.StructureError):
+            def func(a):
+                pass # pragma no cover
+            opttools.CommandHandler(func, _map='thread')(['func', 'a'])
+
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()
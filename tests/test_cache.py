@@ -0,0 +1,208 @@
+import os
+import tempfile
+import time
+import unittest
+import unittest.mock
+import libcli.opttools as opttools
+import libcli.cache as cache
+
+class TestLRU(unittest.TestCase):
+    def setUp(self):
+        self.mock = unittest.mock.Mock(side_effect=lambda *args, **kwargs: \
+            (args, kwargs))
+
+    def test_lru_invoke(self):
+        lru = cache.LRU(maxsize=2)
+        self.assertEqual(lru.invoke(self.mock, (1, [2]), {'n': 3}), \
+            ((1, [2]), {'n': 3}))
+        self.assertEqual(lru.invoke(self.mock, (1, [2]), {'n': 3}), \
+            ((1, [2]), {'n': 3}))
+        self.assertEqual(self.mock.call_count, 1)
+        self.assertEqual(lru.info(), cache.CacheInfo(1, 1, 2, 1, 0))
+
+    def test_lru_evict_count(self):
+        lru = cache.LRU(maxsize=2)
+        for i in (1, 2, 1, 3, 1, 2):
+            lru.invoke(self.mock, (i,), {})
+        # 2 is evicted by 3, since 1 is used more recently
+        self.assertEqual([x[0] for x in self.mock.call_args_list], \
+            [(1,), (2,), (3,), (2,)])
+
+    def test_lru_evict_bytes(self):
+        lru = cache.LRU(maxsize=None, maxbytes=100, sizeof=len)
+        lru.invoke(lambda n: 'x' * n, (60,), {})
+        lru.invoke(lambda n: 'x' * n, (30,), {})
+        self.assertEqual(lru.info().bytes, 90)
+        lru.invoke(lambda n: 'x' * n, (20,), {})
+        self.assertEqual(lru.info()[3:], (2, 50))
+        # Larger than maxbytes, never stored
+        lru.invoke(lambda n: 'x' * n, (200,), {})
+        self.assertEqual(lru.info()[3:], (2, 50))
+
+    def test_lru_ttl(self):
+        lru = cache.LRU(ttl=0.05)
+        lru.invoke(self.mock, (1,), {})
+        lru.invoke(self.mock, (1,), {})
+        time.sleep(0.06)
+        lru.invoke(self.mock, (1,), {})
+        self.assertEqual(self.mock.call_count, 2)
+
+    def test_lru_chained_identity(self):
+        lru = cache.LRU()
+        a, b = [1], [1]
+        lru.invoke(self.mock, (a, 2), {}, chained=True)
+        lru.invoke(self.mock, (b, 2), {}, chained=True)
+        lru.invoke(self.mock, (a, 2), {}, chained=True)
+        self.assertEqual(self.mock.call_count, 2)
+        lru.invalidate(a, 2)
+        lru.invoke(self.mock, (a, 2), {}, chained=True)
+        self.assertEqual(self.mock.call_count, 3)
+
+    def test_lru_exception(self):
+        lru = cache.LRU()
+        self.mock.side_effect = ValueError
+        for i in range(2):
+            with self.assertRaises(ValueError):
+                lru.invoke(self.mock, (1,), {})
+        self.assertEqual(self.mock.call_count, 2)
+
+    def test_lru_command(self):
+        reports = cache.LRU(maxsize=8)
+        mock = self.mock
+        def create(data, key, value):
+            data[key] = value
+            return data
+        def report(data, *, total=None):
+            mock(total is None)
+            return len(data) if total is None else sum(data.values())
+        create = opttools.CommandHandler(create, key='k:str', value='v:int', \
+            _invalidates=[reports], _='+')
+        report = opttools.CommandHandler(report, total='_t', \
+            _cache=reports, _='+')
+        data = {}
+        create.call_at(['create', 'a', '1'], 0, last=data)
+        self.assertEqual(report.call_at(['report'], 0, last=data), (1, 1))
+        self.assertEqual(report.call_at(['report'], 0, last=data), (1, 1))
+        self.assertEqual(report.call_at(['report', '-t'], 0, \
+            last=data), (1, 2))
+        self.assertEqual(mock.call_count, 2)
+        create.call_at(['create', 'b', '2'], 0, last=data)
+        self.assertEqual(report.call_at(['report', '-t'], 0, \
+            last=data), (3, 2))
+        self.assertEqual(reports.info()[:2], (1, 3))
+
+    def test_lru_stream_command(self):
+        def func():
+            yield 1
+        ch = opttools.CommandHandler(func, _cache=cache.LRU())
+        with self.assertRaises(opttools.StructureError):
+            ch.build_opts()
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.calls = []
+        def upper(src, dst, *, suffix=''):
+            self.calls.append(src)
+            with open(src) as fin, open(dst, 'w') as fout:
+                fout.write(fin.read().upper() + suffix)
+            return len(suffix)
+        self.upper = upper
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name, data=None):
+        path = os.path.join(self.tmpdir.name, name)
+        if data is not None:
+            with open(path, 'w') as f:
+                f.write(data)
+        return path
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def command(self, **kwargs):
+        return opttools.CommandHandler(self.upper, suffix='s:str', \
+            _cache=cache.DiskCache(self.path('cache'), **kwargs), \
+            _inputs=['src'], _outputs=['dst'], _='+')
+
+    def test_diskcache_skip(self):
+        ch = self.command()
+        argv = ['upper', '-s!', self.path('a', 'abc'), self.path('b')]
+        self.assertEqual(ch.call_at(argv, 0), (1, 4))
+        self.assertEqual(ch.call_at(argv, 0), (1, 4))
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.read('b'), 'ABC!')
+        # Outputs missing or changed are restored
+        os.unlink(self.path('b'))
+        self.assertEqual(ch.call_at(argv, 0), (1, 4))
+        self.path('b', 'changed')
+        ch.call_at(argv, 0)
+        self.assertEqual(self.read('b'), 'ABC!')
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(ch.cache.info()[:4], (3, 1, None, 1))
+
+    def test_diskcache_input_changed(self):
+        ch = self.command(content=False)
+        argv = ['upper', self.path('a', 'abc'), self.path('b')]
+        ch.call_at(argv, 0)
+        os.utime(self.path('a', 'xyz'), ns=(0, 0))
+        ch.call_at(argv, 0)
+        self.assertEqual(self.read('b'), 'XYZ')
+        ch.call_at(['upper', '-s?', self.path('a'), self.path('b')], 0)
+        self.assertEqual(len(self.calls), 3)
+        # Shared with another process
+        other = self.command(content=False)
+        other.call_at(argv, 0)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_diskcache_chained_varargs(self):
+        opthdr = opttools.OptionHandler()
+        @opthdr.default
+        def load():
+            return ['a', 'b']
+        @opthdr.command(_cache=cache.DiskCache(self.path('cache')))
+        def count(*items):
+            self.calls.append(items)
+            return len(items)
+        self.assertEqual(opthdr._dispatch(['test', 'count', 'c'], None), 2)
+        self.assertEqual(opthdr._dispatch(['test', 'count', 'c'], None), 2)
+        self.assertEqual(opthdr._dispatch(['test', 'count', 'd'], None), 2)
+        self.assertEqual(self.calls, [(['a', 'b'], 'c'), (['a', 'b'], 'd')])
+
+    def test_diskcache_evict(self):
+        ch = self.command(maxbytes=1)
+        ch.call_at(['upper', self.path('a', 'abc'), self.path('b')], 0)
+        self.assertEqual(ch.cache.info().currsize, 0)
+        ch.call_at(['upper', self.path('a'), self.path('b')], 0)
+        self.assertEqual(len(self.calls), 2)
+        ch.cache.maxbytes = None
+        ch.call_at(['upper', self.path('a'), self.path('b')], 0)
+        self.assertEqual(ch.cache.info().currsize, 1)
+        ch.cache.clear()
+        self.assertEqual(ch.cache.info()[3:], (0, 0))
+
+    def test_diskcache_lazy_root(self):
+        ch = self.command()
+        self.assertFalse(os.path.exists(self.path('cache')))
+        self.assertEqual(ch.cache.info()[3:], (0, 0))
+        ch.cache.clear()
+        argv = ['upper', self.path('a', 'abc'), self.path('b')]
+        ch.call_at(argv, 0)
+        self.assertEqual(ch.cache.info().currsize, 1)
+        # Not writable, the command still runs
+        ch.cache.path = os.path.join(self.path('a'), 'cache')
+        self.assertEqual(ch.call_at(argv, 0), (0, 3))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_diskcache_structure(self):
+        ch = opttools.CommandHandler(self.upper, _inputs=['source'])
+        with self.assertRaises(opttools.StructureError):
+            ch.build_opts()
+
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import tempfile
+import unittest
+import libcli.opttools as opttools
+import libcli.checkpoint as checkpoint
+
+class TestException32(Exception):
+    pass
+
+
+class Counter():
+    def __init__(self):
+        self.steps = []
+
+
+def make_handler(calls, fail=None):
+    opthdr = opttools.OptionHandler()
+    opthdr.error(TestException32, errno=32)
+    @opthdr.default
+    def start():
+        calls.append('start')
+        return Counter()
+    @opthdr.command(n='_:int')
+    def step(counter, n):
+        calls.append(n)
+        if n == fail:
+            raise TestException32
+        counter.steps.append(n)
+        return counter
+    @opthdr.command
+    def show(counter):
+        calls.append(counter.steps)
+    return opthdr
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'chain.ckpt')
+        self.chain = ['step', '1', 'step', '2', 'step', '3', 'step', '4', \
+            'show']
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_chain(self, opthdr, *options):
+        with self.assertRaises(SystemExit) as cm:
+            opthdr.run(['test', '--libcli-checkpoint', self.path] + \
+                list(options) + self.chain)
+        return cm.exception.code
+
+    def test_checkpoint_resume(self):
+        calls = []
+        with self.assertLogs('libcli.opttools'):
+            self.assertEqual(self.run_chain(make_handler(calls, fail=3)), 32)
+        self.assertEqual(calls, ['start', 1, 2, 3])
+        calls = []
+        opthdr = make_handler(calls)
+        opthdr.run(['test', '--libcli-checkpoint', self.path, '--libcli-resume'] \
+            + self.chain)
+        self.assertEqual(calls, [3, 4, [1, 2, 3, 4]])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_checkpoint_every(self):
+        calls = []
+        with self.assertLogs('libcli.opttools'):
+            self.run_chain(make_handler(calls, fail=4), \
+                '--libcli-checkpoint-every=2')
+        calls = []
+        make_handler(calls).run(['test', '--libcli-checkpoint', self.path, \
+            '--libcli-resume'] + self.chain)
+        # Saved after step 1 and step 3, the default counts as a command
+        self.assertEqual(calls, [4, [1, 2, 3, 4]])
+
+    def test_checkpoint_other_argv(self):
+        with self.assertLogs('libcli.opttools'):
+            self.run_chain(make_handler([], fail=2))
+        self.chain[1] = '5'
+        with self.assertLogs('libcli.opttools') as cm:
+            self.assertEqual(self.run_chain(make_handler([]), \
+                '--libcli-resume'), 127)
+        self.assertIn('another command line', cm.output[0])
+
+    def test_checkpoint_resume_required(self):
+        with self.assertRaises(SystemExit) as cm, \
+                self.assertLogs('libcli.opttools'):
+            make_handler([]).run(['test', '--libcli-resume'] + self.chain)
+        self.assertEqual(cm.exception.code, 127)
+
+    def test_checkpoint_resume_missing(self):
+        calls = []
+        make_handler(calls).run(['test', '--libcli-checkpoint', self.path, \
+            '--libcli-resume'] + self.chain)
+        self.assertEqual(calls, ['start', 1, 2, 3, 4, [1, 2, 3, 4]])
+
+    def test_checkpoint_write_error(self):
+        calls = []
+        self.path = os.path.join(self.tmpdir.name, 'missing', 'chain.ckpt')
+        with self.assertLogs('libcli.opttools') as cm:
+            make_handler(calls).run(['test', '--libcli-checkpoint', \
+                self.path] + self.chain)
+        self.assertEqual(calls, ['start', 1, 2, 3, 4, [1, 2, 3, 4]])
+        self.assertIn('Failed to write checkpoint', cm.output[0])
+        # The temporary file is removed when it could not be renamed
+        os.makedirs(self.path)
+        ckpt = checkpoint.Checkpoint(self.path, ['test'])
+        with self.assertLogs('libcli.checkpoint'):
+            ckpt.save(1, [1])
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), \
+            ['chain.ckpt'])
+
+    def test_checkpoint_unpicklable(self):
+        ckpt = checkpoint.Checkpoint(self.path, ['test'])
+        with self.assertLogs('libcli.checkpoint'):
+            ckpt.save(1, lambda: None)
+        self.assertFalse(os.path.exists(self.path))
+        ckpt.save(2, [1])
+        self.assertEqual(ckpt.load(), (2, [1]))
+
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()
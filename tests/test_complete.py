@@ -0,0 +1,134 @@
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import unittest.mock
+import libcli.opttools as opttools
+import libcli.complete as complete
+import libcli.spec as spec
+
+def names(prefix):
+    return ['alice', 'albert', 'bob']
+
+
+class TestComplete(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.opthdr = opttools.OptionHandler()
+        @self.opthdr.command(level='l:int', name='n:str', out='o:path', \
+            verbose='_v', _complete={'name': names})
+        def report(path, *, level=1, name=None, out=None, verbose=None):
+            pass
+        @self.opthdr.command(flag='f:bool')
+        def other(*, flag=False):
+            pass
+        self.cache = spec.SpecCache(os.path.join(self.tmpdir.name, 'cache'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def awk(self, *words):
+        self.cache.refresh(self.opthdr)
+        result = subprocess.run(['awk', complete.AWK, os.path.join( \
+            self.cache.path, 'complete.idx')] + list(words), \
+            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        return result.stdout.splitlines()
+
+    def test_complete_index(self):
+        lines = list(complete.index_lines(spec.describe(self.opthdr)))
+        self.assertEqual(lines[0], 'libcli-index\t1')
+        self.assertIn('c\treport', lines)
+        self.assertIn('o\treport\t-l\t1\t-', lines)
+        self.assertIn('o\treport\t--name\t1\tdynamic', lines)
+        self.assertIn('o\treport\t--out\t1\tfiles', lines)
+        self.assertIn('o\treport\t-v\t0\t-', lines)
+        self.assertIn('o\tother\t--flag\t1\twords:true false', lines)
+        self.assertIn('o\t@\t--libcli-output\t1\twords:ndjson json msgpack', \
+            lines)
+
+    @unittest.skipIf(shutil.which('awk') is None, 'requires awk')
+    def test_complete_awk(self):
+        self.assertEqual(self.awk(''), ['words', 'report', 'other'])
+        self.assertEqual(self.awk('re'), ['words', 'report'])
+        self.assertEqual(self.awk('report', '-l', '3', '--na'), \
+            ['words', '--name'])
+        self.assertEqual(self.awk('report', '--out', ''), ['files'])
+        self.assertEqual(self.awk('report', '-vn', 'a'), \
+            ['dynamic', 'report', '-n'])
+        self.assertEqual(self.awk('other', '--flag', 't'), ['words', 'true'])
+        self.assertEqual(self.awk('--libcli-output', 'j'), ['words', 'json'])
+        self.assertEqual(self.awk('--libcli-jobs', '2', 'ot'), \
+            ['words', 'other'])
+        self.assertEqual(self.awk('report', '--level', ''), ['none'])
+
+    def test_complete_refresh(self):
+        path = os.path.join(self.tmpdir.name, 'commands.py')
+        with open(path, 'w') as f:
+            f.write('def report():\n    pass\n')
+        with unittest.mock.patch.object(spec, 'sources', return_value=[path]):
+            self.assertTrue(self.cache.refresh(self.opthdr))
+            self.assertTrue(self.cache.fresh())
+            self.assertFalse(self.cache.refresh(self.opthdr))
+            with open(path, 'a') as f:
+                f.write('def second():\n    pass\n')
+            self.assertFalse(self.cache.fresh())
+            self.opthdr.command(lambda: None, _name='second')
+            self.assertTrue(self.cache.refresh(self.opthdr))
+        self.assertEqual(sorted(self.cache.load()['commands']), \
+            ['other', 'report', 'second'])
+
+    def test_complete_run(self):
+        with unittest.mock.patch.dict(os.environ, \
+                XDG_CACHE_HOME=self.tmpdir.name), \
+                unittest.mock.patch('sys.stdout', new=io.StringIO()) as out:
+            self.opthdr.run(['test', '--libcli-completion', 'bash'])
+            directory = spec.cache_dir('test')
+            self.assertTrue(out.getvalue().startswith('# bash completion'))
+            self.assertIn(os.path.join(directory, 'complete.idx'), \
+                out.getvalue())
+            self.assertTrue(spec.SpecCache(directory).fresh())
+            out.seek(0)
+            out.truncate()
+            self.opthdr.run(['test', '--libcli-complete', 'report', '-n', \
+                'al'])
+            self.assertEqual(out.getvalue().split(), ['alice', 'albert'])
+        with self.assertRaises(SystemExit) as cm, \
+                self.assertLogs('libcli.opttools'):
+            self.opthdr.run(['test', '--libcli-completion', 'fish'])
+        self.assertEqual(cm.exception.code, 127)
+
+    @unittest.skipIf(shutil.which('bash') is None, 'requires bash')
+    def test_complete_stale(self):
+        path = os.path.join(self.tmpdir.name, 'tool.py')
+        with open(path, 'w') as f:
+            f.write('import libcli\n@libcli.command\ndef report():\n'\
+                '    pass\nlibcli.run()\n')
+        env = dict(os.environ, XDG_CACHE_HOME=self.tmpdir.name, \
+            PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath( \
+                complete.__file__))))
+        script = subprocess.run([sys.executable, path, '--libcli-completion', \
+            'bash'], stdout=subprocess.PIPE, universal_newlines=True, \
+            env=env, check=True).stdout
+        with open(path, 'w') as f:
+            f.write('import libcli\n@libcli.command\ndef second():\n'\
+                '    pass\nlibcli.run()\n')
+        os.utime(path, (0, os.stat(path).st_mtime + 10))
+        result = subprocess.run(['bash', '-c', script + \
+            'COMP_LINE="tool.py s"; COMP_POINT=9; _libcli_tool_py; '\
+            'echo "${COMPREPLY[@]}"'], stdout=subprocess.PIPE, \
+            universal_newlines=True, env=env, check=True)
+        self.assertEqual(result.stdout, 'second\n')
+
+    def test_complete_invalid(self):
+        with self.assertRaises(opttools.StructureError):
+            @self.opthdr.command(_complete={'name': names})
+            def invalid():
+                pass
+            self.opthdr._command['invalid'].build_opts()
+
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()
@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+import libcli.opttools as opttools
+import libcli.config as config
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mock = unittest.mock.MagicMock()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def make_handler(self, path):
+        opthdr = opttools.OptionHandler(env_prefix='TEST_', config=path)
+        @opthdr.command(level='l:int', tags='t:list', verbose='_v')
+        def pack(*, level=3, tags=[], verbose=None, name):
+            self.mock(level, tags, verbose, name)
+        return opthdr
+
+    def test_config_precedence(self):
+        path = self.write('tool.json', json.dumps({'name': 'top', \
+            'pack': {'level': 5, 'tags': ['a', 'b'], 'verbose': True}}))
+        opthdr = self.make_handler(path)
+        with unittest.mock.patch.dict('os.environ', {}, clear=True):
+            opthdr.run(['test', 'pack'])
+            self.mock.assert_called_with(5, ['a', 'b'], '', 'top')
+            os.environ['TEST_NAME'] = 'env'
+            os.environ['TEST_PACK_LEVEL'] = '0x10'
+            opthdr.run(['test', 'pack'])
+            self.mock.assert_called_with(16, ['a', 'b'], '', 'env')
+            opthdr.run(['test', 'pack', '-l', '7', '--name=argv'])
+            self.mock.assert_called_with(7, ['a', 'b'], '', 'argv')
+            os.environ['TEST_PACK_LEVEL'] = 'high'
+            with self.assertRaises(SystemExit) as cm, \
+                    self.assertLogs('libcli.opttools'):
+                opthdr.run(['test', 'pack'])
+            self.assertEqual(cm.exception.code, 127)
+
+    def test_config_ini(self):
+        path = self.write('tool.ini', '[DEFAULT]\nname = ini\n\n'\
+            '[pack]\nlevel = 9\nverbose = no\n')
+        with unittest.mock.patch.dict('os.environ', {}, clear=True):
+            self.make_handler(path).run(['test', 'pack'])
+        self.mock.assert_called_with(9, [], None, 'ini')
+
+    def test_config_missing(self):
+        opthdr = self.make_handler(os.path.join(self.tmpdir.name, 'missing.ini'))
+        with unittest.mock.patch.dict('os.environ', {}, clear=True), \
+                self.assertRaises(SystemExit) as cm, \
+                self.assertLogs('libcli.opttools'):
+            opthdr.run(['test', 'pack'])
+        self.assertEqual(cm.exception.code, 127)
+
+    def test_config_cache(self):
+        path = self.write('tool.json', '{"name": "a"}')
+        with unittest.mock.patch('libcli.config._parse', \
+                wraps=config._parse) as parse:
+            self.assertEqual(config.load(path), {'name': 'a'})
+            self.assertEqual(config.load(path), {'name': 'a'})
+            self.assertEqual(parse.call_count, 1)
+            self.write('tool.json', '{"name": "bc"}')
+            self.assertEqual(config.load(path), {'name': 'bc'})
+            self.assertEqual(parse.call_count, 2)
+        self.write('tool.json', '{"name": ')
+        with self.assertRaises(opttools.OptionError):
+            config.load(path)
+
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()
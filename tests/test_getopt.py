@@ -273,6 +273,21 @@ class TestGetopt(unittest.TestCase):
             self.assertEqual(gi.argv[gi.optind:], ['de', '--', '-a', '-b', '-c'])
             self.assertTrue(stderr.tell() == 0)
 
+    def test_getopt_with_optind(self):
+        with unittest.mock.patch('sys.stderr', new=io.StringIO()) as stderr:
+            argv = "testopt skipped cmd -ab de -c arg -a".split()
+            gi = getopt.iter_getopt(argv, '+ab:c', optind=3)
+            for i in [
+                ('a', 1, '?', 3, None),
+                ('b', 1, '?', 5, 'de'),
+                ('c', 1, '?', 6, None)]:
+                self.assertEqual(i , (gi.__next__(), \
+                    gi.opterr, gi.optopt, gi.optind, gi.optarg))
+            self.assertEqual(list(gi), [])
+            self.assertEqual(gi.argv[gi.optind:], ['arg', '-a'])
+            self.assertEqual(gi.progname, 'cmd')
+            self.assertTrue(stderr.tell() == 0)
+
 
 class TestGetoptLong(unittest.TestCase):
     def setUp(self):
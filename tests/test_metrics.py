@@ -0,0 +1,116 @@
+import io
+import os
+import socket
+import tempfile
+import threading
+import unittest
+import libcli.opttools as opttools
+import libcli.metrics as metrics
+from libcli.cache import LRU
+
+class TestException32(Exception):
+    pass
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'metrics.prom')
+        self.opthdr = opttools.OptionHandler()
+        self.opthdr.error(TestException32, errno=32)
+        @self.opthdr.command(_cache=LRU(), _memo=16, n='n:int')
+        def square(n):
+            return n * n
+        @self.opthdr.command
+        def fail():
+            raise TestException32
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_metrics_snapshot(self):
+        tracer = metrics.Metrics(self.opthdr)
+        self.opthdr.tracers.append(tracer)
+        with self.assertLogs('libcli.opttools'):
+            errnos = self.opthdr.run_batch(io.StringIO('square 2\nsquare 2\n'\
+                'square 3\nfail\nfail\nsquare x\n'), prog='test')
+        self.assertEqual(errnos, [0, 0, 0, 32, 32, 127])
+        snapshot = tracer.snapshot()
+        self.assertEqual(snapshot.calls, {'square': 4, 'fail': 2})
+        self.assertEqual(snapshot.errors, {('fail', 32): 2, ('square', 127): 1})
+        self.assertEqual(snapshot.latency['square', 'total'].count, 4)
+        self.assertEqual(snapshot.latency['square', 'call'].count, 3)
+        self.assertEqual(snapshot.latency['fail', 'parse'].count, 2)
+        self.assertLessEqual(snapshot.latency['square', 'parse'].quantile(0.5), \
+            snapshot.latency['square', 'total'].quantile(1))
+        self.assertEqual(snapshot.caches['square', 'result'][:2], (1, 2))
+        self.assertEqual(snapshot.caches['square', 'parse'][:2], (1, 3))
+
+    def test_metrics_threads(self):
+        tracer = metrics.Metrics(self.opthdr)
+        self.opthdr.tracers.append(tracer)
+        lines = ''.join('square {}\n'.format(x) for x in range(200))
+        errnos = self.opthdr.run_batch(io.StringIO(lines), prog='test', \
+            workers=4)
+        self.assertEqual(errnos, [0] * 200)
+        # One shard per thread, folded once the threads ended
+        self.assertGreater(len(tracer._shards), 1)
+        self.assertEqual(tracer.snapshot().calls, {'square': 200})
+        self.assertEqual(tracer._shards, [])
+
+    def test_metrics_thread_churn(self):
+        tracer = metrics.Metrics(self.opthdr)
+        self.opthdr.tracers.append(tracer)
+        for i in range(50):
+            threads = [threading.Thread(target=self.opthdr._dispatch, \
+                args=(['test', 'square', str(x)], None)) for x in range(10)]
+            for j in threads:
+                j.start()
+            for j in threads:
+                j.join()
+        self.assertLessEqual(len(tracer._shards), 11)
+        snapshot = tracer.snapshot()
+        self.assertEqual(snapshot.calls, {'square': 500})
+        self.assertEqual(snapshot.latency['square', 'total'].count, 500)
+        self.assertLessEqual(len(tracer._shards), 1)
+
+    def test_metrics_file(self):
+        with self.assertRaises(SystemExit) as cm, \
+                self.assertLogs('libcli.opttools'):
+            self.opthdr.run(['test', '--libcli-metrics', self.path, 'fail'])
+        self.assertEqual(cm.exception.code, 32)
+        self.opthdr.run(['test', '--libcli-metrics', self.path, 'square', '3'])
+        with open(self.path) as f:
+            text = f.read()
+        self.assertIn('libcli_command_calls_total{command="square"} 1\n', text)
+        self.assertIn('libcli_phase_seconds_bucket{command="square",'\
+            'phase="call",le="+Inf"} 1\n', text)
+        self.assertIn('libcli_cache_misses_total{command="square",'\
+            'cache="result"} 1\n', text)
+        self.assertNotIn('command="fail"', text)
+        self.assertEqual(self.opthdr.tracers, [])
+
+    def test_metrics_socket(self):
+        path = os.path.join(self.tmpdir.name, 'metrics.sock')
+        tracer = metrics.Metrics(self.opthdr)
+        tracer.serve(path)
+        self.opthdr.tracers.append(tracer)
+        self.opthdr._dispatch(['test', 'square', '4'], None)
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(path)
+            data = b''.join(iter(lambda: sock.recv(4096), b''))
+        self.assertIn(b'libcli_command_calls_total{command="square"} 1\n', data)
+        tracer.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_metrics_invalid(self):
+        with self.assertRaises(SystemExit) as cm, \
+                self.assertLogs('libcli.opttools'):
+            self.opthdr.run(['test', '--libcli-serve', self.path, \
+                '--libcli-serve-mode', 'fork', '--libcli-metrics', self.path])
+        self.assertEqual(cm.exception.code, 127)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()
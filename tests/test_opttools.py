@@ -1,6 +1,8 @@
+import asyncio
 import io
 import os
 import sys
+import tempfile
 import math
 import unittest
 import unittest.mock
@@ -195,6 +197,28 @@ class TestOptionHandler(unittest.TestCase):
             def func(*args):
                 pass # pragma no cover
 
+    def test_optionhandler_command_duplicated_ref(self):
+        @self.opthdr.command
+        def func(*args):
+            pass # pragma no cover
+        lineno = func.__code__.co_firstlineno
+        with self.assertRaisesRegex(opttools.StructureError, \
+                r'at \[.*test_opttools.py:{}\]'.format(lineno)):
+            self.opthdr.command(func)
+
+    def test_optionhandler_source_ref(self):
+        import dis
+        import types
+        ref = opttools.SourceRef(sys._getframe())
+        lineno = sys._getframe().f_lineno - 1
+        self.assertTrue(str(ref).endswith('test_opttools.py:{}'.format(lineno)))
+        # Without code.co_lines
+        code, ref.code = ref.code, types.SimpleNamespace()
+        findlinestarts = dis.findlinestarts
+        with unittest.mock.patch('dis.findlinestarts', \
+                lambda x: findlinestarts(code)):
+            self.assertEqual('{:>8}'.format(ref)[-4:], ':{}'.format(lineno))
+
     def test_optionhandler_default_duplicated_withoud_stack_frame(self):
       with unittest.mock.patch('inspect.currentframe', lambda: None):
         with self.assertRaises(opttools.StructureError):
@@ -378,6 +402,399 @@ class TestOptionHandler(unittest.TestCase):
                 pass # pragma no cover
             self.opthdr.run(['test', '--a', '--b', '--c=foobar'], debug=True)
 
+    def test_optionhandler_coroutine_command(self):
+      with unittest.mock.patch('sys.stdout', new=io.StringIO()) as stdout:
+        @self.opthdr.default(n='_n:int')
+        async def start(*, n=0):
+            await asyncio.sleep(0)
+            return n
+        @self.opthdr.command(n='_n:int')
+        async def add(last, *, n=1):
+            await asyncio.sleep(0)
+            return last + n
+        @self.opthdr.command
+        def value(last):
+            print(last)
+        self.opthdr.run(['test', '-n1', 'add', '-n20', 'value'])
+        asyncio.run(self.opthdr.run_async(['test', 'add', 'value']))
+        self.assertEqual(stdout.getvalue(), '21\n1\n')
+
+    def test_optionhandler_run_async_except_custom(self):
+        with self.assertRaises(SystemExit) as cm:
+            @self.opthdr.default
+            async def func(*args):
+                raise TestException32
+            asyncio.run(self.opthdr.run_async(['test']))
+        self.assertEqual(cm.exception.code, 32)
+
+    def test_optionhandler_run_many_async(self):
+        events = []
+        @self.opthdr.command(n='_n:int')
+        async def wait(*, n=0):
+            events.append(('start', n))
+            await asyncio.sleep(0)
+            events.append(('stop', n))
+            if n == 2:
+                raise TestException32
+        codes = asyncio.run(self.opthdr.run_many_async( \
+            [['test', 'wait', '-n1'], ['test', 'wait', '-n2'], \
+                ['test', 'unknown']]))
+        self.assertEqual(codes, [0, 32, 127])
+        self.assertEqual(events[:2], [('start', 1), ('start', 2)])
+
+    def test_optionhandler_run_batch(self):
+        @self.opthdr.command(key='k:str')
+        def get(*, key):
+            self.mock(key)
+            if key == 'missing':
+                raise TestException32(key)
+        stream = io.StringIO('get -k "a b"\n\n# comment\n'\
+            'get -k missing\nget\nget -k c\n')
+        with self.assertLogs('libcli.opttools', 'ERROR') as cm:
+            errnos = self.opthdr.run_batch(stream)
+        self.assertEqual(errnos, [0, 32, 127, 0])
+        self.assertIn('line 4', cm.output[0])
+        self.assertEqual(self.mock.call_args_list, [unittest.mock.call('a b'), \
+            unittest.mock.call('missing'), unittest.mock.call('c')])
+
+    def test_optionhandler_run_batch_stop_on_error(self):
+        @self.opthdr.command
+        def fail():
+            raise TestException32
+        with self.assertLogs('libcli.opttools', 'ERROR'):
+            errnos = self.opthdr.run_batch(['fail', 'fail'], stop_on_error=True)
+        self.assertEqual(errnos, [32])
+
+    def test_optionhandler_run_batch_stdin(self):
+        @self.opthdr.command
+        def fail():
+            raise TestException32
+        @self.opthdr.command
+        def func():
+            self.mock()
+        with unittest.mock.patch('sys.stdin', new=io.StringIO('func\nfail\nfunc\n')):
+            with self.assertLogs('libcli.opttools', 'ERROR'):
+                with self.assertRaises(SystemExit) as cm:
+                    self.opthdr.run(['test', '--libcli-batch', '-', \
+                        '--libcli-stop-on-error'])
+        self.assertEqual(cm.exception.code, 32)
+        self.mock.assert_called_once_with()
+
+    def test_optionhandler_invalid_global_option(self):
+        with self.assertLogs('libcli.opttools', 'ERROR'):
+            with self.assertRaises(SystemExit) as cm:
+                self.opthdr.run(['test', '--libcli-foobar'])
+        self.assertEqual(cm.exception.code, 127)
+
+    def test_optionhandler_stream_chain(self):
+        events = []
+        @self.opthdr.command(n='n:int')
+        def numbers(*, n=3):
+            try:
+                for i in range(n):
+                    events.append(i)
+                    yield i
+            finally:
+                events.append('closed')
+        @self.opthdr.command
+        def first(items):
+            for i in items:
+                return i
+        @self.opthdr.command
+        def show(value):
+            self.mock(value)
+        self.opthdr.run(['test', 'numbers', '-n', '1000000', 'first', 'show'])
+        self.mock.assert_called_once_with(0)
+        self.assertEqual(events, [0, 'closed'])
+
+    def test_optionhandler_stream_drain_last(self):
+        @self.opthdr.command
+        def numbers():
+            for i in range(3):
+                self.mock(i)
+                yield i
+        @self.opthdr.command(_stream=True)
+        def double(items):
+            return map(lambda x: x * 2, items)
+        self.opthdr.run(['test', 'numbers', 'double'])
+        self.assertEqual(self.mock.call_count, 3)
+        self.assertTrue(self.opthdr._command['double'].stream)
+
+    def test_optionhandler_stream_close_on_error(self):
+        events = []
+        @self.opthdr.command
+        def numbers():
+            try:
+                yield 1
+                yield 2
+            finally:
+                events.append('closed')
+        @self.opthdr.command
+        def fail(items):
+            next(items)
+            raise TestException32
+        with self.assertRaises(SystemExit):
+            self.opthdr.run(['test', 'numbers', 'fail'])
+        self.assertEqual(events, ['closed'])
+
+    def test_optionhandler_long_chain(self):
+        mock = self.mock
+        @self.opthdr.default
+        class Storage():
+            def __init__(self):
+                self.data = {}
+            @self.opthdr.command(key='k:str', value='v:int')
+            def create(self, key, value):
+                self.data[key] = value
+                return self
+            @self.opthdr.command
+            def dump(self):
+                mock(self.data)
+        argv = ('test',)
+        for i in range(1000):
+            argv += ('create', 'k{}'.format(i), str(i))
+        self.opthdr.run(argv + ('dump',))
+        self.mock.assert_called_once_with({'k{}'.format(i): i for i in range(1000)})
+
+    def test_optionhandler_call_at(self):
+        def func(last, value, *, n=0):
+            self.mock(last, value, n)
+            return value
+        ch = opttools.CommandHandler(func, n='n:int', value='_:int', _='+')
+        argv = ['test', 'func', '-n1', '2', 'next']
+        self.assertEqual(ch.call_at(argv, 1, last='x'), (2, 4))
+        self.mock.assert_called_once_with('x', 2, 1)
+        self.assertEqual(argv, ['test', 'func', '-n1', '2', 'next'])
+
+    def test_optionhandler_memo(self):
+        def func(last, value, *, n=0, tags=[]):
+            tags.append(value)
+            self.mock(last, value, n, tags)
+        ch = opttools.CommandHandler(func, n='n:int', value='_:int', \
+            tags='t:list', _memo=2, _='+')
+        argv = ['test', 'func', '-n1', '-ta', '2', 'func', '-n1', '-ta', '2', \
+            'func', '-n1', '-ta', '2']
+        self.assertEqual(ch.call_at(argv, 1, last='x'), (None, 5))
+        self.assertEqual(ch.call_at(argv, 5, last='x'), (None, 9))
+        self.assertEqual(ch.call_at(argv, 9, last='x'), (None, 13))
+        self.mock.assert_called_with('x', 2, 1, ['a', 2])
+        self.assertEqual(ch.memo_info(), opttools.MemoInfo(2, 1, 2, 1))
+        # Options following the memoised tokens are still parsed
+        self.assertEqual(ch.call_at(['func', '-n1', '-ta', '-n3', '4'], 0, \
+            last='x'), (None, 5))
+        self.mock.assert_called_with('x', 4, 3, ['a', 4])
+
+    def test_optionhandler_memo_varargs(self):
+        def func(*args, n=0):
+            self.mock(args, n)
+        ch = opttools.CommandHandler(func, n='n:int', _memo=8, _='+')
+        ch.call_at(['func', '-n1', 'a'], 0)
+        self.mock.assert_called_with(('a',), 1)
+        # Same prefix, more operands follow
+        self.assertEqual(ch.call_at(['func', '-n1', 'a', 'b', '{'], 0), \
+            (None, 4))
+        self.mock.assert_called_with(('a', 'b'), 1)
+        self.assertEqual(ch.call_at(['func', '-n1', 'a'], 0), (None, 3))
+        self.assertEqual(ch.memo_info().hits, 1)
+
+    def test_optionhandler_memo_impure(self):
+        def func(*, n=0):
+            pass
+        opttools.IMPURE_TYPES.add('int')
+        try:
+            ch = opttools.CommandHandler(func, n='n:int', _memo=8, _='+')
+            ch.call_at(['func', '-n1'], 0)
+            ch.call_at(['func', '-n1'], 0)
+        finally:
+            opttools.IMPURE_TYPES.discard('int')
+        self.assertEqual(ch.memo_info(), opttools.MemoInfo(0, 0, 8, 0))
+
+    def test_optionhandler_operands_fd(self):
+        def count(files, *, n=0):
+            self.assertNotIsInstance(files, (list, tuple))
+            self.mock(list(files), n)
+        r, w = os.pipe()
+        os.write(w, b'a\0b c\0\0d')
+        os.close(w)
+        try:
+            ch = opttools.CommandHandler(count, n='n:int', _operands=r, \
+                _operands_sep='\0', _='+')
+            self.assertEqual(ch.call_at(['count', '-n1', 'next'], 0), \
+                (None, 2))
+        finally:
+            os.close(r)
+        self.mock.assert_called_once_with(['a', 'b c', 'd'], 1)
+
+    def test_optionhandler_operands_stdin_map(self):
+        def double(*values, prefix=''):
+            return [prefix + x * 2 for x in values]
+        ch = opttools.CommandHandler(double, prefix='p:str', \
+            _operands='stdin', _map='thread', _='+')
+        stdin = io.TextIOWrapper(io.BytesIO(b'a\nb\n\nc\n'))
+        with unittest.mock.patch('sys.stdin', stdin), \
+                unittest.mock.patch('libcli.batch.LAZY_CHUNKSIZE', 2):
+            self.assertEqual(ch.call_at(['double', '-p-'], 0), \
+                (['-aa', '-bb', '-cc'], 2))
+
+    def test_optionhandler_operands_structure(self):
+        def func(*args):
+            pass
+        with self.assertRaises(opttools.StructureError):
+            opttools.CommandHandler(func, _operands='stdin').build_opts()
+        with self.assertRaises(opttools.StructureError):
+            opttools.CommandHandler(func, _operands='-')
+
+    def test_optionhandler_resource_types(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'data')
+            f.flush()
+            opened = []
+            @self.opthdr.default(src='s:path', fin='f:file', data='d:mmap')
+            def load(*, src=None, fin=None, data=None):
+                opened.extend([fin, data])
+                self.mock(src, fin.read(), data[:])
+                return fin
+            @self.opthdr.command
+            def show(fin):
+                self.mock(fin.closed)
+            self.opthdr.run(['test', '-s', f.name, '-f', f.name, '-d', f.name])
+            self.mock.assert_called_once_with(f.name, b'data', b'data')
+            # Released after the command, or the chain when carried
+            self.assertTrue(opened[0].closed)
+            self.assertTrue(opened[1].closed)
+            self.mock.reset_mock()
+            self.opthdr.run(['test', '-s', f.name, '-f', f.name, '-d', f.name, \
+                'show'])
+            self.mock.assert_called_with(False)
+            self.assertTrue(opened[2].closed)
+            with self.assertRaises(SystemExit) as cm:
+                self.opthdr.run(['test', '-s', f.name + '.missing'])
+            self.assertEqual(cm.exception.code, 127)
+
+    def test_optionhandler_resource_mmap_view(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'data')
+            f.flush()
+            @self.opthdr.default(data='d:mmap')
+            def load(*, data=None):
+                return memoryview(data)[:2]
+            @self.opthdr.command
+            def show(view):
+                self.mock(bytes(view))
+            self.opthdr.run(['test', '-d', f.name, 'show'])
+            self.mock.assert_called_once_with(b'da')
+            self.assertEqual(self.opthdr._dispatch(['test', '-d', f.name], \
+                None).tobytes(), b'da')
+
+    def test_optionhandler_resource_error(self):
+        with tempfile.NamedTemporaryFile() as f:
+            opened = []
+            @self.opthdr.default(fin='f:file')
+            def load(*, fin=None):
+                opened.append(fin)
+                raise TestException32
+            with self.assertRaises(SystemExit):
+                self.opthdr.run(['test', '-f', f.name])
+            self.assertTrue(opened[0].closed)
+
+    def test_optionhandler_fan_out(self):
+        import threading
+        barrier = threading.Barrier(2, timeout=5)
+        @self.opthdr.default(n='_n:int')
+        def load(*, n=3):
+            return list(range(n))
+        @self.opthdr.command
+        def total(data):
+            return sum(data)
+        @self.opthdr.command
+        def size(data):
+            return len(data)
+        @self.opthdr.command(n='_n:int')
+        def scale(data, *, n=1):
+            barrier.wait() # both branches run at the same time
+            return [x * n for x in data]
+        @self.opthdr.command
+        def show(data):
+            self.mock(data)
+        self.opthdr.run(['test', '-n4', '{', 'scale', 'total', '}', \
+            '{', 'scale', '-n2', '{', 'size', '}', '{', 'total', '}', '}', \
+            'show'])
+        self.mock.assert_called_once_with([6, [4, 12]])
+
+    def test_optionhandler_fan_out_error(self):
+        @self.opthdr.default
+        def load():
+            return 1
+        @self.opthdr.command
+        def fail0(last):
+            raise TestException
+        @self.opthdr.command
+        def fail32(last):
+            raise TestException32
+        with self.assertRaises(SystemExit) as cm:
+            self.opthdr.run(['test', '--libcli-jobs=1', '{', 'fail32', '}', \
+                '{', 'fail0', '}'])
+        self.assertEqual(cm.exception.code, 32)
+        with self.assertRaises(SystemExit) as cm:
+            self.opthdr.run(['test', '{', 'fail32'])
+        self.assertEqual(cm.exception.code, 127)
+
+    def test_optionhandler_brace_operands(self):
+        @self.opthdr.command
+        def echo(*words):
+            return list(words)
+        @self.opthdr.command
+        def pair(a, b):
+            return [a, b]
+        @self.opthdr.command
+        def show(data):
+            self.mock(data)
+        self.opthdr.run(['test', 'echo', 'a', '}'])
+        self.opthdr.run(['test', 'echo', '--', '{', 'x', '}'])
+        self.opthdr.run(['test', 'echo', '--', 'a', '{', '}', 'show'])
+        self.assertEqual(self.mock.call_args_list, [])
+        self.assertEqual(self.opthdr._dispatch(['test', 'echo', '--', '{', \
+            'x'], None), ['{', 'x'])
+        self.opthdr._dispatch(['test', 'pair', '--', '{', '}', 'show'], None)
+        self.mock.assert_called_once_with(['{', '}'])
+        self.mock.reset_mock()
+        self.opthdr.run(['test', 'echo', 'a', '{', 'show', '}'])
+        self.mock.assert_called_once_with(['a'])
+
+    def test_optionhandler_fan_out_stream(self):
+        @self.opthdr.command(n='_n:int')
+        def numbers(*, n=3):
+            for i in range(n):
+                yield i
+        @self.opthdr.command
+        def total(items):
+            return sum(items)
+        @self.opthdr.command
+        def show(data):
+            self.mock(data)
+        self.opthdr.run(['test', 'numbers', '-n', '100', '{', 'total', '}', \
+            '{', 'total', '}', '{', '}', 'show'])
+        self.mock.assert_called_once_with([4950, 4950, unittest.mock.ANY])
+        self.assertEqual(list(self.mock.call_args[0][0][2]), list(range(100)))
+        self.mock.reset_mock()
+        asyncio.run(self.opthdr.run_async(['test', 'numbers', '{', 'total', \
+            '}', '{', 'total', '}', 'show']))
+        self.mock.assert_called_once_with([3, 3])
+
+    def test_optionhandler_fan_out_async(self):
+        @self.opthdr.default
+        async def load():
+            return 2
+        @self.opthdr.command
+        async def double(last):
+            return last * 2
+        @self.opthdr.command
+        def show(data):
+            self.mock(data)
+        asyncio.run(self.opthdr.run_async(['test', '{', 'double', '}', \
+            '{', '}', 'show']))
+        self.mock.assert_called_once_with([4, 2])
+
 
 class TestOptionHandlerDebug(TestOptionHandler):
     def setUp(self):
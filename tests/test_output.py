@@ -0,0 +1,95 @@
+import io
+import json
+import unittest
+import unittest.mock
+import libcli.opttools as opttools
+import libcli.output as output
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class Point():
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+
+class TestOutput(unittest.TestCase):
+    def setUp(self):
+        self.opthdr = opttools.OptionHandler()
+        self.produced = []
+        @self.opthdr.default
+        def rows(*, n=3):
+            for i in range(n):
+                self.produced.append(i)
+                yield {'id': i, 'tags': {'a'}}
+        @self.opthdr.command
+        def point(last):
+            return Point(1, 2)
+        @self.opthdr.encoder(Point)
+        def encode(p):
+            return [p.x, p.y]
+
+    def run_output(self, *argv):
+        stdout = io.StringIO()
+        with unittest.mock.patch('sys.stdout', stdout):
+            self.opthdr.run(['test'] + list(argv))
+        return stdout.getvalue()
+
+    def test_output_ndjson(self):
+        self.assertEqual(self.run_output('--libcli-output=ndjson'), \
+            '{"id": 0, "tags": ["a"]}\n{"id": 1, "tags": ["a"]}\n'\
+            '{"id": 2, "tags": ["a"]}\n')
+        self.assertEqual(self.run_output('--libcli-output=ndjson', 'point'), \
+            '[1, 2]\n')
+
+    def test_output_json(self):
+        self.assertEqual(json.loads(self.run_output('--libcli-output', 'json', \
+            '--n', '2')), [{'id': 0, 'tags': ['a']}, {'id': 1, 'tags': ['a']}])
+
+    def test_output_incremental(self):
+        stream = unittest.mock.MagicMock()
+        lengths = []
+        stream.write.side_effect = lambda data: lengths.append( \
+            (len(data), len(self.produced)))
+        with unittest.mock.patch('libcli.output.BUFFER_SIZE', 64):
+            output.write(({'id': i} for i in range(100) \
+                if not self.produced.append(i)), 'ndjson', stream=stream)
+        # Written as produced, in buffered chunks
+        self.assertGreater(len(lengths), 10)
+        self.assertLess(lengths[0][1], 100)
+
+    def test_output_invalid(self):
+        with self.assertRaises(SystemExit) as cm, \
+                self.assertLogs('libcli.opttools'):
+            self.run_output('--libcli-output=xml')
+        self.assertEqual(cm.exception.code, 127)
+        self.assertEqual(self.produced, [])
+        self.opthdr._encoder.clear()
+        with self.assertRaises(SystemExit) as cm, \
+                self.assertLogs('libcli.opttools'):
+            self.run_output('--libcli-output=json', 'point')
+        self.assertEqual(cm.exception.code, 127)
+
+    def test_output_producer_error(self):
+        def items():
+            yield {'id': 1}
+            yield None + 1
+        stream = io.StringIO()
+        with self.assertRaises(TypeError):
+            output.write(items(), 'ndjson', stream=stream)
+        with self.assertRaises(opttools.OptionError):
+            output.write([{'id': 1}, object()], 'json', stream=stream)
+
+    @unittest.skipIf(msgpack is None, 'msgpack not installed')
+    def test_output_msgpack(self):
+        stream = io.BytesIO()
+        output.write(iter([{'id': 1}, Point(1, 2)]), 'msgpack', \
+            encoders=self.opthdr._encoder, stream=stream)
+        self.assertEqual(list(msgpack.Unpacker(io.BytesIO(stream.getvalue()))), \
+            [{'id': 1}, [1, 2]])
+
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()
@@ -0,0 +1,80 @@
+import io
+import os
+import tempfile
+import unittest
+import unittest.mock
+import libcli.opttools as opttools
+import libcli.pathset as pathset
+
+class TestPathSet(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        for i in ('a.txt', 'b.log', '.hidden.txt', 'sub/c.txt', 'sub/deep/d.txt', \
+                'sub/deep/e.log', 'other/f.txt'):
+            path = os.path.join(self.root, i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+        os.symlink(self.root, os.path.join(self.root, 'sub', 'loop'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def expand(self, pattern, cache=None):
+        return [os.path.relpath(x, self.root) for x in \
+            pathset.expand(os.path.join(self.root, pattern), cache)]
+
+    def test_pathset_expand(self):
+        self.assertEqual(self.expand('*.txt'), ['a.txt'])
+        self.assertEqual(self.expand('.*.txt'), ['.hidden.txt'])
+        self.assertEqual(self.expand('*/*.txt'), ['other/f.txt', 'sub/c.txt'])
+        self.assertEqual(self.expand('sub/d?ep/[de].*'), \
+            ['sub/deep/d.txt', 'sub/deep/e.log'])
+        self.assertEqual(self.expand('a.txt'), ['a.txt'])
+        self.assertEqual(self.expand('missing'), [])
+        self.assertEqual(self.expand('missing/*'), [])
+
+    def test_pathset_expand_recursive(self):
+        self.assertEqual(self.expand('**/*.txt'), ['a.txt', 'other/f.txt', \
+            'sub/c.txt', 'sub/deep/d.txt'])
+        self.assertEqual(self.expand('sub/**'), ['sub/c.txt', 'sub/deep', \
+            'sub/deep/d.txt', 'sub/deep/e.log', 'sub/loop'])
+
+    def test_pathset_cache(self):
+        cache = pathset.ScanCache()
+        self.expand('**/*.txt', cache)
+        scans = cache.scans
+        self.assertEqual(self.expand('**/*.log', cache), ['b.log', 'sub/deep/e.log'])
+        self.assertEqual(cache.scans, scans)
+
+    def test_pathset_option_type(self):
+        opthdr = opttools.OptionHandler()
+        results = []
+        @opthdr.command(files='_:glob', exclude='x:glob')
+        def count(*files, exclude=()):
+            self.assertIsInstance(files[0], str)
+            excluded = set(exclude)
+            results.append(len([x for x in files if x not in excluded]))
+        @opthdr.command(files='_:glob', _map='thread')
+        def size(*files):
+            return [os.path.getsize(x) for x in files]
+        stream = io.StringIO('count -x {0}/b.log {0}/*\ncount {0}/**/*.txt\n'.\
+            format(self.root))
+        with unittest.mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertEqual(opthdr.run_batch(stream), [0, 0])
+        self.assertEqual(results, [3, 4])
+        # The listing of root is shared by the lines of a batch
+        self.assertEqual(scandir.call_count, 4)
+        @opthdr.command(files='_:glob')
+        def names(*files):
+            return [os.path.relpath(x, self.root) for x in files]
+        self.assertEqual(opthdr._dispatch(['test', 'names', os.path.join( \
+            self.root, 'sub', '*.txt'), os.path.join(self.root, '*.txt')], \
+            None), ['sub/c.txt', 'a.txt'])
+        self.assertEqual(opthdr._command['size'].call_at(['size', \
+            os.path.join(self.root, '**', '*.log')], 0, \
+            ctx=opttools.Context()), ([0, 0], 2))
+
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()
@@ -0,0 +1,106 @@
+import json
+import os
+import pstats
+import tempfile
+import unittest
+import libcli.opttools as opttools
+import libcli.profile as profile
+
+class TestException32(Exception):
+    pass
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'trace.json')
+        self.opthdr = opttools.OptionHandler()
+        self.opthdr.error(TestException32, errno=32)
+        @self.opthdr.default(n='n:int')
+        def start(*, n=1):
+            return n
+        @self.opthdr.command
+        def double(last):
+            return last * 2
+        @self.opthdr.command
+        def fail(last):
+            raise TestException32
+        self.retained = []
+        @self.opthdr.command(items='i:list')
+        def grow(last, *, items=[]):
+            self.retained.append([bytearray(1000) for x in range(1000)])
+            temporary = bytearray(1 << 20)
+            return last
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def events(self):
+        with open(self.path) as f:
+            return json.load(f)['traceEvents']
+
+    def test_profile_trace(self):
+        self.opthdr.run(['test', '--libcli-profile', self.path, '-n2', \
+            'double', 'double'])
+        events = self.events()
+        self.assertEqual(events[0]['name'], 'startup')
+        self.assertEqual([(x['name'], x['ph']) for x in events[1:7]], \
+            [('start', 'B'), ('build_opts', 'B'), ('build_opts', 'E'), \
+            ('parse', 'B'), ('parse', 'E'), ('convert', 'B')])
+        self.assertEqual([x['name'] for x in events if x['cat'] == 'command' \
+            and x['ph'] == 'E'], ['start', 'double', 'double'])
+        # Balanced and ordered
+        stack = []
+        for i in events[1:]:
+            if i['ph'] == 'B':
+                stack.append(i)
+            else:
+                self.assertEqual(stack.pop()['name'], i['name'])
+                self.assertGreaterEqual(i['ts'], events[0]['ts'])
+        self.assertEqual(stack, [])
+        self.assertEqual(self.opthdr.tracers, [])
+
+    def test_profile_error(self):
+        with self.assertRaises(SystemExit) as cm, \
+                self.assertLogs('libcli.opttools'):
+            self.opthdr.run(['test', '--libcli-profile', self.path, 'fail'])
+        self.assertEqual(cm.exception.code, 32)
+        self.assertIn('TestException32', self.events()[-1]['args']['error'])
+
+    def test_profile_pstats(self):
+        stats = os.path.join(self.tmpdir.name, 'run.pstats')
+        self.opthdr.run(['test', '--libcli-profile', self.path, \
+            '--libcli-profile-pstats', stats, 'double'])
+        functions = [x[2] for x in pstats.Stats(stats).stats]
+        self.assertIn('double', functions)
+        self.assertNotIn('scan_at', functions)
+
+    def test_profile_api(self):
+        profiler = profile.Profiler(self.path)
+        self.opthdr.tracers.append(profiler)
+        self.opthdr._command['double'].call_at(['double'], 0, last=1, \
+            ctx=opttools.Context(tracers=self.opthdr.tracers))
+        profiler.close()
+        self.assertEqual(self.events()[0]['name'], 'double')
+
+    def test_memprofile(self):
+        self.opthdr.run(['test', '--libcli-memprofile', self.path, \
+            'grow', 'grow', '-i', ','.join(['x'] * 10000)])
+        with open(self.path) as f:
+            report = json.load(f)
+        self.assertEqual([x['name'] for x in report['commands']], \
+            ['start', 'grow'])
+        grow = report['commands'][1]
+        self.assertEqual(grow['calls'], 2)
+        self.assertGreater(grow['net'], 2000000)
+        self.assertGreater(grow['peak'], grow['net'] // 2 + (1 << 20))
+        self.assertGreater(grow['phases']['convert']['peak'], 10000 * 8)
+        self.assertEqual(grow['phases']['call']['calls'], 2)
+        self.assertIn(__file__, grow['top'][0]['site'])
+        self.assertGreater(grow['top'][0]['size'], 2000000)
+        self.assertGreater(report['maxrss'], report['peak'])
+        self.assertFalse(profile.tracemalloc.is_tracing())
+
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()
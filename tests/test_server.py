@@ -0,0 +1,164 @@
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import libcli.opttools as opttools
+import libcli.server as server
+import libcli.client as client
+
+class TestException32(Exception):
+    pass
+
+
+LEAKED = []
+
+def make_handler():
+    opthdr = opttools.OptionHandler()
+    opthdr.error(TestException32, errno=32)
+    @opthdr.command(text='t:str')
+    def echo(*, text=''):
+        print(text)
+    @opthdr.command
+    def data():
+        return {'a': 1}
+    @opthdr.command
+    def where():
+        print(os.getcwd(), os.environ.get('LIBCLI_TEST'))
+    @opthdr.command
+    def cat():
+        sys.stdout.write(sys.stdin.read())
+    @opthdr.command
+    def fail():
+        print('failing', file=sys.stderr)
+        raise TestException32
+    @opthdr.command
+    def leak():
+        LEAKED.append(None)
+        print(len(LEAKED))
+    @opthdr.command
+    def crash():
+        os.kill(os.getpid(), 9)
+    @opthdr.command
+    def wait():
+        time.sleep(0.5)
+        print(os.getpid())
+    return opthdr
+
+
+class TestServer(unittest.TestCase):
+    server_class = server.Server
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'test.sock')
+        self.processes = []
+
+    def tearDown(self):
+        for i in self.processes:
+            if i.is_alive():
+                i.terminate()
+            i.join(5)
+        self.tmpdir.cleanup()
+
+    def start(self, **kwargs):
+        srv = self.server_class(make_handler(), self.path, **kwargs)
+        srv.bind()
+        process = multiprocessing.get_context('fork').Process( \
+            target=srv.serve_forever)
+        process.start()
+        srv.sock.close()
+        self.processes.append(process)
+        return process
+
+    def call(self, argv, stdin=b'', **kwargs):
+        with tempfile.TemporaryFile() as fin, tempfile.TemporaryFile() as fout, \
+                tempfile.TemporaryFile() as ferr:
+            fin.write(stdin)
+            fin.seek(0)
+            status = client.call(self.path, argv, \
+                stdio=(fin.fileno(), fout.fileno(), ferr.fileno()), **kwargs)
+            fout.seek(0)
+            ferr.seek(0)
+            return status, fout.read().decode(), ferr.read().decode()
+
+    def test_server_call(self):
+        self.start(workers=2)
+        self.assertEqual(self.call(['test', 'echo', '-t', 'hello']), \
+            (0, 'hello\n', ''))
+        self.assertEqual(self.call(['test', 'cat'], stdin=b'data'), \
+            (0, 'data', ''))
+        status, out, err = self.call(['test', 'fail'])
+        self.assertEqual((status, out), (32, ''))
+        self.assertIn('failing', err)
+        self.assertEqual(self.call(['test', 'unknown'])[0], 127)
+
+    def test_server_global_options(self):
+        self.start(workers=1)
+        self.assertEqual(self.call(['test', '--libcli-output', 'json', \
+            'data']), (0, '{"a": 1}\n', ''))
+        self.assertEqual(self.call(['test', 'data']), (0, '', ''))
+        status, out, err = self.call(['test', '--libcli-output=xml', 'data'])
+        self.assertEqual(status, 127)
+        for i in ['--libcli-serve=x', '--libcli-interactive', \
+                '--libcli-profile=x', '--libcli-unknown']:
+            self.assertEqual(self.call(['test', i, 'data'])[0], 127)
+
+    def test_server_env_cwd(self):
+        self.start(workers=1)
+        status, out, err = self.call(['test', 'where'], \
+            env={'LIBCLI_TEST': 'value'}, cwd=self.tmpdir.name)
+        self.assertEqual(out, '{} value\n'.format(os.path.realpath(self.tmpdir.name)))
+        status, out, err = self.call(['test', 'where'], env={})
+        self.assertEqual(out, '{} None\n'.format(os.getcwd()))
+
+    def test_server_concurrent(self):
+        self.start(workers=2)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append( \
+            self.call(['test', 'wait']))) for i in range(2)]
+        start = time.monotonic()
+        for i in threads:
+            i.start()
+        for i in threads:
+            i.join()
+        self.assertLess(time.monotonic() - start, 0.95)
+        self.assertEqual([x[0] for x in results], [0, 0])
+        self.assertNotEqual(results[0][1], results[1][1])
+
+    def test_server_idle_timeout(self):
+        process = self.start(workers=2, idle_timeout=0.3)
+        self.assertEqual(self.call(['test', 'echo'])[0], 0)
+        process.join(5)
+        self.assertEqual(process.exitcode, 0)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_server_protocol_version(self):
+        self.start(workers=1)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path)
+            server.send_message(sock, {'version': 0, 'argv': ['test']}, \
+                fds=(0, 1, 2))
+            response, fds = server.recv_message(sock)
+        self.assertEqual(response['status'], server.EXIT_PROTOCOL)
+        self.assertEqual(response['version'], server.PROTOCOL_VERSION)
+
+
+class TestForkServer(TestServer):
+    server_class = server.ForkServer
+
+    def test_server_isolated(self):
+        self.start(workers=2)
+        self.assertEqual(self.call(['test', 'leak'])[1], '1\n')
+        self.assertEqual(self.call(['test', 'leak'])[1], '1\n')
+
+    def test_server_crash(self):
+        self.start(workers=1)
+        self.assertEqual(self.call(['test', 'crash'])[0], 128 + 9)
+
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()
@@ -0,0 +1,126 @@
+import io
+import os
+import tempfile
+import unittest
+import unittest.mock
+import libcli.opttools as opttools
+import libcli.shell as shell
+
+class TestException32(Exception):
+    pass
+
+
+class TestShell(unittest.TestCase):
+    def setUp(self):
+        self.opthdr = opttools.OptionHandler()
+        self.opthdr.error(TestException32, errno=32)
+        self.loaded = 0
+        test = self
+        @self.opthdr.default(filename='f:str')
+        class Storage():
+            def __init__(self, *, filename='data'):
+                test.loaded += 1
+                self.data = {}
+            @self.opthdr.command(key='k:str', value='v:int')
+            def create(self, key, value):
+                self.data[key] = value
+                return self
+            @self.opthdr.command(key='k:str')
+            def read(self, key):
+                if key not in self.data:
+                    raise TestException32(key)
+                print(self.data[key])
+            @self.opthdr.command(verbose='v')
+            def list(self, *, verbose=None):
+                print(sorted(self.data))
+                return self
+
+    def test_shell_resident(self):
+        stream = io.StringIO('create -k a -v 1 create -k b -v 2\n\nread -k a\n'\
+            'read -k missing\nunknown\ncreate -k "c\nlist\n')
+        with unittest.mock.patch('sys.stdout', new=io.StringIO()) as stdout:
+            with self.assertLogs('libcli.opttools', 'ERROR') as cm:
+                errno = self.opthdr.interact(['test', '-f', 'x'], stream=stream)
+        self.assertEqual(errno, 0)
+        self.assertEqual(self.loaded, 1)
+        self.assertEqual(stdout.getvalue(), "1\n['a', 'b']\n")
+        self.assertEqual(len(cm.output), 3)
+
+    def test_shell_async_default(self):
+        opthdr = opttools.OptionHandler()
+        @opthdr.default
+        async def load():
+            return {'a': 1}
+        @opthdr.command
+        def show(data):
+            print(data)
+            return data
+        with unittest.mock.patch('sys.stdout', new=io.StringIO()) as stdout:
+            errno = opthdr.interact(['test', 'show'], stream=['show\n'])
+        self.assertEqual(errno, 0)
+        self.assertEqual(stdout.getvalue(), "{'a': 1}\n{'a': 1}\n")
+
+    def test_shell_line_context(self):
+        opthdr = opttools.OptionHandler()
+        files, events = [], []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'data')
+            with open(path, 'w') as f:
+                f.write('abc')
+            @opthdr.command(src='s:file')
+            def peek(last, *, src):
+                files.append(src)
+                src.read(1)
+            @opthdr.command(src='s:file')
+            def keep(last=None, *, src):
+                files.append(src)
+                return {'src': src}
+            @opthdr.command
+            def numbers(last):
+                try:
+                    for i in range(3):
+                        events.append(i)
+                        yield i
+                finally:
+                    events.append('closed')
+            @opthdr.command
+            def check(last):
+                events.append([x.closed for x in files])
+            errno = opthdr.interact(['test'], stream=['keep -s {}\n'.format( \
+                path), 'peek -s {}\n'.format(path), 'check\n', 'numbers\n', \
+                'check\n', 'keep -s {}\n'.format(path), 'check\n'])
+        self.assertEqual(errno, 0)
+        self.assertEqual(events, [[False, True], 0, 1, 2, 'closed', \
+            [False, True], [True, True, False]])
+        self.assertTrue(all(x.closed for x in files))
+
+    def test_shell_exit_code(self):
+        with self.assertLogs('libcli.opttools', 'ERROR'):
+            errno = self.opthdr.interact(['test'], stream=['read -k x\n'])
+        self.assertEqual(errno, 32)
+        with self.assertLogs('libcli.opttools', 'ERROR'):
+            errno = self.opthdr.interact(['test', '--unknown'], stream=[])
+        self.assertEqual(errno, 127)
+
+    def test_shell_stdin(self):
+        with unittest.mock.patch('sys.stdin', new=io.StringIO('create -k a -v 3\n'\
+                'read -k a\n')), \
+                unittest.mock.patch('sys.stdout', new=io.StringIO()) as stdout:
+            with self.assertRaises(SystemExit) as cm:
+                self.opthdr.run(['test', '--libcli-interactive'])
+        self.assertEqual(cm.exception.code, 0)
+        self.assertEqual(stdout.getvalue(), '3\n')
+
+    def test_shell_candidates(self):
+        sh = shell.Shell(self.opthdr)
+        self.assertEqual(sh.candidates('', ''), ['create', 'list', 'read'])
+        self.assertEqual(sh.candidates('cr', 'cr'), ['create'])
+        self.assertEqual(sh.candidates('create -', '-'), \
+            ['--key', '--value', '-k', '-v'])
+        self.assertEqual(sh.candidates('create -k a list --v', '--v'), \
+            ['--verbose'])
+        self.assertEqual(sh.candidates('--f', '--f'), ['--filename'])
+
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()
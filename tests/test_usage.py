@@ -0,0 +1,121 @@
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import types
+import unittest
+import unittest.mock
+import libcli
+import libcli.opttools as opttools
+import libcli.spec as spec
+import libcli.usage as usage
+
+
+class TestUsage(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.opthdr = opttools.OptionHandler()
+        @self.opthdr.command(level='l:int', depth='d::int=3', verbose='_v')
+        def report(path, mode='fast', *, level=1, depth=None, verbose=None):
+            """Report the entries of a file.
+
+            :param path: Path of the input
+            :param level: Level of detail
+            """
+            print('report', path)
+        @self.opthdr.command(help='h:str')
+        def other(*files, help=None):
+            """Do another thing."""
+            print('other', help)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_usage_render(self):
+        texts = usage.render(spec.describe(self.opthdr), 'tool')
+        self.assertEqual(sorted(texts), ['', 'report'])
+        self.assertEqual(texts[''], 'usage: tool COMMAND [ARG]... '\
+            '[COMMAND [ARG]...]...\n\ncommands:\n'\
+            '  report                Report the entries of a file.\n'\
+            '  other                 Do another thing.\n\n'\
+            'Run "tool COMMAND --help" for the help of COMMAND.\n')
+        text = texts['report']
+        self.assertTrue(text.startswith('usage: tool report [OPTION]... '\
+            'PATH [MODE]\n\nReport the entries of a file.\n\narguments:\n'))
+        self.assertIn('  PATH                  Path of the input\n', text)
+        self.assertIn('  -l LEVEL, --level=LEVEL\n                        '\
+            'Level of detail\n', text)
+        self.assertIn('  -d[DEPTH], --depth[=DEPTH]\n', text)
+        self.assertIn('(default: 3)', text)
+        self.assertIn('  -v\n', text)
+        self.assertNotIn(':param', text)
+
+    def test_usage_default(self):
+        opthdr = opttools.OptionHandler()
+        @opthdr.default(count='c:int')
+        def main(*names, count=1):
+            """Greet names."""
+        texts = usage.render(spec.describe(opthdr), 'tool')
+        self.assertEqual(sorted(texts), [''])
+        self.assertTrue(texts[''].startswith('usage: tool [OPTION]... '\
+            '[NAMES]...\n\nGreet names.\n\narguments:\n  NAMES\n\n'\
+            'options:\n  -c COUNT, --count=COUNT\n'))
+
+    def test_usage_run(self):
+        path = os.path.join(self.tmpdir.name, 'tool.py')
+        with open(path, 'w') as f:
+            f.write('pass\n')
+        main = types.ModuleType('__main__')
+        main.__file__ = path
+        with unittest.mock.patch.dict(os.environ, \
+                XDG_CACHE_HOME=self.tmpdir.name), \
+                unittest.mock.patch.dict(sys.modules, __main__=main), \
+                unittest.mock.patch('sys.stdout', new=io.StringIO()) as out:
+            self.assertFalse(usage.print_cached([path, '--help']))
+            self.opthdr.run([path, 'report', '--help'])
+            self.assertTrue(out.getvalue().startswith('usage: tool.py report'))
+            self.assertTrue(spec.for_prog(path).fresh())
+            out.seek(0)
+            out.truncate()
+            self.assertTrue(usage.print_cached([path, '--help']))
+            self.assertTrue(out.getvalue().startswith('usage: tool.py COMMAND'))
+            # Defined by the command, or not a command
+            self.assertFalse(usage.print_cached([path, 'other', '--help']))
+            self.assertFalse(usage.print_cached([path, 'none', '--help']))
+            self.assertFalse(usage.print_cached([path, 'report', 'x', '--help']))
+            self.opthdr.run([path, 'other', '--help', 'x'])
+            self.assertTrue(out.getvalue().endswith('other x\n'))
+            with open(path, 'a') as f:
+                f.write('pass\n')
+            self.assertFalse(usage.print_cached([path, '--help']))
+            with unittest.mock.patch.dict(os.environ, LIBCLI_NO_FAST_HELP='1'):
+                self.opthdr.run([path, '--help'])
+                self.assertFalse(usage.print_cached([path, '--help']))
+            self.assertTrue(usage.print_cached([path, '--help']))
+            with self.assertRaises(SystemExit) as cm:
+                libcli.fast_help([path, '--help'])
+            self.assertEqual(cm.exception.code, 0)
+            self.assertIsNone(libcli.fast_help([path, 'report', 'x']))
+
+    def test_usage_import(self):
+        # Importing libcli never answers --help nor exits, even when cached
+        path = os.path.join(self.tmpdir.name, 'tool.py')
+        with open(path, 'w') as f:
+            f.write('import libcli\nprint("imported")\n'\
+                '@libcli.command\ndef hello():\n    """Say hello."""\n'\
+                'libcli.run()\n')
+        env = dict(os.environ, XDG_CACHE_HOME=self.tmpdir.name, \
+            PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath( \
+                usage.__file__))))
+        for i in range(2):
+            result = subprocess.run([sys.executable, path, '--help'], \
+                stdout=subprocess.PIPE, universal_newlines=True, env=env, \
+                check=True)
+            self.assertTrue(result.stdout.startswith('imported\nusage: '))
+        with unittest.mock.patch.dict(os.environ, \
+                XDG_CACHE_HOME=self.tmpdir.name):
+            self.assertTrue(spec.for_prog(path).fresh())
+
+if __name__ == '__main__': # pragma: no cover
+    unittest.main()